@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Export the maps of an area to a printable image without GUI.
+# The tiles are fetched concurrently, and composited strip by strip (one tile row at a time),
+# which are streamed to the output file, so the area can be far larger than memory.
+
+import os
+import sys
+import zlib
+import math
+import time
+import struct
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import src.conf as conf
+from src.coord import TileSystem
+from src.tile import TileAgent, MapDescriptor
+from src.util import combineImage
+
+to_pixel = TileSystem.getPixcelXYByTileXY
+to_tile = TileSystem.getTileXYByPixcelXY
+
+'''
+Write a RGB png file row by row, only the compressor state is kept in memory.
+'''
+class PngStreamWriter:
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, filepath, width, height):
+        self.__width = width
+        self.__height = height
+        self.__rows = 0
+        self.__buf = []
+        self.__buf_len = 0
+
+        self.__file = open(filepath, 'wb')
+        self.__file.write(b'\x89PNG\r\n\x1a\n')
+        self.__writeChunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))  #8-bit RGB
+        self.__compressor = zlib.compressobj(6)
+
+    def __writeChunk(self, tag, data):
+        self.__file.write(struct.pack(">I", len(data)))
+        self.__file.write(tag)
+        self.__file.write(data)
+        self.__file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def __writeData(self, data):
+        if data:
+            self.__buf.append(data)
+            self.__buf_len += len(data)
+        if self.__buf_len >= self.CHUNK_SIZE:
+            self.__flushData()
+
+    def __flushData(self):
+        if self.__buf_len:
+            self.__writeChunk(b'IDAT', b''.join(self.__buf))
+            self.__buf = []
+            self.__buf_len = 0
+
+    #write the rows of @img, whose width should be the same as the png
+    def writeRows(self, img):
+        if img.size[0] != self.__width:
+            raise ValueError("the width of rows is %d, not %d" % (img.size[0], self.__width))
+        if self.__rows + img.size[1] > self.__height:
+            raise ValueError("too many rows")
+
+        data = img.convert("RGB").tobytes()
+        stride = self.__width * 3
+        for i in range(0, len(data), stride):
+            self.__writeData(self.__compressor.compress(b'\x00' + data[i:i+stride]))  #filter type: none
+        self.__rows += img.size[1]
+
+    def close(self):
+        if self.__rows != self.__height:
+            logging.warning("png has %d rows, not %d" % (self.__rows, self.__height))
+        self.__writeData(self.__compressor.flush())
+        self.__flushData()
+        self.__writeChunk(b'IEND', b'')
+        self.__file.close()
+
+# The world file in EPSG:3857 (web mercator, meters) for the image whose top-left pixel is (@px, @py)
+def writeWorldFile(filepath, level, px, py):
+    half = math.pi * TileSystem.EARTH_RADIUS
+    res = 2 * half / TileSystem.getMapSize(level)
+    with open(filepath, 'w') as f:
+        f.write("%.10f\n0.0\n0.0\n%.10f\n" % (res, -res))
+        f.write("%.10f\n%.10f\n" % ((px + 0.5) * res - half, half - (py + 0.5) * res))
+
+def loadMapDescriptors(dirpath):
+    descs = {}
+    for f in os.listdir(dirpath):
+        if os.path.splitext(f)[1].lower() == ".xml":
+            try:
+                desc = MapDescriptor.parseXml(os.path.join(dirpath, f))
+                descs[desc.map_id] = desc
+            except Exception as ex:
+                logging.error("parse file '%s' error: %s" % (f, str(ex)))
+    return descs
+
+# parse 'id' or 'id:alpha', or return the enabled maps of user conf if no any one.
+# the first map is the top layer.
+def getLayers(map_args, descs):
+    if not map_args:
+        map_args = [id + ':' + str(alpha) for id, (en, alpha) in conf.USER_MAPS.items() if en]
+
+    layers = []
+    for arg in map_args:
+        id, sep, alpha = arg.partition(':')
+        if id not in descs:
+            raise ValueError("map '%s' is not found in %s" % (id, conf.MAPCACHE_DIR))
+        layers.append((descs[id], float(alpha) if sep else 1.0))
+    return layers
+
+class AreaExporter:
+    LOOKAHEAD_ROWS = 2   #the tile rows which are fetched in advance
+
+    def __init__(self, layers, level, workers):
+        self.__level = level
+        self.__agents = []
+        for desc, alpha in layers:
+            if not (desc.level_min <= level <= desc.level_max):
+                raise ValueError("level %d is out of the range of map '%s'" % (level, desc.map_id))
+            self.__agents.append((TileAgent(desc, conf.MAPCACHE_DIR, auto_start=True), alpha))
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.fail_tiles = 0
+
+    def close(self):
+        self.__executor.shutdown()
+        for agent, alpha in self.__agents:
+            agent.close()
+
+    def __fetchTile(self, agent, x, y):
+        try:
+            return agent.getTile(self.__level, x, y, "sync", allow_fake=False)
+        except Exception as ex:
+            logging.error("[%s] fetch tile (%d,%d,%d) error: %s" % (agent.map_id, self.__level, x, y, str(ex)))
+            return None
+
+    # read the tiles of the row from disk by one query, and submit the others to download.
+    # return the futures of the row, ordered as the layers.
+    def __fetchRow(self, x_range, y):
+        row = []
+        for agent, alpha in self.__agents:
+            tiles, missing = agent.getTiles(self.__level, x_range, range(y, y+1), None, allow_fake=False)
+            futures = {}
+            for x in x_range:
+                if (x, y) in missing:
+                    futures[x] = self.__executor.submit(self.__fetchTile, agent, x, y)
+                else:
+                    futures[x] = tiles[(x, y)]
+            row.append(futures)
+        return row
+
+    def __compositeTile(self, row, x):
+        side = to_pixel(1, 1)[0]
+        tile = Image.new("RGBA", (side, side), "white")
+        for (agent, alpha), futures in reversed(list(zip(self.__agents, row))):
+            layer = futures[x]
+            if not isinstance(layer, Image.Image):
+                layer = layer.result()
+            if layer is None:
+                self.fail_tiles += 1
+                continue
+            if layer.mode != "RGBA":
+                layer = layer.convert("RGBA")
+            tile = combineImage(tile, layer, alpha)
+        return tile
+
+    # generate the composited tile rows of the tile rect, as (y, [tile, ...])
+    def genRows(self, x_range, y_range):
+        pending = deque()
+        ys = iter(y_range)
+        for y in ys:
+            pending.append((y, self.__fetchRow(x_range, y)))
+            if len(pending) > self.LOOKAHEAD_ROWS:
+                break
+
+        while pending:
+            y, row = pending.popleft()
+            next_y = next(ys, None)
+            if next_y is not None:
+                pending.append((next_y, self.__fetchRow(x_range, next_y)))
+            yield y, [self.__compositeTile(row, x) for x in x_range]
+
+def exportImage(exporter, level, left, upper, right, lower, filepath):
+    side = to_pixel(1, 1)[0]
+    t_left, t_upper = to_tile(left, upper)
+    t_right, t_lower = to_tile(right - 1, lower - 1)
+    x_range = range(t_left, t_right + 1)
+    y_range = range(t_upper, t_lower + 1)
+
+    width, height = right - left, lower - upper
+    logging.info("export %dx%d image from %d tiles" % (width, height, len(x_range) * len(y_range)))
+
+    writer = PngStreamWriter(filepath, width, height)
+    try:
+        strip = Image.new("RGB", (len(x_range) * side, side))
+        for y, tiles in exporter.genRows(x_range, y_range):
+            for i, tile in enumerate(tiles):
+                strip.paste(tile.convert("RGB"), (i * side, 0))
+
+            #crop to the area
+            px, py = to_pixel(t_left, y)
+            top, bottom = max(upper - py, 0), min(lower - py, side)
+            writer.writeRows(strip.crop((left - px, top, right - px, bottom)))
+            logging.info("row %d/%d done" % (y - t_upper + 1, len(y_range)))
+    finally:
+        writer.close()
+
+    writeWorldFile(os.path.splitext(filepath)[0] + ".pgw", level, left, upper)
+
+def exportTiles(exporter, level, left, upper, right, lower, dirpath):
+    t_left, t_upper = to_tile(left, upper)
+    t_right, t_lower = to_tile(right - 1, lower - 1)
+    x_range = range(t_left, t_right + 1)
+    y_range = range(t_upper, t_lower + 1)
+    logging.info("export %d tiles" % (len(x_range) * len(y_range),))
+
+    for y, tiles in exporter.genRows(x_range, y_range):
+        for x, tile in zip(x_range, tiles):
+            tile_dir = os.path.join(dirpath, str(level), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            tile.convert("RGB").save(os.path.join(tile_dir, "%d.png" % (y,)))
+        logging.info("row %d/%d done" % (y - t_upper + 1, len(y_range)))
+
+def init_arguments():
+    parser = argparse.ArgumentParser(description='export the maps of an area to a large image, without GUI')
+    parser.add_argument("-v", "--verbose", help="show detail information", action="count", default=0)
+    parser.add_argument("-c", "--conf", help="load the config file in specific folder", default="")
+    parser.add_argument("-b", "--bbox", help="the area to export", type=float, nargs=4, required=True,
+            metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument("-l", "--level", help="the zoom level", type=int, required=True)
+    parser.add_argument("-m", "--map", help="the map id, with optional alpha as 'id:0.5'; the first one is the top layer."
+            " (default: the enabled maps)", action="append", default=[])
+    parser.add_argument("-w", "--workers", help="the number of concurrent downloads (default: 8)", type=int, default=8)
+    parser.add_argument("-t", "--tiles", help="write the composited tiles in DIR/level/x/y.png, instead of one image",
+            action="store_true")
+    parser.add_argument("output", help="the png file, with a world file .pgw in EPSG:3857; or the directory of tiles")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = init_arguments()
+
+    if args.conf:
+        conf.change_conf_dir(args.conf)
+
+    log_level = logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING
+    logging.basicConfig(level=log_level,
+            format="%(asctime)s.%(msecs)03d [%(levelname)s] [%(module)s] %(message)s", datefmt="%H:%M:%S")
+
+    min_lon, min_lat, max_lon, max_lat = args.bbox
+    left, upper = TileSystem.getPixcelXYByLatLon(max_lat, min_lon, args.level)
+    right, lower = TileSystem.getPixcelXYByLatLon(min_lat, max_lon, args.level)
+    if right <= left or lower <= upper:
+        sys.exit("the area is empty")
+
+    try:
+        layers = getLayers(args.map, loadMapDescriptors(conf.MAPCACHE_DIR))
+        if not layers:
+            sys.exit("no map to export")
+        exporter = AreaExporter(layers, args.level, args.workers)
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+    start = time.time()
+    try:
+        if args.tiles:
+            exportTiles(exporter, args.level, left, upper, right, lower, args.output)
+        else:
+            exportImage(exporter, args.level, left, upper, right, lower, args.output)
+    finally:
+        exporter.close()
+
+    if exporter.fail_tiles:
+        logging.warning("%d tiles are failed to fetch, left blank" % (exporter.fail_tiles,))
+    logging.info("export done in %.1f sec" % (time.time() - start,))
@@ -18,7 +18,7 @@ from PIL import Image, ImageTk, ImageDraw, ImageColor
 from math import floor, ceil, sqrt
 from tkinter import messagebox, filedialog, ttk
 from datetime import datetime, timedelta
-from threading import Lock, Thread
+from threading import Lock, Thread, Condition
 from collections import OrderedDict
 
 #my modules
@@ -27,11 +27,12 @@ import src.sym as sym
 import src.coord as coord
 import src.util as util
 from src.ui import MapSelectFrame
-from src.gpx import GpsDocument, WayPoint, TrackPoint
+from src.gpx import GpsDocument, WayPoint, TrackPoint, Track, ColumnarTrack
 from src.pic import PicDocument
 from src.util import GeoPoint, DrawGuard, imageIsTransparent, bindMenuCmdAccelerator, bindMenuCheckAccelerator
+from src.util import tuneAlpha, combineImage
 from src.util import AreaSelector, AreaSizeTooLarge, GeoInfo  #should move to ui.py
-from src.util import getPtPosText, getPtEleText, getPtTimeText, getPtTimezone, getPtLocaltime
+from src.util import getPtPosText, getPtPosTexts, getPtEleText, getPtTimeText, getPtTimezones, getTrkLocaltimes
 from src.util import downloadAsTemp, drawTextBg
 from src.tool import *
 from src.tile import TileAgent, MapDescriptor
@@ -66,7 +67,8 @@ def isPicFile(path):
         return True
     return False
 
-def getGpsDocument(path):
+# @progress_cb(read_bytes, total_bytes) is called periodically while loading, if any
+def getGpsDocument(path, progress_cb=None):
     try:
         #support http
         if path.startswith("http"):
@@ -77,10 +79,10 @@ def getGpsDocument(path):
         gps = GpsDocument()
 
         if ext == '.gpx':
-            gps.load(filename=path)
+            gps.load(filename=path, progress_cb=progress_cb)
         else:
             gpx_path = toGpxFile(path)
-            gps.load(filename=gpx_path)
+            gps.load(filename=gpx_path, progress_cb=progress_cb)
             os.remove(gpx_path)        #remove tmp file
             #pythonW.exe seems causing pipe error, if we get output from stdout directly.
             #gpx_string = toGpxString(path)
@@ -254,6 +256,7 @@ class MapBoard(tk.Frame):
         self.__map_req_time = datetime.min
         self.__map_has_update = False
         self.__map_prog = None
+        self.__strip_progs = []   #the progress of the strips rendered with failed tiles since the map
         self.__map_req_lock = Lock()
         self.__alter_time = None
         self.__pref_dir = None
@@ -269,9 +272,27 @@ class MapBoard(tk.Frame):
 
         Thread(target=self.__runMapUpdater).start()
 
+        #the exposed strips on panning, rendered by the strip renderer and placed by polling
+        self.__strip_cv = Condition()
+        self.__strip_reqs = []       #(gen, canvas rect, pan offset, geo, view attr), to render
+        self.__strip_done = []       #(gen, canvas rect, pan offset, img), to place
+        self.__strip_gen = 0         #increased as the whole map is rendered, to drop the strips requested before
+        self.__strip_pending = 0     #the strips requested but not rendered yet
+        self.__strip_job = None
+        Thread(target=self.__runStripRenderer).start()
+
         #canvas items
         self.__canvas_map = None
         self.__canvas_sel_area = None
+        self.__map_pimgs = {}        #canvas item tagged 'MAP' -> photo image, keep the refs
+        self.__map_rendered = None   #the rendered area (left, top, right, bottom) in canvas coordinates
+
+        #pan
+        self.__pan_job = None
+        self.__pan_dx = 0
+        self.__pan_dy = 0
+        self.__pan_offset = (0, 0)   #the canvas moved since the whole map is rendered
+        self.__is_panned = False
 
         #info
         self.__info_frame = self.initMapInfo()
@@ -340,7 +361,7 @@ class MapBoard(tk.Frame):
                 lambda:self.onEditTrk(mode='single'))
 
         split_trk_menu = tk.Menu(self.__rclick_menu, tearoff=0)
-        split_trk_menu.add_command(label='By day', command=lambda:self.onSplitTrk(self.trkDiffDay))
+        split_trk_menu.add_command(label='By day', command=lambda:self.onSplitTrkAt(self.trkDayChanges))
         split_trk_menu.add_command(label='By time gap', command=lambda:self.onSplitTrk(self.trkTimeGap))
         split_trk_menu.add_command(label='By distance', command=lambda:self.onSplitTrk(self.trkDistGap))
         self.__rclick_menu.add_cascade(label='Split tracks...', menu=split_trk_menu)
@@ -503,13 +524,16 @@ class MapBoard(tk.Frame):
     #release sources to exit
     def exit(self):
         self.__is_closed = True
+        with self.__strip_cv:
+            self.__strip_cv.notify()
         self.__leaveMode(self.__mode)
         self.__map_ctrl.close()
 
     def addFiles(self, file_pathes):
         gps_path, pic_path = parsePathes(file_pathes)  
         for path in gps_path:
-            self.addGpx(getGpsDocument(path))
+            progress_cb = lambda read, total, path=path: self.__setLoadProgress(path, read, total)
+            self.addGpx(getGpsDocument(path, progress_cb))
         for path in pic_path:
             self.addWpt(getPicDocument(path))
 
@@ -642,10 +666,12 @@ class MapBoard(tk.Frame):
         #re-config
         self.__map_descs = self.__map_menu.map_descriptors
         self.__map_ctrl.configMap(self.__map_descs)
+        self.__map_ctrl.invalidateMap(desc.map_id)
         self.resetMap()
 
     def __onMapAlphaChanged(self, desc, old_val):
         logging.debug("desc %s's enable change from %f to %f" % (desc.map_id, old_val, desc.alpha))
+        self.__map_ctrl.invalidateMap(desc.map_id)
         if desc.enabled:
             self.resetMap(force='all')
 
@@ -810,9 +836,134 @@ class MapBoard(tk.Frame):
                 return
             last_x, last_y = last_pos
             x, y = pos
-            self.__map_ctrl.shiftGeoPixel(last_x - x, last_y - y)
-            self.__setMapInfo()
+            self.__panMap(x - last_x, y - last_y)
+
+    # Pan the map by moving the rendered images, and only render the exposed area.
+    # The motions are coalesced to the display refresh rate.
+    def __panMap(self, dx, dy):
+        self.__map_ctrl.shiftGeoPixel(-dx, -dy)
+        self.__pan_dx += dx
+        self.__pan_dy += dy
+        self.__is_panned = True
+        if self.__pan_job is None:
+            self.__pan_job = self.after(conf.MAP_PAN_PERIOD_MS, self.__flushPan)
+
+    def __flushPan(self):
+        self.__pan_job = None
+        dx, dy = self.__pan_dx, self.__pan_dy
+        self.__pan_dx = self.__pan_dy = 0
+        if not dx and not dy:
+            return
+
+        self.__setMapInfo()
+        if self.__map_rendered is None:
             self.resetMap()
+            return
+
+        #move the rendered
+        self.disp_canvas.move('MAP', dx, dy)
+        left, top, right, bottom = self.__map_rendered
+        rendered = (left + dx, top + dy, right + dx, bottom + dy)
+        ox, oy = self.__pan_offset
+        self.__pan_offset = (ox + dx, oy + dy)
+
+        #request the exposed strips of the canvas
+        w = self.disp_canvas.winfo_width()
+        h = self.disp_canvas.winfo_height()
+        level = self.__map_ctrl.level
+        geo = self.__map_ctrl.geo
+        view = MapAttr(level, (geo.px(level), geo.py(level)), (w, h))
+        self.__map_ctrl.setViewport(view)  #the strips of the view not focus the downloads on themselves
+        with self.__strip_cv:
+            for strip in self.getExposedStrips(rendered, w, h, conf.MAP_PAN_OVERDRAW_PX):
+                left, top = strip[:2]
+                self.__strip_reqs.append((self.__strip_gen, strip, self.__pan_offset, geo.addPixel(left, top, level), view))
+                self.__strip_pending += 1
+            self.__strip_cv.notify()
+        self.__map_rendered = (0, 0, w, h)
+        if self.__strip_job is None:
+            self.__strip_job = self.after(conf.MAP_PAN_PERIOD_MS, self.__placeStrips)
+
+        #remove the images out of the canvas
+        for item in self.disp_canvas.find_withtag('MAP'):
+            x1, y1, x2, y2 = self.disp_canvas.bbox(item)
+            if x2 <= 0 or y2 <= 0 or x1 >= w or y1 >= h:
+                self.disp_canvas.delete(item)
+                self.__map_pimgs.pop(item, None)
+
+    # the strips (left, top, right, bottom) of the canvas @w x @h not covered by @rendered,
+    # each of which overdraws the rendered by @margin, so the labels across the edges are drawn entirely
+    @staticmethod
+    def getExposedStrips(rendered, w, h, margin=0):
+        left, top, right, bottom = rendered
+        strips = []
+        if top > 0:
+            strips.append((0, 0, w, min(top + margin, h)))
+        if bottom < h:
+            strips.append((0, max(bottom - margin, 0), w, h))
+        mid_top, mid_bottom = max(top, 0), min(bottom, h)
+        if mid_top < mid_bottom:
+            if left > 0:
+                strips.append((0, mid_top, min(left + margin, w), mid_bottom))
+            if right < w:
+                strips.append((max(right - margin, 0), mid_top, w, mid_bottom))
+        return strips
+
+    #The thread to render the strips requested on panning, out of the UI thread
+    def __runStripRenderer(self):
+        while True:
+            with self.__strip_cv:
+                while not self.__strip_reqs and not self.__is_closed:
+                    self.__strip_cv.wait()
+                if self.__is_closed:
+                    break
+                reqs, self.__strip_reqs = self.__strip_reqs, []
+
+            for gen, strip, offset, geo, view in reqs:
+                img = None
+                if gen == self.__strip_gen:  #or the whole map is rendered again
+                    left, top, right, bottom = strip
+                    try:
+                        with self.__map_req_lock:
+                            self.__map_req_time = datetime.now()  #postpone the auto update
+                            img, attr = self.__map_ctrl.getMap(right - left, bottom - top, geo=geo, level=view.level,
+                                    cb=self.__notifyTileReady, view=view)
+                            #to update the map as the tiles of the strip arrive
+                            if attr.fail_tiles:
+                                map_ids = [d.map_id for d in self.__map_descs if d.enabled]
+                                self.__strip_progs.append(MapProgressRec(attr, map_ids, needed_count=attr.fail_tiles))
+                    except Exception as ex:
+                        logging.error("render strip %s error: %s" % (str(strip), str(ex)))
+                with self.__strip_cv:
+                    self.__strip_pending -= 1
+                    if img is not None:
+                        self.__strip_done.append((gen, strip, offset, img))
+
+    #place the rendered strips, at where they are moved to by panning, until all requested are placed
+    def __placeStrips(self):
+        self.__strip_job = None
+        with self.__strip_cv:
+            done, self.__strip_done = self.__strip_done, []
+            is_pending = self.__strip_pending > 0
+
+        ox, oy = self.__pan_offset
+        for gen, strip, offset, img in done:
+            if gen != self.__strip_gen:
+                continue
+            left, top = strip[:2]
+            pos = (left + ox - offset[0], top + oy - offset[1])
+            pimg = ImageTk.PhotoImage(img)
+            item = self.disp_canvas.create_image(pos, image=pimg, anchor='nw', tag='MAP_STRIP')
+            #over the rendered map (for overdrawing), but under other canvas objects
+            self.disp_canvas.tag_lower(item)
+            if self.disp_canvas.find_withtag('MAP'):
+                self.disp_canvas.tag_raise(item, 'MAP')
+            self.disp_canvas.dtag(item, 'MAP_STRIP')
+            self.disp_canvas.addtag_withtag('MAP', item)
+            self.__map_pimgs[item] = pimg
+
+        if is_pending:
+            self.__strip_job = self.after(conf.MAP_PAN_PERIOD_MS, self.__placeStrips)
 
     def __onDragEnd(self):
         #saving image
@@ -827,6 +978,14 @@ class MapBoard(tk.Frame):
         #normal
         else:
             self.master['cursor'] = ''
+            #render the whole map after panning
+            if self.__pan_job is not None:
+                self.after_cancel(self.__pan_job)
+                self.__pan_job = None
+            if self.__is_panned:
+                self.__is_panned = False
+                self.__setMapInfo()
+                self.resetMap()
 
     # click-related events ======================================
     def onClickDown(self, e, flag):
@@ -1003,13 +1162,20 @@ class MapBoard(tk.Frame):
 
         self.resetMap()
 
+    #the indices of the points whose local date is not the one of the previous point with time,
+    #by the local times of the whole track at once
     @staticmethod
-    def trkDiffDay(pt1, pt2):
-        t1 = getPtLocaltime(pt1)
-        t2 = getPtLocaltime(pt2)
-        return not (t1.year == t2.year and \
-                    t1.month == t2.month and \
-                    t1.day == t2.day)
+    def trkDayChanges(trk):
+        idxs = []
+        last_date = None
+        for i, t in enumerate(getTrkLocaltimes(trk)):
+            if t is None:
+                continue
+            date = t.date()
+            if last_date is not None and date != last_date:
+                idxs.append(i)
+            last_date = date
+        return idxs
 
     @staticmethod
     def trkTimeGap(pt1, pt2):
@@ -1024,10 +1190,16 @@ class MapBoard(tk.Frame):
         return dist > conf.SPLIT_DIST_GAP
 
     def onSplitTrk(self, split_fn):
+        self.__splitTrk(lambda gpx: gpx.splitTrk(split_fn))
+
+    def onSplitTrkAt(self, idxs_fn):
+        self.__splitTrk(lambda gpx: gpx.splitTrkAt(idxs_fn))
+
+    def __splitTrk(self, split):
         is_alter = False
             
         for gpx in self.__map_ctrl.gpx_layers:
-            if gpx.splitTrk(split_fn):
+            if split(gpx):
                 is_alter = True
 
         if is_alter:
@@ -1049,6 +1221,14 @@ class MapBoard(tk.Frame):
         #wpt_board.show()
         self.__focused_wpt = None
 
+    def __setLoadProgress(self, path, read_bytes, total_bytes):
+        if read_bytes >= total_bytes:
+            self.__setStatus('', 0, is_immediate=True)
+        else:
+            prog = 100 * read_bytes / total_bytes
+            txt = "Loading %s...%.1f%%" % (os.path.basename(path), prog)
+            self.__setStatus(txt, prog, is_immediate=True)
+
     def __setMapProgress(self, rate, is_immediate=False):
         logging.debug("set map progress %f", rate)
         #set status
@@ -1270,7 +1450,11 @@ class MapBoard(tk.Frame):
         logging.debug("tile (%s, %d, %d, %d) is ready" % tile_info)
 
         with self.__map_req_lock:
-            if self.__map_prog.update(tile_info): #need the lock due to access to data members
+            #need the lock due to access to data members
+            is_updated = self.__map_prog.update(tile_info)
+            for prog in self.__strip_progs:
+                is_updated = prog.update(tile_info) or is_updated
+            if is_updated:
                 self.__map_has_update = True
                 logging.debug("has update")
 
@@ -1298,6 +1482,7 @@ class MapBoard(tk.Frame):
             self.__map_req_time = now
             self.__map, self.__map_attr = self.__map_ctrl.getMap(w, h, force, cb=self.__notifyTileReady)  #buffer the image
             self.__map_prog = MapProgressRec(map_area, map_ids, needed_count=self.__map_attr.fail_tiles)
+            self.__strip_progs = []
 
         #set map
         self.__setMap(self.__map)
@@ -1315,19 +1500,24 @@ class MapBoard(tk.Frame):
         pimg = ImageTk.PhotoImage(img)
         self.disp_canvas.image = pimg #keep a ref
         
-        canvas_map = self.disp_canvas.create_image((0,0), image=pimg, anchor='nw')
+        canvas_map = self.disp_canvas.create_image((0,0), image=pimg, anchor='nw', tag='MAP')
         self.disp_canvas.tag_lower(canvas_map)    #ensure the map is the lowest to avoid hiding other canvas objects
-        '''
-        #it seems the view is more smoothly if DISABLED...update...NORMAL
-        #any better idea?
-        self.disp_canvas['state'] = 'disabled'
-        tmp = self.__canvas_map
-        self.__canvas_map = self.disp_canvas.create_image((0,0), image=pimg, anchor='nw')
-        if tmp:
-            self.disp_canvas.tag_lower(tmp)
-            self.disp_canvas.delete(tmp)
-        self.disp_canvas['state'] = 'normal'
-        '''
+
+        #delete the old ones after the new one is shown
+        for item in self.disp_canvas.find_withtag('MAP'):
+            if item != canvas_map:
+                self.disp_canvas.delete(item)
+        self.__map_pimgs = {canvas_map: pimg}
+
+        #the map is rendered at the current geo, so the pending pan and strips are done
+        self.__map_rendered = (0, 0) + img.size
+        self.__pan_dx = self.__pan_dy = 0
+        self.__pan_offset = (0, 0)
+        with self.__strip_cv:
+            self.__strip_gen += 1
+            self.__strip_pending -= len(self.__strip_reqs)
+            self.__strip_reqs = []
+            self.__strip_done = []
 
 class MapAgent:
     #properties from map_desc
@@ -1380,10 +1570,20 @@ class MapAgent:
                not cache_attr.fail_tiles and \
                cache_attr.coversArea(req_attr)
 
+    #prioritize the downloads of the view @view_attr
+    def setViewport(self, view_attr):
+        level = min(max(self.level_min, view_attr.level), self.level_max)
+        extra_p = self.__extra_p * 2**(level - view_attr.level)
+        if view_attr.level != level:
+            view_attr = view_attr.zoomToLevel(level)
+        self.__tile_agent.setViewport(level, *view_attr.boundTiles(extra_p))
+
     # @cb is used to notify some tile is ready.
     # sync cb is handled by genMap, and async cb by getTile
     # which call cb(tile_info), tile_info = (map_id, level, x, y)
-    def genMap(self, req_attr, req_type, cb=None):
+    # @is_part is for the map of a part of the view, e.g. the strip exposed on panning,
+    # which neither focuses the downloads on itself nor replaces the cached map
+    def genMap(self, req_attr, req_type, cb=None, is_part=False):
         if self.__isCacheValid(req_attr):
             return (self.__cache_basemap, self.__cache_attr)
 
@@ -1391,12 +1591,12 @@ class MapAgent:
         level = min(max(self.level_min, req_attr.level), self.level_max)
 
         if req_attr.level == level:
-            tile_map = self.__genTileMap(req_attr, self.__extra_p, req_type, cb)
+            tile_map = self.__genTileMap(req_attr, self.__extra_p, req_type, cb, not is_part)
         else:
             #get approx map
             aprx_attr = req_attr.zoomToLevel(level)
             extra_p = self.__extra_p * 2**(level - req_attr.level)
-            aprx_map, aprx_attr = self.__genTileMap(aprx_attr, extra_p, req_type, cb)
+            aprx_map, aprx_attr = self.__genTileMap(aprx_attr, extra_p, req_type, cb, not is_part)
 
             #zoom to request level
             if aprx_map is not None:
@@ -1405,7 +1605,8 @@ class MapAgent:
                 tile_map = (None, aprx_attr.zoomToLevel(req_attr.level))
 
         #cache
-        self.__cache_basemap, self.__cache_attr = tile_map
+        if not is_part:
+            self.__cache_basemap, self.__cache_attr = tile_map
         return tile_map
 
     def __genZoomMap(self, map, attr, level):
@@ -1440,19 +1641,6 @@ class MapAgent:
             return (t_left <= x <= t_right) and (t_upper <= y <= t_lower)
         return False
 
-    @classmethod
-    def isCompleteColor(cls, img):
-        extrema = img.getextrema()
-        #channels = min(len(extrema), 3)
-        if img.mode == "P":
-            _min, _max = extrema
-            return _min == _max
-        else:
-            for _min, _max in extrema:
-                if _min != _max:
-                    return False
-        return True
-
     def __notifyTileReady(self, level, x, y, cb):
         try:
             if cb is not None:
@@ -1467,47 +1655,104 @@ class MapAgent:
     '''
 
     #could return None map
-    def __genTileMap(self, map_attr, extra_p, req_type, cb=None):
-        async_cb = cb if cb is not None and req_type == "async" else None
-        #if cb is not None and req_type == "async":
-        #    async_cb = lambda level, x, y: self.__tileIsReady(level, x, y, map_attr, cb) 
-
+    def __genTileMap(self, map_attr, extra_p, req_type, cb=None, focus=True):
         #get tile x, y.
         t_left, t_upper, t_right, t_lower = map_attr.boundTiles(extra_p)
         tx_num = t_right - t_left +1
         ty_num = t_lower - t_upper +1
 
+        #prioritize the downloads of the viewport
+        if req_type == "async" and focus:
+            self.__tile_agent.setViewport(map_attr.level, t_left, t_upper, t_right, t_lower)
+
         #gen image
         logging.debug("pasting tile...")
 
-        disp_map = None
-        fail_tiles = 0
-
-        for x in range(tx_num):
-            for y in range(ty_num):
-                tile = self.__tile_agent.getTile(map_attr.level, t_left +x, t_upper +y, req_type, async_cb)
-
-                if tile is None or tile.is_fake:
-                    fail_tiles += 1
+        expired = set()
+        tiles, missing = self.__tile_agent.getTiles(map_attr.level,
+                range(t_left, t_right+1), range(t_upper, t_lower+1), req_type, cb, expired=expired)
 
-                if tile is not None:
-                    if disp_map is None:
-                        disp_map = Image.new("RGBA", to_pixel(tx_num, ty_num), 'lightgray')
-                    disp_map.paste(tile, to_pixel(x, y))
-
-                if req_type == "sync" and cb is not None:
-                    tile_info = (self.map_id, map_attr.level, t_left + x, t_upper +y)
-                    cb(tile_info)
+        disp_map = None
+        fail_tiles = len(missing)
+
+        for (x, y), tile in tiles.items():
+            if disp_map is None:
+                disp_map = Image.new("RGBA", to_pixel(tx_num, ty_num), 'lightgray')
+            px, py = to_pixel(x - t_left, y - t_upper)
+            fill_color = getattr(tile, 'fill_color', None)  #uniform tile
+            if fill_color is not None:
+                disp_map.paste(fill_color, (px, py) + to_pixel(x - t_left + 1, y - t_upper + 1))
+            else:
+                disp_map.paste(tile, (px, py))
 
         logging.debug("pasting tile...done")
 
         #reset map_attr
         pos = to_pixel(t_left, t_upper)
         size = to_pixel(tx_num, ty_num)
-        disp_attr = MapAttr(map_attr.level, pos, size, fail_tiles)
+        disp_attr = MapAttr(map_attr.level, pos, size, fail_tiles, len(expired))
 
         return  (disp_map, disp_attr)
 
+'''
+The LRU cache of the tiles made from map layers, keyed by (level, x, y, layers),
+where layers are the ordered (map_id, alpha) of the maps, e.g. the composited tiles of the enabled maps,
+or the alpha-tuned tiles of a map.
+'''
+class LayerTileCache:
+    @property
+    def stats(self):
+        with self.__lock:
+            return {'items': len(self.__repo),
+                    'bytes': self.__used_bytes,
+                    'max_bytes': self.__max_bytes,
+                    'hits': self.__hits,
+                    'misses': self.__misses}
+
+    def __init__(self, max_bytes):
+        self.__max_bytes = max_bytes
+        self.__used_bytes = 0
+        self.__repo = OrderedDict()  #key -> tile
+        self.__lock = Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    @classmethod
+    def sizeOf(cls, tile):
+        w, h = tile.size
+        return w * h * len(tile.getbands())
+
+    def get(self, key):
+        with self.__lock:
+            tile = self.__repo.get(key)
+            if tile is None:
+                self.__misses += 1
+                return None
+            self.__repo.move_to_end(key)
+            self.__hits += 1
+            return tile
+
+    def put(self, key, tile):
+        if self.__max_bytes <= 0:
+            return
+        with self.__lock:
+            old = self.__repo.pop(key, None)
+            if old is not None:
+                self.__used_bytes -= self.sizeOf(old)
+            self.__repo[key] = tile
+            self.__used_bytes += self.sizeOf(tile)
+            while self.__used_bytes > self.__max_bytes and self.__repo:
+                k, t = self.__repo.popitem(last=False)
+                self.__used_bytes -= self.sizeOf(t)
+
+    #remove the tiles composited with the map
+    def invalidate(self, map_id):
+        with self.__lock:
+            keys = [key for key in self.__repo if any(id == map_id for id, alpha in key[3])]
+            for key in keys:
+                self.__used_bytes -= self.sizeOf(self.__repo.pop(key))
+        logging.debug("invalidate %d composited tiles of map %s" % (len(keys), map_id))
+
 # todo: what is the class's purpose?, suggest to reconsider
 class MapController:
 
@@ -1555,6 +1800,8 @@ class MapController:
         #image
         self.__cache_gpsmap = None
         self.__cache_attr = None
+        self.__composite_cache = LayerTileCache(conf.TILE_COMPOSITE_CACHE_MB * 1024 * 1024)
+        self.__tuned_cache = LayerTileCache(conf.TILE_TUNED_CACHE_MB * 1024 * 1024)
         self.__font = conf.IMG_FONT
         self.__is_hide_text = False
 
@@ -1584,6 +1831,13 @@ class MapController:
         self.__cache_gpsmap = None
         self.__cache_attr = None
 
+    #the map is changed (e.g. enable, alpha), the composited tiles are out of date
+    def invalidateMap(self, map_id):
+        self.__composite_cache.invalidate(map_id)
+        self.__tuned_cache.invalidate(map_id)
+        self.__cache_gpsmap = None
+        self.__cache_attr = None
+
     #Are there any map contains the point?
     def mapContainsPt(self, geo):
         for desc in self.__map_descs:
@@ -1650,7 +1904,14 @@ class MapController:
                 return wpt
         return None
 
-    def getMap(self, width, height, force=None, geo=None, level=None, req_type="async", cb=None):
+    #prioritize the downloads of the view @view_attr, e.g. the view moved by panning
+    def setViewport(self, view_attr):
+        for agent in self.__getMapAgents():
+            agent.setViewport(view_attr)
+
+    # @view is the area of the whole view which the map is a part of, to lay out the coordinate labels; the map itself if None.
+    # The part of the view neither focuses the downloads on itself nor replaces the cached map, see setViewport()
+    def getMap(self, width, height, force=None, geo=None, level=None, req_type="async", cb=None, view=None):
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "gen map: begin")
         if geo is None: geo = self.geo
         if level is None: level = self.level
@@ -1658,12 +1919,12 @@ class MapController:
 
         #The image attributes with which we want to create a image compatible.
         req_attr = MapAttr(level, (px, py), (width, height), 0)
-        map, attr = self.__genGpsMap(req_attr, force, req_type, cb)
+        map, attr = self.__genGpsMap(req_attr, force, req_type, cb, view is not None)
 
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  crop map")
         map = self.__genCropMap(map, attr, req_attr)
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw coord")
-        self.__drawCoordValue(map, req_attr)
+        self.__drawCoordValue(map, req_attr, view)
 
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "gen map: done")
         req_attr.fail_tiles = attr.fail_tiles
@@ -1684,43 +1945,6 @@ class MapController:
                 (p[2]*beta + q[2]*alpha) >> 8,
                 255)
 
-    @classmethod
-    #tune alpha channel by @alpha, which between 0.0~1.0
-    def tunealpha(cls, img, alpha):
-        logging.debug("prepare to tune alpha...")
-        if img.mode != "RGBA":
-            logging.warning("not support mode '%s' to tune alpha" % (img.mode,))
-            return
-
-        alpha = int(alpha*256)
-
-        #optimize
-        min_a, max_a = img.getextrema()[3];
-        if alpha == 256 or max_a == 0:
-            return img
-        if alpha == 0 or min_a == 255:
-            img.putalpha(alpha)
-            return img
-
-        logging.debug("start to tune alpha...")
-
-        bands = img.split()
-
-        #tune alpha channel
-        #todo: for improve, may use numpy module
-        data = bands[3].load()
-        w, h = img.size
-        for x in range(w):
-            for y in range(h):
-                p = data[x,y]
-                if p:
-                    data[x,y] = (p * alpha) >> 8
-
-        result = Image.merge("RGBA", bands)
-
-        logging.debug("end to tune alpha...")
-        return result
-
     def __getMapAgents(self):
         agents = []
         for desc in self.__map_descs:
@@ -1742,14 +1966,14 @@ class MapController:
 
         return agents
 
-    def __runReqMap(self, repo, repo_lock, agent, req_attr, req_type, cb):
+    def __runReqMap(self, repo, repo_lock, agent, req_attr, req_type, cb, is_part):
         logging.debug('generating map: %s', (agent.map_id,))
-        res = agent.genMap(req_attr, req_type, cb)
+        res = agent.genMap(req_attr, req_type, cb, is_part)
         logging.debug('generated map: %s', (agent.map_id,))
         with repo_lock:
             repo[agent] = res
 
-    def __getMaps(self, req_attr, req_type, cb=None):
+    def __getMaps(self, req_attr, req_type, cb=None, is_part=False):
         agents = self.__getMapAgents()
 
         if not agents:
@@ -1760,8 +1984,8 @@ class MapController:
         # sync to get maps
         if len(agents) == 1 or req_type == 'sync':
             for agent in agents:
-                map, attr = agent.genMap(req_attr, req_type, cb)
-                maps.append((map, attr, agent.alpha))
+                map, attr = agent.genMap(req_attr, req_type, cb, is_part)
+                maps.append((map, attr, agent.alpha, agent.map_id))
         # Async to get maps
         else:
             map_repo = {}
@@ -1770,7 +1994,7 @@ class MapController:
 
             #create req map workers
             for agent in agents:
-                job = lambda: self.__runReqMap(map_repo, map_repo_lock, agent, req_attr, req_type, cb)
+                job = lambda: self.__runReqMap(map_repo, map_repo_lock, agent, req_attr, req_type, cb, is_part)
                 worker = Thread(target=job)
                 worker.start()
                 map_workers.append(worker)
@@ -1783,7 +2007,7 @@ class MapController:
             idx = 0
             for agent in agents:
                 map, attr = map_repo[agent]
-                maps.append((map, attr, agent.alpha))
+                maps.append((map, attr, agent.alpha, agent.map_id))
                 logging.debug('get map[%d] %-20s, size: %s, attr: %s' % (idx, agent.map_id, "None" if map is None else str(map.size), str(attr)))
                 idx += 1
 
@@ -1799,21 +2023,59 @@ class MapController:
                 logging.warning("[NeedCropMap] map[%d]: %s" % (i, str(attrs[i])))
                 logging.warning("[NeedCropMap]      -> %s" % (str(baseattr)))
 
-    #alpha between 0.0~1.0
+    #the tile-aligned maps, which need to composite, can use the composite cache
     @classmethod
-    def combineMap(cls, basemap, map, alpha):
-        if imageIsTransparent(map):
-            if alpha != 1.0:
-                map = cls.tunealpha(map, alpha)
-            return Image.alpha_composite(basemap, map)
-        else:
-            if alpha != 1.0:
-                return Image.blend(basemap, map, alpha)
-            return map
-
-    def __genBaseMap(self, req_attr, req_type, cb=None):
+    def __canCompositeByTiles(cls, maps, baseattr):
+        side = to_pixel(1, 1)[0]
+        if len(maps) == 1:
+            map, attr, alpha, map_id = maps[0]
+            if alpha == 1.0 and (map is None or not imageIsTransparent(map)):
+                return False  #nothing to composite
+        areas = [baseattr] + [attr for map, attr, alpha, map_id in maps]
+        return all(a.x % side == 0 and a.y % side == 0 for a in areas) and \
+               baseattr.width % side == 0 and baseattr.height % side == 0
+
+    def __tuneLayerTile(self, tile, alpha, key, is_cacheable):
+        tuned = self.__tuned_cache.get(key)
+        if tuned is None:
+            tuned = tuneAlpha(tile, alpha)
+            if is_cacheable:
+                self.__tuned_cache.put(key, tuned)
+        return tuned
+
+    def __genCompositeMap(self, maps, baseattr):
+        side = to_pixel(1, 1)[0]
+        layers = tuple((map_id, alpha) for map, attr, alpha, map_id in maps)
+        #only cache the tiles composited from all real and up-to-date tiles,
+        #since nothing evicts them when the missing or expired tiles arrive
+        is_cacheable = all(attr.isComplete() for map, attr, alpha, map_id in maps)
 
-        maps = self.__getMaps(req_attr, req_type, cb)
+        basemap = Image.new("RGBA", baseattr.size, "white")
+        for tx in range(baseattr.x // side, (baseattr.x + baseattr.width) // side):
+            for ty in range(baseattr.y // side, (baseattr.y + baseattr.height) // side):
+                key = (baseattr.level, tx, ty, layers)
+                tile = self.__composite_cache.get(key)
+                if tile is None:
+                    tile = Image.new("RGBA", (side, side), "white")
+                    for map, attr, alpha, map_id in reversed(maps):
+                        if map is None:
+                            continue
+                        px, py = tx * side - attr.x, ty * side - attr.y
+                        layer = map.crop((px, py, px + side, py + side))
+                        if alpha != 1.0 and imageIsTransparent(layer):
+                            layer = self.__tuneLayerTile(layer, alpha, (baseattr.level, tx, ty, ((map_id, alpha),)),
+                                    attr.isComplete())
+                            tile = Image.alpha_composite(tile, layer)
+                        else:
+                            tile = combineImage(tile, layer, alpha)
+                    if is_cacheable:
+                        self.__composite_cache.put(key, tile)
+                basemap.paste(tile, (tx * side - baseattr.x, ty * side - baseattr.y))
+        return basemap
+
+    def __genBaseMap(self, req_attr, req_type, cb=None, is_part=False):
+
+        maps = self.__getMaps(req_attr, req_type, cb, is_part)
 
         #create attr
         baseattr = None
@@ -1821,7 +2083,7 @@ class MapController:
             baseattr = req_attr.clone() 
             baseattr.fail_tiles = 0
         else:
-            attrs = [attr for map, attr, alpha in maps]
+            attrs = [attr for map, attr, alpha, map_id in maps]
             area = TileArea.intersetOverlap(attrs)
             fail_tiles = sum([attr.fail_tiles for attr in attrs])
             baseattr = MapAttr.toMapAttr(area, fail_tiles)
@@ -1829,32 +2091,37 @@ class MapController:
             self.__checkAttrs(attrs, baseattr)
 
         #create basemap
+        if maps and self.__canCompositeByTiles(maps, baseattr):
+            return self.__genCompositeMap(maps, baseattr), baseattr
+
         basemap = Image.new("RGBA", baseattr.size, "white")
         if maps:
-            for map, attr, alpha in reversed(maps):
+            for map, attr, alpha, map_id in reversed(maps):
                 if map is None:
                     continue
                 cropmap = self.__genCropMap(map, attr, baseattr)
-                basemap = self.combineMap(basemap, cropmap, alpha)
+                basemap = combineImage(basemap, cropmap, alpha)
 
         return basemap, baseattr
 
-    def __genGpsMap(self, req_attr, force=None, req_type="async", cb=None):
+    def __genGpsMap(self, req_attr, force=None, req_type="async", cb=None, is_part=False):
         if force not in ('all', 'gps', 'trk', 'wpt') and self.__isCacheValid(self.__cache_gpsmap, req_attr):
             #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  get gps map from cache")
             return (self.__cache_gpsmap, self.__cache_attr)
 
-        basemap, attr = self.__genBaseMap(req_attr, req_type, cb)
+        basemap, attr = self.__genBaseMap(req_attr, req_type, cb, is_part)
 
-        #create gpsmap, also cache
-        self.__cache_gpsmap = basemap.copy()
-        self.__cache_attr = attr
+        #create gpsmap, also cache if it is the whole view
+        gpsmap = basemap.copy()
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw trk")
-        self.__drawTrk(self.__cache_gpsmap, attr)
+        self.__drawTrk(gpsmap, attr)
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "  draw wpt")
-        self.__drawWpt(self.__cache_gpsmap, attr)
+        self.__drawWpt(gpsmap, attr)
 
-        return self.__cache_gpsmap, self.__cache_attr
+        if not is_part:
+            self.__cache_gpsmap = gpsmap
+            self.__cache_attr = attr
+        return gpsmap, attr
 
     def __drawTrk(self, map, map_attr):
         #print(datetime.strftime(datetime.now(), '%H:%M:%S.%f'), "draw gpx...")
@@ -1896,30 +2163,48 @@ class MapController:
                 _draw.ellipse((px-r, py-r, px+r, py+r), fill=color, outline=bg_color)
             else:
                 #print('draw trk seg')
-                xy = []
-                for pt in pts:
-                    (px, py) = pt.pixel(map_attr.level)
-                    xy.append(px - map_attr.left_px)
-                    xy.append(py - map_attr.up_py)
+                if isinstance(pts, (Track, ColumnarTrack)):  #the pixels are cached, and simplified, by the track
+                    #only the runs of the segments in the image
+                    runs = pts.getPixels().getImageRuns(map_attr.level, self.__getTrkRect(map_attr, bg_width),
+                            map_attr.left_px, map_attr.up_py, conf.TRK_SIMPLIFY_PX)
+                else:
+                    xy = []
+                    for pt in pts:
+                        (px, py) = pt.pixel(map_attr.level)
+                        xy.append(px - map_attr.left_px)
+                        xy.append(py - map_attr.up_py)
+                    runs = [xy]
 
                 if bg_color is not None:
-                    _draw.line(xy, fill=bg_color, width=width+4)
+                    for xy in runs:
+                        _draw.line(xy, fill=bg_color, width=width+4)
 
-                _draw.line(xy, fill=color, width=width)
+                for xy in runs:
+                    _draw.line(xy, fill=color, width=width)
         finally:
             if draw is None:
                 del _draw
 
 
+    # the rect (left, top, right, bottom) of the image, extended by @margin for the width of the line
+    @staticmethod
+    def __getTrkRect(map_attr, margin):
+        return (map_attr.left_px - margin, map_attr.up_py - margin, map_attr.right_px + margin, map_attr.low_py + margin)
+
     def isTrackInImage(self, trk, map_attr):
-        """Currently disabled, 'cause the algo will be broken if two pt across the image"""
-        return True
-        #if some track point is in disp
-        # for pt in trk:
-        #     (px, py) = pt.pixel(map_attr.level)
-        #     if map_attr.coversPoint(px, py):
-        #         return True
-        # return False
+        """by the bounds of the track, then by its segments, since two pt may be across the image"""
+        bounds = trk.bounds
+        if bounds is None:
+            return False
+
+        minlat, maxlat, minlon, maxlon = bounds
+        left, top, right, bottom = self.__getTrkRect(map_attr, conf.TRK_WIDTH + 4 + 1)  #1 for rounding
+        (min_px, min_py) = coord.TileSystem.getPixcelXYByLatLon(maxlat, minlon, map_attr.level)
+        (max_px, max_py) = coord.TileSystem.getPixcelXYByLatLon(minlat, maxlon, map_attr.level)
+        if max_px < left or min_px > right or max_py < top or min_py > bottom:
+            return False
+
+        return trk.getPixels().intersects(map_attr.level, (left, top, right, bottom), conf.TRK_SIMPLIFY_PX)
 
     def __drawWpt(self, map, map_attr):
         """draw pic as waypoint"""
@@ -2022,7 +2307,7 @@ class MapController:
             raise ValueError("Unknown coord system '%s'" % (coord,))
         return geo.pixel(level)
 
-    def __drawCoordValue(self, map, attr):
+    def __drawCoordValue(self, map, attr, view=None):
 
         if attr.level <= 12:  #too crowded to show
             return
@@ -2048,8 +2333,16 @@ class MapController:
         # init GeoInfo
         geo_info = GeoInfo(self.geo, self.level, coord_sys)
 
-        # xy to draw
-        lines, texts, line5, line10, text10 = self.__getCoordValueXY(attr, geo_info, coord_density)
+        # xy to draw, laid out in the view and moved to the map
+        if view is None:
+            view = attr
+        lines, texts, line5, line10, text10 = self.__getCoordValueXY(view, geo_info, coord_density)
+        dx, dy = view.left_px - attr.left_px, view.up_py - attr.up_py
+        if dx or dy:
+            def moveLine(xy): return (xy[0] + dx, xy[1] + dy, xy[2] + dx, xy[3] + dy)
+            def moveText(xy_text): return ((xy_text[0][0] + dx, xy_text[0][1] + dy), xy_text[1])
+            lines, line5, line10 = [[moveLine(xy) for xy in xys] for xys in (lines, line5, line10)]
+            texts, text10 = [[moveText(xy_text) for xy_text in xys] for xys in (texts, text10)]
 
         #to draw acoording to data
         with DrawGuard(map) as draw:
@@ -2091,15 +2384,15 @@ class MapController:
         def getPy(px, py): return py
         def toVer(px): return (px, 0, px, height)
         def toHor(py): return (0, py, width, py)
-        def getBasePixelOfX(x): return geo_info.getPixelByCoord(x*scale, low_y)
-        def getBasePixelOfY(y): return geo_info.getPixelByCoord(left_x, y*scale)
+        def getBasePixelsOfX(xs): return geo_info.getPixelsByCoords([x*scale for x in xs], [low_y] * len(xs))
+        def getBasePixelsOfY(ys): return geo_info.getPixelsByCoords([left_x] * len(ys), [y*scale for y in ys])
 
         # the logic to collect xy position of line/text.
         # (the function prevents from looping x and y, respectively.)
         def getCoordData(begin_pos, end_pos, base_fun, line_fun, pxl_fun):
-            for pos in range(ceil(begin_pos/scale), floor(end_pos/scale) +1):
+            positions = range(ceil(begin_pos/scale), floor(end_pos/scale) +1)
+            for pos, (px, py) in zip(positions, base_fun(positions)):  #convert the positions in one batch
                 #print("tm: ", x)
-                px, py = base_fun(pos)
                 px -= attr.left_px
                 py -= attr.up_py
                 p = pxl_fun(px, py) # selecting px or py by pxl_fun
@@ -2118,8 +2411,8 @@ class MapController:
                         texts.append( (toTxtXY(px,py), str(pos%10)) )
 
         # get data
-        getCoordData(left_x, right_x, getBasePixelOfX, toVer, getPx)
-        getCoordData(low_y, up_y, getBasePixelOfY, toHor, getPy)
+        getCoordData(left_x, right_x, getBasePixelsOfX, toVer, getPx)
+        getCoordData(low_y, up_y, getBasePixelsOfY, toHor, getPy)
 
         return lines, texts, line5, line10, text10
 
@@ -2313,26 +2606,35 @@ class MapAttr(TileArea):
     @fail_tiles.setter
     def fail_tiles(self, v): self._fail_tiles = v
 
-    def __init__(self, level, pos, size, fail_tiles=0):
+    @property
+    def expired_tiles(self): return self._expired_tiles
+
+    def __init__(self, level, pos, size, fail_tiles=0, expired_tiles=0):
         super().__init__(level, pos, size)
         self._fail_tiles = fail_tiles
+        self._expired_tiles = expired_tiles  #the tiles shown but out of date, until refreshed
 
     def __str__(self):
-        return "MapAttr{level=%d, pos=%s, size=%s, fail_tiles=%d}" % (self.level, str(self.pos), str(self.size), self.fail_tiles)
+        return "MapAttr{level=%d, pos=%s, size=%s, fail_tiles=%d, expired_tiles=%d}" % \
+                (self.level, str(self.pos), str(self.size), self.fail_tiles, self.expired_tiles)
 
     def clone(self):
-        return MapAttr(self.level, self.pos, self.size, self.fail_tiles)
+        return MapAttr(self.level, self.pos, self.size, self.fail_tiles, self.expired_tiles)
+
+    #all the tiles are real and up to date
+    def isComplete(self):
+        return self.fail_tiles == 0 and self.expired_tiles == 0
 
     def toTileArea(self):
         return TileArea(self.level, self.pos, self.size)
 
     def zoomToLevel(self, level):
         area = super().zoomToLevel(level)
-        return self.toMapAttr(area, self.fail_tiles)
+        return self.toMapAttr(area, self.fail_tiles, self.expired_tiles)
 
     @classmethod
-    def toMapAttr(cls, area, fail_tiles=0):
-        return MapAttr(area.level, area.pos, area.size, fail_tiles)
+    def toMapAttr(cls, area, fail_tiles=0, expired_tiles=0):
+        return MapAttr(area.level, area.pos, area.size, fail_tiles, expired_tiles)
 
 
 class WptBoard(tk.Toplevel):
@@ -2987,9 +3289,11 @@ class TrkSingleBoard(tk.Toplevel):
         self.pt_list.delete(0, 'end')
         self.pt_list.data = trk
         if trk:
-            tz = getPtTimezone(trk[0])  #optimize, prevent calculation for each pt 
-            for sn, pt in enumerate(trk, 1):
-                txt = "#%04d  %s: %s, %s" % ( sn, getPtTimeText(pt, tz), getPtPosText(pt), getPtEleText(pt))
+            pts = list(trk)
+            tzs = getPtTimezones(pts)  #resolved once per area, rather than per pt
+            pos_txts = getPtPosTexts(pts)
+            for sn, (pt, tz, pos_txt) in enumerate(zip(pts, tzs, pos_txts), 1):
+                txt = "#%04d  %s: %s, %s" % ( sn, getPtTimeText(pt, tz), pos_txt, getPtEleText(pt))
                 self.pt_list.insert('end', txt)
 
 
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+''' benchmark the scalar and the batch coordinate conversions '''
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src import coord
+from src.coord import TileSystem, CoordinateSystem
+
+def bench(name, n, fn):
+    t = time.time()
+    fn()
+    secs = time.time() - t
+    print("%-28s %.3f sec  %.3f us/pt" % (name, secs, secs * 1e6 / n))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the coordinate conversions')
+    parser.add_argument("-n", "--points", help="the points to convert (default: 1000000)", type=int, default=1000000)
+    args = parser.parse_args()
+
+    n = args.points
+    lats = [random.uniform(21.5, 25.5) for i in range(n)]
+    lons = [random.uniform(119.0, 122.5) for i in range(n)]
+    xs, ys = CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch(lats, lons)
+    xs, ys = list(xs), list(ys)
+
+    print("numpy: %s" % ("yes" if coord.np is not None else "no",))
+    bench("scalar latlon -> tm2", n, lambda: [CoordinateSystem.TWD97_LatLonToTWD97_TM2(lat, lon) for lat, lon in zip(lats, lons)])
+    bench("batch  latlon -> tm2", n, lambda: CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch(lats, lons))
+    bench("scalar tm2 -> latlon", n, lambda: [CoordinateSystem.TWD97_TM2ToTWD97_LatLon(x, y) for x, y in zip(xs, ys)])
+    bench("batch  tm2 -> latlon", n, lambda: CoordinateSystem.TWD97_TM2ToTWD97_LatLonBatch(xs, ys))
+    bench("scalar latlon -> pixel", n, lambda: [TileSystem.getPixcelXYByLatLon(lat, lon, 23) for lat, lon in zip(lats, lons)])
+    bench("batch  latlon -> pixel", n, lambda: TileSystem.getPixcelXYByLatLonBatch(lats, lons, 23))
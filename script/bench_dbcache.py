@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+''' benchmark the per-tile read cost of the local cache DB (.mbtiles) '''
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.tile import MapDescriptor, DBDiskCache
+
+MAP_XML = """<customMapSource>
+    <name>bench</name>
+    <minZoom>0</minZoom>
+    <maxZoom>18</maxZoom>
+    <tileType>png</tileType>
+    <url>http://localhost/{$z}/{$x}/{$y}.png</url>
+</customMapSource>"""
+
+LEVEL = 16
+X0, Y0 = 54869, 28139
+
+#the read path before using the bound parameters: format the sql, and log every tile
+def legacyGet(conn, level, x, y):
+    y = (1 << level) - 1 - y  #tms
+    sql = "SELECT %s FROM tiles WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d" % \
+            ("tile_data, timestamp", level, x, y,)
+    row = conn.execute(sql).fetchone()
+    if row is None:
+        logging.info("[%s] %s [NA]" % ('bench', sql))
+        return (None, None)
+    logging.info("[%s] %s [OK][TS]" % ('bench', sql))
+    return row
+
+def bench(name, get, coords, rounds):
+    t = time.perf_counter()
+    for i in range(rounds):
+        for x, y in coords:
+            get(LEVEL, x, y)
+    secs = time.perf_counter() - t
+    n = rounds * len(coords)
+    print("%-10s %8d reads  %8.2f us/tile" % (name, n, secs / n * 1e6))
+    return secs / n
+
+def init_arguments():
+    parser = argparse.ArgumentParser(description='benchmark the tile reads of DBDiskCache')
+    parser.add_argument("-n", "--side", type=int, default=16, help="the side of the tile rectangle")
+    parser.add_argument("-r", "--rounds", type=int, default=20, help="the rounds to read all the tiles")
+    parser.add_argument("-v", "--verbose", action="store_true", help="enable info logging, to a null stream")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = init_arguments()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+            stream=open(os.devnull, 'w'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        desc = MapDescriptor.parseXml(xmlstr=MAP_XML, id="bench")
+        coords = [(X0 + i, Y0 + j) for i in range(args.side) for j in range(args.side)]
+        data = os.urandom(20000)
+
+        #prepare tiles, and half of the reads are missing
+        cache = DBDiskCache(tmp_dir, desc, 'tms', is_concurrency=False)
+        cache.start()
+        for x, y in coords[::2]:
+            cache.put(LEVEL, x, y, data)
+        cache.close()
+
+        conn = sqlite3.connect(os.path.join(tmp_dir, "bench.mbtiles"))
+        before = bench("before", lambda level, x, y: legacyGet(conn, level, x, y), coords, args.rounds)
+        conn.close()
+
+        cache = DBDiskCache(tmp_dir, desc, 'tms')
+        cache.start()
+        after = bench("after", cache.get, coords, args.rounds)
+
+        t = time.perf_counter()
+        for i in range(args.rounds):
+            cache.getMany(LEVEL, range(X0, X0 + args.side), range(Y0, Y0 + args.side))
+        secs = time.perf_counter() - t
+        print("%-10s %8d reads  %8.2f us/tile" % ("getMany", args.rounds * len(coords), secs / (args.rounds * len(coords)) * 1e6))
+        cache.close()
+
+        print("speedup of get(): %.2fx" % (before / after,))
+    finally:
+        shutil.rmtree(tmp_dir)
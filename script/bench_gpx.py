@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+''' benchmark the time and the peak memory to load a huge gpx file '''
+
+import os
+import sys
+import time
+import pytz
+import random
+import resource
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import src.conf as conf
+from src.gpx import GpsDocument, TrackPoint
+
+NS = {'gpx': "http://www.topografix.com/GPX/1/1"}
+
+def genGpx(path, points, tracks):
+    t = datetime(2016, 1, 1, tzinfo=pytz.utc)
+    lat, lon = 24.0, 121.0
+    per_trk = points // tracks
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="bench">\n')
+        for i in range(tracks):
+            f.write('<trk><name>trk-%d</name><trkseg>\n' % (i,))
+            for j in range(per_trk):
+                lat += random.uniform(-0.0001, 0.0001)
+                lon += random.uniform(-0.0001, 0.0001)
+                t += timedelta(seconds=1)
+                f.write('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time></trkpt>\n' %
+                        (lat, lon, random.uniform(0, 3000), t.strftime("%Y-%m-%dT%H:%M:%SZ")))
+            f.write('</trkseg></trk>\n')
+        f.write('</gpx>\n')
+
+#the loading before streaming: parse the whole tree, find the child elements, and strptime
+def legacyLoad(path):
+    def toUTCTime(txt):
+        fmt = "%Y-%m-%dT%H:%M:%S.%fZ" if "." in txt else "%Y-%m-%dT%H:%M:%SZ"
+        return datetime.strptime(txt, fmt).replace(tzinfo=pytz.utc)
+
+    trks = []
+    root = ET.parse(path).getroot()
+    for trk_elem in root.findall("./gpx:trk", NS):
+        trk = []
+        for seg_elem in trk_elem.findall("./gpx:trkseg", NS):
+            for pt_elem in seg_elem.findall("./gpx:trkpt", NS):
+                pt = TrackPoint(float(pt_elem.attrib["lat"]), float(pt_elem.attrib["lon"]))
+                elem = pt_elem.find("./gpx:ele", NS)
+                pt.ele = None if elem is None else float(elem.text)
+                elem = pt_elem.find("./gpx:time", NS)
+                pt.time = None if elem is None else toUTCTime(elem.text)
+                trk.append(pt)
+        trks.append(trk)
+    return sum(len(trk) for trk in trks)
+
+def streamLoad(path, storage):
+    conf.TRK_STORAGE = storage
+    doc = GpsDocument()
+    doc.load(filename=path)
+    return sum(len(trk) for trk in doc.tracks)
+
+#run in this process, to measure the peak memory alone
+def run(method, path):
+    t = time.time()
+    points = legacyLoad(path) if method == "legacy" else streamLoad(path, method)
+    secs = time.time() - t
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  #KB on linux
+    print("%-8s %d points  %.1f sec  %.2f us/pt  peak %.0f MB" % (method, points, secs, secs * 1e6 / points, peak_mb))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark GpsDocument.load')
+    parser.add_argument("-n", "--points", help="the points to generate (default: 5000000)", type=int, default=5000000)
+    parser.add_argument("-t", "--tracks", help="the tracks to generate (default: 10)", type=int, default=10)
+    parser.add_argument("--skip-legacy", help="not to run the legacy loading, which may take GBs", action="store_true")
+    parser.add_argument("--run", help=argparse.SUPPRESS, nargs=2, metavar=('METHOD', 'PATH'))
+    args = parser.parse_args()
+
+    if args.run:
+        run(*args.run)
+        sys.exit(0)
+
+    fd, path = tempfile.mkstemp(suffix=".gpx")
+    os.close(fd)
+    try:
+        genGpx(path, args.points, args.tracks)
+        print("gpx: %d points, %.1f MB" % (args.points, os.path.getsize(path) / (1 << 20)))
+        methods = ("list", "columnar") if args.skip_legacy else ("legacy", "list", "columnar")
+        for method in methods:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--run", method, path], check=True)
+    finally:
+        os.remove(path)
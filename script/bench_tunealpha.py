@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+''' benchmark tuning the alpha channel of a semi-transparent overlay, e.g. OpenSeaMap '''
+
+import os
+import sys
+import time
+import argparse
+from PIL import Image, ImageChops
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.util import tuneAlpha
+
+#the per-pixel loop before using the lookup table
+def legacyTunealpha(img, alpha):
+    alpha = int(alpha*256)
+    bands = img.split()
+    data = bands[3].load()
+    w, h = img.size
+    for x in range(w):
+        for y in range(h):
+            p = data[x,y]
+            if p:
+                data[x,y] = (p * alpha) >> 8
+    return Image.merge("RGBA", bands)
+
+def genOverlay(w, h):
+    img = Image.effect_noise((w, h), 64).convert("RGBA")
+    #mostly transparent with some opaque marks, like a sea chart overlay
+    img.putalpha(Image.effect_noise((w, h), 100).point(lambda v: 0 if v < 160 else v))
+    return img
+
+def bench(name, func, img, alpha, rounds):
+    t = time.perf_counter()
+    for i in range(rounds):
+        result = func(img, alpha)
+    secs = (time.perf_counter() - t) / rounds
+    print("%-8s %10.2f ms" % (name, secs * 1000))
+    return result, secs
+
+def init_arguments():
+    parser = argparse.ArgumentParser(description='benchmark tuneAlpha')
+    parser.add_argument("-W", "--width", type=int, default=2000)
+    parser.add_argument("-H", "--height", type=int, default=1500)
+    parser.add_argument("-a", "--alpha", type=float, default=0.6)
+    parser.add_argument("-r", "--rounds", type=int, default=10, help="the rounds of the new one")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = init_arguments()
+    img = genOverlay(args.width, args.height)
+    print("tune alpha %.2f of %dx%d RGBA" % (args.alpha, args.width, args.height))
+
+    before, before_secs = bench("before", legacyTunealpha, img, args.alpha, 1)
+    after, after_secs = bench("after", tuneAlpha, img, args.alpha, args.rounds)
+
+    assert ImageChops.difference(before, after).getbbox() is None, "the results are different"
+    print("speedup: %.0fx" % (before_secs / after_secs,))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+''' import the loose tile files into the local cache DB (.mbtiles), or export the DB to the tile files '''
+
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import src.conf as conf
+from src.tile import MapDescriptor, DBDiskCache, FileDiskCache
+from src.util import getUniformColorOfData
+
+#the tile file names:
+#   {level}-{x}-{y}.ext, the layout of FileDiskCache
+#   {level}/{x}-{y}.ext
+#   {level}/{x}/{y}.ext
+TILE_NAME_RE = re.compile(r'^(\d+)-(\d+)-(\d+)\.\w+$')
+TILE_XY_NAME_RE = re.compile(r'^(\d+)-(\d+)\.\w+$')
+TILE_Y_NAME_RE = re.compile(r'^(\d+)\.\w+$')
+
+# return (level, x, y), or None if not a tile file
+def parseTilePath(dirpath, filename):
+    m = TILE_NAME_RE.match(filename)
+    if m:
+        return tuple(int(v) for v in m.groups())
+
+    parent = os.path.basename(dirpath)
+    m = TILE_XY_NAME_RE.match(filename)
+    if m and parent.isdigit():
+        return (int(parent), int(m.group(1)), int(m.group(2)))
+
+    grandparent = os.path.basename(os.path.dirname(dirpath))
+    m = TILE_Y_NAME_RE.match(filename)
+    if m and parent.isdigit() and grandparent.isdigit():
+        return (int(grandparent), int(parent), int(m.group(1)))
+
+    return None
+
+'''
+Report the progress of the tiles periodically.
+'''
+class Progress:
+    REPORT_PERIOD = 5  #sec
+
+    def __init__(self, action):
+        self.__action = action
+        self.__tiles = 0
+        self.__bytes = 0
+        self.__start_ts = time.time()
+        self.__report_ts = self.__start_ts
+
+    def add(self, tiles, nbytes):
+        self.__tiles += tiles
+        self.__bytes += nbytes
+        if time.time() - self.__report_ts >= self.REPORT_PERIOD:
+            self.report()
+
+    def report(self):
+        self.__report_ts = time.time()
+        secs = self.__report_ts - self.__start_ts
+        print("%s %d tiles (%.1f MB) in %.1f sec, %.1f tiles/s" % (self.__action, self.__tiles,
+                self.__bytes / (1 << 20), secs, self.__tiles / secs if secs else 0.0), flush=True)
+
+def genTileFiles(src_dir):
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for f in sorted(filenames):
+            tile = parseTilePath(dirpath, f)
+            if tile is None:
+                logging.info("skip the file not a tile: %s" % (os.path.join(dirpath, f),))
+                continue
+            yield tile + (os.path.join(dirpath, f),)
+
+# return (level, x, y, data, timestamp, color), timestamp is the file mtime
+def readTileFile(tile_file):
+    level, x, y, path = tile_file
+    with open(path, 'rb') as f:
+        data = f.read()
+    return (level, x, y, data, int(os.path.getmtime(path)), getUniformColorOfData(data))
+
+# generate the batches of the items, each one is a list of @size items at most
+def genBatches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def importTiles(desc, src_dir, db_dir, workers, batch_size):
+    db = DBDiskCache(db_dir, desc, conf.DB_SCHEMA, is_concurrency=False)
+    db.start()
+    progress = Progress("import")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            #read (and detect the uniform tiles of) the next batch of files in parallel,
+            #while writing the current batch in one transaction
+            pending = None
+            for batch in genBatches(genTileFiles(src_dir), batch_size):
+                reading = [executor.submit(readTileFile, tile_file) for tile_file in batch]
+                if pending is not None:
+                    items = [future.result() for future in pending]
+                    db.putMany(items)
+                    progress.add(len(items), sum(len(item[3]) for item in items))
+                pending = reading
+            if pending is not None:
+                items = [future.result() for future in pending]
+                db.putMany(items)
+                progress.add(len(items), sum(len(item[3]) for item in items))
+    finally:
+        db.close()
+    progress.report()
+
+def exportTiles(desc, db_dir, dst_dir, workers, batch_size):
+    db = DBDiskCache(db_dir, desc, conf.DB_SCHEMA, is_concurrency=False)
+    files = FileDiskCache(dst_dir, desc)
+    db.start()
+    files.start()
+    progress = Progress("export")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in genBatches(db.iterTiles(), batch_size):
+                futures = []
+                for level, x, y, data, ts in batch:
+                    futures.append(executor.submit(files.put, level, x, y, data, ts=ts))
+                for future in futures:
+                    future.result()
+                progress.add(len(batch), sum(len(item[3]) for item in batch))
+    finally:
+        files.close()
+        db.close()
+    progress.report()
+
+def getMapDescriptor(args):
+    if args.xml:
+        return MapDescriptor.parseXml(args.xml)
+    return MapDescriptor.parseXml(os.path.join(conf.MAPCACHE_DIR, args.map + ".xml"))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import the tile files of a map into the local cache DB,'
+            ' or export the DB to the tile files')
+    parser.add_argument("-v", "--verbose", help="show detail information", action="count", default=0)
+    parser.add_argument("-c", "--conf", help="load the config file in specific folder", default="")
+    parser.add_argument("-x", "--xml", help="the map descriptor file, instead of the map id")
+    parser.add_argument("-d", "--cache-dir", help="the folder of the cache DB (default: the map cache folder)")
+    parser.add_argument("-w", "--workers", help="the number of threads to read/write files (default: 8)",
+            type=int, default=8)
+    parser.add_argument("-n", "--batch-size", help="the tiles written in one transaction (default: 5000)",
+            type=int, default=5000)
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("dir", help="import: the folder of tile files, named as '{level}-{x}-{y}.ext',"
+            " '{level}/{x}-{y}.ext', or '{level}/{x}/{y}.ext';"
+            " export: the folder to write '{map_id}/{x}/{level}-{x}-{y}.jpg'")
+    parser.add_argument("map", nargs='?', help="the map id in the map cache folder")
+    args = parser.parse_args()
+
+    if args.conf:
+        conf.change_conf_dir(args.conf)
+
+    log_level = logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING
+    logging.basicConfig(level=log_level,
+            format="%(asctime)s.%(msecs)03d [%(levelname)s] [%(module)s] %(message)s", datefmt="%H:%M:%S")
+
+    if not args.map and not args.xml:
+        parser.error("the map id or the map descriptor file is required")
+
+    desc = getMapDescriptor(args)
+    db_dir = args.cache_dir or conf.MAPCACHE_DIR
+    if args.action == "import":
+        importTiles(desc, args.dir, db_dir, args.workers, args.batch_size)
+    else:
+        exportTiles(desc, db_dir, args.dir, args.workers, args.batch_size)
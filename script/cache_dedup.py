@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+''' migrate the local cache DBs (.mbtiles) to the deduplicated schema, or prune the unused tile data of them '''
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.tile import DBDiskCache
+
+def hasColumn(conn, tbl_name, col_name):
+    return any(row[1] == col_name for row in conn.execute("PRAGMA table_info(%s)" % (tbl_name,)))
+
+def fileSize(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+# remove the images not referenced by the map, return the number of the removed
+def prune(conn):
+    with conn:
+        cursor = conn.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+    return cursor.rowcount
+
+# copy the tiles to the new db of the dedup schema, and replace the old one
+def dedup(path, batch_size, keep_backup):
+    tmp_path = path + ".dedup"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    src = sqlite3.connect(path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        dst.execute("PRAGMA synchronous=OFF")  #the tmp db is dropped if failed
+        dst.execute("PRAGMA journal_mode=OFF")
+
+        #metadata
+        dst.execute("CREATE TABLE metadata(name TEXT PRIMARY KEY, value TEXT)")
+        dst.executemany("INSERT INTO metadata(name, value) VALUES(?, ?)",
+                src.execute("SELECT name, value FROM metadata"))
+        for sql in DBDiskCache.DEDUP_TABLES_SQLS:
+            dst.execute(sql)
+        dst.commit()
+
+        #tiles, as stored (not flip y)
+        ts_col = "timestamp" if hasColumn(src, "tiles", "timestamp") else "%d" % (int(time.time()),)
+        cursor = src.execute("SELECT zoom_level, tile_column, tile_row, tile_data, %s FROM tiles" % (ts_col,))
+        count = 0
+        start = time.time()
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            hashes = [DBDiskCache.genTileHash(row[3]) for row in rows]
+            with dst:
+                dst.executemany("INSERT OR IGNORE INTO images(tile_id, tile_data) VALUES(?, ?)",
+                        ((h, row[3]) for h, row in zip(hashes, rows)))
+                dst.executemany("INSERT OR REPLACE INTO map(zoom_level, tile_column, tile_row, tile_id, timestamp)"
+                        " VALUES(?, ?, ?, ?, ?)", ((row[0], row[1], row[2], h, row[4]) for h, row in zip(hashes, rows)))
+            count += len(rows)
+            logging.info("%s: %d tiles copied" % (path, count))
+
+        #the colors of the uniform tiles
+        if src.execute("SELECT count(*) FROM sqlite_master WHERE name='tile_colors'").fetchone()[0]:
+            with dst:
+                dst.execute(DBDiskCache.COLORS_TABLE_SQL)
+                dst.executemany("INSERT INTO tile_colors(zoom_level, tile_column, tile_row, color) VALUES(?, ?, ?, ?)",
+                        src.execute("SELECT zoom_level, tile_column, tile_row, color FROM tile_colors"))
+
+        secs = time.time() - start
+        images = dst.execute("SELECT count(*) FROM images").fetchone()[0]
+        print("%s: %d tiles, %d unique, %.1f tiles/s" % (path, count, images, count / secs if secs else 0.0))
+    except:
+        dst.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        src.close()
+    dst.close()
+
+    if keep_backup:
+        os.replace(path, path + ".bak")
+    os.replace(tmp_path, path)
+
+def migrate(path, batch_size, keep_backup):
+    size = fileSize(path)
+
+    conn = sqlite3.connect(path)
+    try:
+        is_dedup = DBDiskCache.isDedup(conn)
+        if is_dedup:
+            print("%s: pruned %d unused tile data" % (path, prune(conn)))
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    if not is_dedup:
+        dedup(path, batch_size, keep_backup)
+
+    print("%s: %.1f MB -> %.1f MB" % (path, size / (1 << 20), fileSize(path) / (1 << 20)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='migrate the local cache DBs to the deduplicated schema, in which'
+            ' the identical tiles share their data; or prune and vacuum the DBs already deduplicated.'
+            ' Close the app before the migration.')
+    parser.add_argument("-v", "--verbose", help="show detail information", action="count", default=0)
+    parser.add_argument("-n", "--batch-size", help="the tiles copied in one transaction (default: 5000)",
+            type=int, default=5000)
+    parser.add_argument("-k", "--keep-backup", help="keep the original DB as .bak", action="store_true")
+    parser.add_argument('files', nargs='+', help="the .mbtiles files")
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING
+    logging.basicConfig(level=log_level,
+            format="%(asctime)s.%(msecs)03d [%(levelname)s] [%(module)s] %(message)s", datefmt="%H:%M:%S")
+
+    for path in args.files:
+        migrate(path, args.batch_size, args.keep_backup)
@@ -1,98 +1,384 @@
 #!/usr/bin/env python3
-# -*- coding: utf8 -*-
 
+''' seed the local cache DB (.mbtiles) of a map with the tiles of an area, resumable '''
+
+import os
 import sys
-sys.path.insert(0, 'src')
+import json
+import time
+import logging
+import argparse
+from threading import Lock, Condition
+from concurrent.futures import ThreadPoolExecutor
 
-import tile
-from tile import TileSystem
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-import urllib.request
-import shutil
-import threading
-from threading import Thread, Lock
-import time
-import os
+import src.conf as conf
+from src.coord import TileSystem
+from src.net import HttpPool
+from src.tile import MapDescriptor, TileAgent, DBDiskCache
+from src.util import getUniformColorOfData
+
+# the duration as 'HH:MM:SS', or 'Nd HH:MM:SS' over a day
+def formatDuration(secs):
+    mins, secs = divmod(int(secs), 60)
+    hours, mins = divmod(mins, 60)
+    days, hours = divmod(hours, 24)
+    hms = "%02d:%02d:%02d" % (hours, mins, secs)
+    return "%dd %s" % (days, hms) if days else hms
+
+'''
+The rectangle area, by lon/lat.
+'''
+class BBoxArea:
+    def __init__(self, min_lon, min_lat, max_lon, max_lat):
+        self.bbox = (min_lon, min_lat, max_lon, max_lat)
+
+    def toJson(self):
+        return {'bbox': list(self.bbox)}
+
+    # generate the columns as (x, [y_range, ...])
+    def genColumns(self, level):
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        min_x, min_y = TileSystem.getTileXYByLatLon(max_lat, min_lon, level)
+        max_x, max_y = TileSystem.getTileXYByLatLon(min_lat, max_lon, level)
+        for x in range(min_x, max_x + 1):
+            yield x, [range(min_y, max_y + 1)]
+
+'''
+The polygon area, by the list of (lon, lat).
+A tile is in the area if any edge passes the tile, or the tile is inside the polygon.
+'''
+class PolygonArea:
+    def __init__(self, points):
+        if len(points) < 3:
+            raise ValueError("polygon needs at least 3 points")
+        self.points = points
+        lons = [lon for lon, lat in points]
+        lats = [lat for lon, lat in points]
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+
+    @classmethod
+    def parseFile(cls, filepath):
+        points = []
+        with open(filepath) as f:
+            for line in f:
+                line = line.split('#')[0].replace(',', ' ').split()
+                if line:
+                    points.append((float(line[0]), float(line[1])))
+        return cls(points)
+
+    def toJson(self):
+        return {'polygon': [list(pt) for pt in self.points]}
 
-CACHE_DIR = "mapcache"
-MAX_THREAD = 5
-thread_lock = Lock()
-thread_pool = []
-
-def downloadJob(tile_map, level, x, y):
-    #do download
-    result_ok = False
-    try:
-        url = tile_map.genTileUrl(level, x, y)
-        path = tile_map.genTilePath(level, x, y)
-        print('DL', url)
-        with urllib.request.urlopen(url, timeout=30) as response:
-            tile.mkdirCheck(os.path.dirname(path))
-            with open(path, 'wb') as f:
-                shutil.copyfileobj(response, f)
-        result_ok = True
-    except Exception as ex:
-        print('ERROR download %s to %s error: %s' % (url, path, str(ex)))
-
-    #result
-    print('DL %s [%s]' % (url, 'SUCCESS' if result_ok else 'FAILED'))
-
-    #remove from pool
-    myself = threading.current_thread()
-    with thread_lock:
-        thread_pool.remove(myself)
-
-def downloadArea(map, low_lat, up_lat, left_lon, right_lon):
-    #level
-    for level in range(map.level_min, map.level_max+1):
-        #x, y
-        min_x, min_y = TileSystem.getTileXYByLatLon(up_lat, left_lon, level)
-        max_x, max_y = TileSystem.getTileXYByLatLon(low_lat, right_lon, level)
-        total = (max_x - min_x + 1) * (max_y - min_y + 1)
-        print("Download Tiles in level %d, X,Y=(%d->%d, %d->%d), total %d tiles" % (level, min_x, max_x, min_y, max_y, total))
-
-        count = 0
-        for x in range(min_x, max_x+1):
-            for y in range(min_y, max_y+1):
-                count += 1
-                #check
-                path = map.genTilePath(level, x, y)
-                if os.path.exists(path) and os.path.getsize(path):
-                    #print("SKIP tile(%d,%d,%d)...%d/%d" % (level, x, y, count, total))
+    def genColumns(self, level):
+        side = TileSystem.getPixcelXYByTileXY(1, 1)[0]
+        pts = [TileSystem.getPixcelXYByLatLon(lat, lon, level) for lon, lat in self.points]
+        edges = list(zip(pts, pts[1:] + pts[:1]))
+        min_x = min(px for px, py in pts) // side
+        max_x = max(px for px, py in pts) // side
+
+        for x in range(min_x, max_x + 1):
+            x0, x1 = x * side, (x + 1) * side
+            ys = set()
+
+            #the tiles passed by the edges, clipped in the column
+            for (ax, ay), (bx, by) in edges:
+                if max(ax, bx) < x0 or min(ax, bx) >= x1:
                     continue
+                if ax == bx:
+                    y_lo, y_hi = min(ay, by), max(ay, by)
+                else:
+                    lo, hi = max(x0, min(ax, bx)), min(x1, max(ax, bx))
+                    ya = ay + (by - ay) * (lo - ax) / (bx - ax)
+                    yb = ay + (by - ay) * (hi - ax) / (bx - ax)
+                    y_lo, y_hi = min(ya, yb), max(ya, yb)
+                ys.update(range(int(y_lo) // side, int(y_hi) // side + 1))
+
+            #the tiles inside, by the crossings of the center line of the column (even-odd rule)
+            cx = x0 + side / 2
+            crosses = sorted(ay + (by - ay) * (cx - ax) / (bx - ax)
+                    for (ax, ay), (bx, by) in edges if (ax <= cx) != (bx <= cx))
+            for y_in, y_out in zip(crosses[0::2], crosses[1::2]):
+                ys.update(range(int(y_in) // side, int(y_out) // side + 1))
+
+            if ys:
+                yield x, self.__toRanges(sorted(ys))
+
+    @staticmethod
+    def __toRanges(ys):
+        ranges = []
+        start = prev = ys[0]
+        for y in ys[1:]:
+            if y != prev + 1:
+                ranges.append(range(start, prev + 1))
+                start = y
+            prev = y
+        ranges.append(range(start, prev + 1))
+        return ranges
+
+'''
+Limit the rate of the calls of acquire(), shared by the threads.
+'''
+class RateLimiter:
+    def __init__(self, rate):
+        self.__interval = 1.0 / rate if rate > 0 else 0
+        self.__next_ts = time.time()
+        self.__lock = Lock()
+
+    def acquire(self):
+        if not self.__interval:
+            return
+        with self.__lock:
+            now = time.time()
+            ts = max(self.__next_ts, now)
+            self.__next_ts = ts + self.__interval
+        if ts > now:
+            time.sleep(ts - now)
+
+'''
+The journal to resume the seeding, saved as json.
+The done columns of each level are kept, a column is done if all its tiles are fresh in the db.
+'''
+class SeedJournal:
+    SAVE_PERIOD = 5  #sec
+
+    def __init__(self, filepath, job):
+        self.__filepath = filepath
+        self.__job = job
+        self.__done = {}  #level -> set of x
+        self.__lock = Lock()
+        self.__save_ts = time.time()
+
+        if os.path.exists(filepath):
+            try:
+                with open(filepath) as f:
+                    data = json.load(f)
+                if data.get('job') == job:
+                    self.__done = {int(level): set(xs) for level, xs in data['done'].items()}
+                    logging.info("resume from journal '%s'" % (filepath,))
+                else:
+                    logging.warning("journal '%s' is for another job, restart" % (filepath,))
+            except Exception as ex:
+                logging.warning("read journal '%s' error: %s, restart" % (filepath, str(ex)))
+
+    def isDone(self, level, x):
+        with self.__lock:
+            return x in self.__done.get(level, ())
 
-                #wait thread_pool available
-                while True:
-                    with thread_lock:
-                        if len(thread_pool) < MAX_THREAD:
-                            break
-                    print('.', end='')
-                    time.sleep(1)
-
-                #download
-                print("DL tile(%d,%d,%d)...%d/%d" % (level, x, y, count, total))
-                job = lambda: downloadJob(map, level, x, y)
-                th = Thread(target=job)
-                with thread_lock:
-                    thread_pool.append(th)
-                th.start()
+    def setDone(self, level, x):
+        with self.__lock:
+            self.__done.setdefault(level, set()).add(x)
+            if time.time() - self.__save_ts < self.SAVE_PERIOD:
+                return
+            self.__save_ts = time.time()
+            self.__save()
+
+    def save(self):
+        with self.__lock:
+            self.__save()
+
+    def __save(self):
+        data = {'job': self.__job, 'done': {str(level): sorted(xs) for level, xs in self.__done.items()}}
+        tmp_path = self.__filepath + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.__filepath)  #atomic, not to break the journal if killed
+
+    def remove(self):
+        if os.path.exists(self.__filepath):
+            os.remove(self.__filepath)
+
+class Seeder:
+    REPORT_PERIOD = 5  #sec
+
+    def __init__(self, desc, cache_dir, area, levels, workers, rate, force):
+        self.__desc = desc
+        self.__area = area
+        self.__levels = levels
+        self.__workers = workers
+        self.__force = force
+
+        self.__agent = TileAgent(desc, cache_dir)  #not started, to generate the urls only
+        self.__cache = DBDiskCache(cache_dir, desc, conf.DB_SCHEMA)
+        self.__http_pool = HttpPool(max_conns_per_host=workers)
+        self.__limiter = RateLimiter(rate)
+
+        job = {'map_id': desc.map_id, 'levels': list(levels), 'area': area.toJson()}
+        self.__journal = SeedJournal(os.path.join(cache_dir, desc.map_id + ".seed.json"), job)
+
+        #the columns in progress, (level, x) -> [undone tiles, failed tiles]
+        self.__columns = {}
+        self.__lock = Lock()
+        self.__cv = Condition(self.__lock)
+        self.__pending = 0
+
+        #stats
+        self.__total = 0
+        self.__skipped = 0
+        self.__downloaded = 0
+        self.__failed = 0
+        self.__bytes = 0
+        self.__start_ts = None
+        self.__report_ts = 0
+
+    def __isFresh(self, ts):
+        if ts is None:
+            return True  #the db without timestamp, fresh if existed
+        return not self.__desc.expire_sec or (time.time() - ts) <= self.__desc.expire_sec
+
+    def __download(self, level, x, y):
+        self.__limiter.acquire()
+        url = self.__agent.genTileUrl(level, x, y)
+        try:
+            data = self.__http_pool.get(url, headers=TileAgent.HTTP_HEADERS, timeout=30)
+            self.__cache.put(level, x, y, data, color=getUniformColorOfData(data))
+        except Exception as ex:
+            logging.warning("DL %s [FAILED][%s]" % (url, str(ex)))
+            data = None
+        self.__onDone(level, x, data)
+
+    def __onDone(self, level, x, data):
+        with self.__cv:
+            column = self.__columns[(level, x)]
+            column[0] -= 1
+            if data is None:
+                column[1] += 1
+                self.__failed += 1
+            else:
+                self.__downloaded += 1
+                self.__bytes += len(data)
+            if column[0] == 0:
+                del self.__columns[(level, x)]
+                if column[1] == 0:
+                    self.__journal.setDone(level, x)
+            self.__pending -= 1
+            self.__cv.notify()
+        self.__report()
+
+    def __report(self, is_final=False):
+        now = time.time()
+        with self.__lock:
+            if not is_final and now - self.__report_ts < self.REPORT_PERIOD:
+                return
+            self.__report_ts = now
+            done = self.__skipped + self.__downloaded + self.__failed
+            secs = now - self.__start_ts
+            dl_rate = self.__downloaded / secs if secs else 0.0
+            rate = done / secs if secs else 0.0
+            eta = (self.__total - done) / rate if rate else 0.0
+            nbytes = self.__bytes
+        print("%d/%d tiles (%.1f%%), %d downloaded, %d skipped, %d failed, %.1f tiles/s, %.1f KB/s, ETA %s" % (
+                done, self.__total, 100.0 * done / self.__total if self.__total else 100.0,
+                self.__downloaded, self.__skipped, self.__failed,
+                dl_rate, nbytes / secs / 1024 if secs else 0.0,
+                formatDuration(eta)), flush=True)
+
+    def __countTiles(self):
+        total = 0
+        for level in self.__levels:
+            for x, y_ranges in self.__area.genColumns(level):
+                total += sum(len(r) for r in y_ranges)
+        return total
+
+    def run(self):
+        self.__total = self.__countTiles()
+        logging.info("seed %d tiles of map '%s', levels %d-%d" % (self.__total, self.__desc.map_id,
+                self.__levels[0], self.__levels[-1]))
+
+        self.__start_ts = time.time()
+        self.__cache.start()
+        executor = ThreadPoolExecutor(max_workers=self.__workers)
+        try:
+            for level in self.__levels:
+                for x, y_ranges in self.__area.genColumns(level):
+                    self.__seedColumn(executor, level, x, y_ranges)
+            #wait all done
+            with self.__cv:
+                while self.__pending:
+                    self.__cv.wait()
+        finally:
+            executor.shutdown()
+            self.__cache.close()
+            self.__http_pool.close()
+            self.__journal.save()
+
+        self.__report(is_final=True)
+        if not self.__failed:
+            self.__journal.remove()
+        return self.__failed == 0
+
+    def __seedColumn(self, executor, level, x, y_ranges):
+        count = sum(len(r) for r in y_ranges)
+        if self.__journal.isDone(level, x):
+            with self.__lock:
+                self.__skipped += count
+            return
+
+        #skip if fresh
+        ys = []
+        for y_range in y_ranges:
+            tss = {} if self.__force else self.__cache.getTimestamps(level, range(x, x+1), y_range)
+            ys.extend(y for y in y_range if (x, y) not in tss or not self.__isFresh(tss[(x, y)]))
+        with self.__lock:
+            self.__skipped += count - len(ys)
+        if not ys:
+            self.__journal.setDone(level, x)
+            return
+
+        with self.__cv:
+            self.__columns[(level, x)] = [len(ys), 0]
+
+        for y in ys:
+            #limit the queued jobs, not to hold the whole area in memory
+            with self.__cv:
+                while self.__pending >= self.__workers * 2:
+                    self.__cv.wait()
+                self.__pending += 1
+            executor.submit(self.__download, level, x, y)
+
+def getMapDescriptor(args):
+    if args.xml:
+        return MapDescriptor.parseXml(args.xml)
+    return MapDescriptor.parseXml(os.path.join(conf.MAPCACHE_DIR, args.map + ".xml"))
 
 if __name__ == '__main__':
-    cdir = sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR
+    parser = argparse.ArgumentParser(description='seed the local cache DB of a map with the tiles of an area;'
+            ' run again to resume')
+    parser.add_argument("-v", "--verbose", help="show detail information", action="count", default=0)
+    parser.add_argument("-c", "--conf", help="load the config file in specific folder", default="")
+    parser.add_argument("-x", "--xml", help="the map descriptor file, instead of the map id")
+    parser.add_argument("-d", "--cache-dir", help="the folder of the cache DB (default: the map cache folder)")
+    parser.add_argument("-b", "--bbox", help="the area to seed", type=float, nargs=4,
+            metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument("-p", "--polygon", help="the area to seed, by the file of 'lon,lat' lines")
+    parser.add_argument("-l", "--levels", help="the level range (default: all the levels of the map)",
+            type=int, nargs=2, metavar=('MIN', 'MAX'))
+    parser.add_argument("-w", "--workers", help="the number of concurrent downloads (default: 8)", type=int, default=8)
+    parser.add_argument("-r", "--rate", help="the max tiles per second to download (default: no limit)",
+            type=float, default=0)
+    parser.add_argument("-f", "--force", help="download the tiles even if they are fresh in the db", action="store_true")
+    parser.add_argument("map", nargs='?', help="the map id in the map cache folder")
+    args = parser.parse_args()
+
+    if args.conf:
+        conf.change_conf_dir(args.conf)
 
-    #TM25Kv3
-    map = tile.getTM25Kv3TileMap(cache_dir=cdir)
-    try:
-        #main island of Taiwan
-        low_lat, up_lat = 21.876792, 25.373809
-        left_lon, right_lon = 120.020142, 122.025146
-        downloadArea(map, low_lat, up_lat, left_lon, right_lon)
+    log_level = logging.DEBUG if args.verbose >= 2 else logging.INFO if args.verbose == 1 else logging.WARNING
+    logging.basicConfig(level=log_level,
+            format="%(asctime)s.%(msecs)03d [%(levelname)s] [%(module)s] %(message)s", datefmt="%H:%M:%S")
 
-        #penghu
-        low_lat, up_lat = 23.122995, 23.877676
-        left_lon, right_lon = 119.383106, 119.758186
-        downloadArea(map, low_lat, up_lat, left_lon, right_lon)
-    finally:
-        map.close()
+    if not args.map and not args.xml:
+        parser.error("the map id or the map descriptor file is required")
+    if (args.bbox is None) == (args.polygon is None):
+        parser.error("one of the bbox or the polygon is required")
 
+    desc = getMapDescriptor(args)
+    area = BBoxArea(*args.bbox) if args.bbox else PolygonArea.parseFile(args.polygon)
+    level_min, level_max = args.levels if args.levels else (desc.level_min, desc.level_max)
+    levels = range(max(level_min, desc.level_min), min(level_max, desc.level_max) + 1)
+    if not levels:
+        parser.error("the levels are out of the range of the map")
 
+    seeder = Seeder(desc, args.cache_dir or conf.MAPCACHE_DIR, area, levels, args.workers, args.rate, args.force)
+    sys.exit(0 if seeder.run() else 1)
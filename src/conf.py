@@ -133,6 +133,8 @@ DEL_ICON = os.path.join(__DATA_DIR, 'delete_icon.png')
 GPSBABEL_EXT_FMT = raw.gpsbabel_ext_fmt
 
 MAP_UPDATE_PERIOD = timedelta(seconds=1)
+MAP_PAN_PERIOD_MS = 16   #coalesce the drag motions to the display refresh rate
+MAP_PAN_OVERDRAW_PX = 64 #the exposed strips overdraw the rendered map, to draw the labels across the edges entirely
 
 DEF_COLOR = "DarkMagenta"
 
@@ -174,19 +176,50 @@ __app_conf = __readConf(__APP_CONF)
 __mapcache_dir  = __app_conf.get('settings', 'mapcache_dir', fallback='mapcache')
 __gpsbabel_exe  = __app_conf.get('settings', 'gpsbabel_exe', fallback=__defaultGpsbabelExe())
 __db_schema     = __app_conf.get('settings', 'db_schema', fallback='tms')
+__trk_storage   = __app_conf.get('settings', 'trk_storage', fallback='list')
+__trk_simplify_px = __app_conf.getfloat('settings', 'trk_simplify_px', fallback=0.5)
 
 #publish conf
 MAPCACHE_DIR  = abspath(__mapcache_dir, __HOME_DIR)
 GPSBABEL_EXE  = abspath(__gpsbabel_exe, __HOME_DIR)
 DB_SCHEMA     = __db_schema            #valid value is 'tms' or 'zyx'
+TRK_STORAGE   = __trk_storage          #'columnar': points in arrays, 'list': a list of TrackPoint
+TRK_SIMPLIFY_PX = __trk_simplify_px    #the tolerance to simplify tracks for drawing, 0 to disable
 TRK_COLORS    = __readTrkColors(__app_conf)
 APP_SYMS      = __readAppSyms(__app_conf)
 
+#tile conf
+TILE_MEM_CACHE_MB = __app_conf.getint('tile', 'mem_cache_mb', fallback=256)   #memory cache of decoded tiles, per map
+TILE_MEM_TOTAL_MB = __app_conf.getint('tile', 'mem_total_mb', fallback=1024)  #memory cache of decoded tiles, for all maps
+TILE_FAKE_CACHE_MB = __app_conf.getint('tile', 'fake_cache_mb', fallback=64)   #fake tiles generated from other levels, per map
+TILE_FAKE_MAGNIFY_DEPTH = __app_conf.getint('tile', 'fake_magnify_depth', fallback=3)  #levels up to find a tile to magnify
+TILE_FAKE_MINIFY_DEPTH  = __app_conf.getint('tile', 'fake_minify_depth', fallback=1)   #levels down to find tiles to minify
+TILE_COMPOSITE_CACHE_MB = __app_conf.getint('tile', 'composite_cache_mb', fallback=64)  #composited tiles of multi-layer maps
+TILE_TUNED_CACHE_MB = __app_conf.getint('tile', 'tuned_cache_mb', fallback=32)    #alpha-tuned tiles of transparent maps
+TILE_HTTP_CONNS_PER_HOST = __app_conf.getint('tile', 'http_conns_per_host', fallback=4)  #keep-alive connections per host
+TILE_DL_WORKERS     = __app_conf.getint('tile', 'dl_workers', fallback=3)       #download threads per map, if the map not specified
+TILE_DL_KEEP_MARGIN = __app_conf.getint('tile', 'dl_keep_margin', fallback=2)   #keep the requests within the margin (in tiles) of viewport
+TILE_DL_BACKEND     = __app_conf.get('tile', 'dl_backend', fallback='thread')   #'thread': worker threads, 'async': asyncio engine
+TILE_DL_ASYNC_IN_FLIGHT = __app_conf.getint('tile', 'dl_async_in_flight', fallback=64)  #in-flight requests per map, for 'async'
+TILE_HTTP_ASYNC_CONNS_PER_HOST = __app_conf.getint('tile', 'http_async_conns_per_host', fallback=8)  #for 'async'
+TILE_PREFETCH_MAX_TILES = __app_conf.getint('tile', 'prefetch_max_tiles', fallback=64)  #tiles to prefetch per viewport, 0 to disable
+TILE_PREFETCH_RING  = __app_conf.getint('tile', 'prefetch_ring', fallback=1)    #tiles around the viewport to prefetch
+TILE_PREFETCH_DELAY_MS = __app_conf.getint('tile', 'prefetch_delay_ms', fallback=300)  #prefetch after the viewport is stable
+TILE_PREFETCH_NETWORK = __app_conf.getboolean('tile', 'prefetch_network', fallback=False)  #also download the tiles not in disk
+TILE_DB_BATCH_SIZE  = __app_conf.getint('tile', 'db_batch_size', fallback=64)   #tiles written in one transaction
+TILE_DB_BATCH_MS    = __app_conf.getint('tile', 'db_batch_ms', fallback=500)    #the longest time a tile waits to be written
+TILE_DB_JOURNAL_MODE = __app_conf.get('tile', 'db_journal_mode', fallback='WAL')
+TILE_DB_SYNCHRONOUS  = __app_conf.get('tile', 'db_synchronous', fallback='NORMAL')  #OFF, NORMAL, or FULL
+TILE_DB_READERS     = __app_conf.getint('tile', 'db_readers', fallback=8)       #read-only connections per map
+TILE_DB_DEDUP       = __app_conf.getboolean('tile', 'db_dedup', fallback=False)  #new cache DBs share the data of identical tiles
+
 def writeAppConf():
     __app_conf['settings'] = OrderedDict()
     __app_conf['settings']['mapcache_dir'] = preferOrigIfEql(MAPCACHE_DIR, __mapcache_dir, __HOME_DIR)
     __app_conf['settings']['gpsbabel_exe'] = preferOrigIfEql(GPSBABEL_EXE, __gpsbabel_exe, __HOME_DIR)
     __app_conf['settings']['db_schema'] = DB_SCHEMA
+    __app_conf['settings']['trk_storage'] = TRK_STORAGE
+    __app_conf['settings']['trk_simplify_px'] = "%g" % (TRK_SIMPLIFY_PX,)
 
     __app_conf['trk_colors'] = OrderedDict()
     for i in range(len(TRK_COLORS)):
@@ -196,6 +229,31 @@ def writeAppConf():
     for i in range(len(APP_SYMS)):
         __app_conf['app_syms']['app_syms.' + str(i)] = APP_SYMS[i]
 
+    __app_conf['tile'] = OrderedDict()
+    __app_conf['tile']['mem_cache_mb'] = "%d" % (TILE_MEM_CACHE_MB,)
+    __app_conf['tile']['mem_total_mb'] = "%d" % (TILE_MEM_TOTAL_MB,)
+    __app_conf['tile']['fake_cache_mb'] = "%d" % (TILE_FAKE_CACHE_MB,)
+    __app_conf['tile']['fake_magnify_depth'] = "%d" % (TILE_FAKE_MAGNIFY_DEPTH,)
+    __app_conf['tile']['fake_minify_depth'] = "%d" % (TILE_FAKE_MINIFY_DEPTH,)
+    __app_conf['tile']['composite_cache_mb'] = "%d" % (TILE_COMPOSITE_CACHE_MB,)
+    __app_conf['tile']['tuned_cache_mb'] = "%d" % (TILE_TUNED_CACHE_MB,)
+    __app_conf['tile']['http_conns_per_host'] = "%d" % (TILE_HTTP_CONNS_PER_HOST,)
+    __app_conf['tile']['dl_workers'] = "%d" % (TILE_DL_WORKERS,)
+    __app_conf['tile']['dl_keep_margin'] = "%d" % (TILE_DL_KEEP_MARGIN,)
+    __app_conf['tile']['dl_backend'] = TILE_DL_BACKEND
+    __app_conf['tile']['dl_async_in_flight'] = "%d" % (TILE_DL_ASYNC_IN_FLIGHT,)
+    __app_conf['tile']['http_async_conns_per_host'] = "%d" % (TILE_HTTP_ASYNC_CONNS_PER_HOST,)
+    __app_conf['tile']['prefetch_max_tiles'] = "%d" % (TILE_PREFETCH_MAX_TILES,)
+    __app_conf['tile']['prefetch_ring'] = "%d" % (TILE_PREFETCH_RING,)
+    __app_conf['tile']['prefetch_delay_ms'] = "%d" % (TILE_PREFETCH_DELAY_MS,)
+    __app_conf['tile']['prefetch_network'] = "true" if TILE_PREFETCH_NETWORK else "false"
+    __app_conf['tile']['db_batch_size'] = "%d" % (TILE_DB_BATCH_SIZE,)
+    __app_conf['tile']['db_batch_ms'] = "%d" % (TILE_DB_BATCH_MS,)
+    __app_conf['tile']['db_journal_mode'] = TILE_DB_JOURNAL_MODE
+    __app_conf['tile']['db_synchronous'] = TILE_DB_SYNCHRONOUS
+    __app_conf['tile']['db_readers'] = "%d" % (TILE_DB_READERS,)
+    __app_conf['tile']['db_dedup'] = "true" if TILE_DB_DEDUP else "false"
+
     __writeConf(__app_conf, __APP_CONF)
 
 
@@ -3,6 +3,11 @@
 import math
 from math import tan, sin, cos, radians, degrees, floor
 
+try:
+    import numpy as np  #for the batch conversions
+except ImportError:
+    np = None
+
 EARTH_RADIUS = 6378137
 MIN_LATITUDE = -85.05112878
 MAX_LATITUDE = 85.05112878
@@ -184,7 +189,26 @@ class TileSystem:
         pixel_y = int(C.crop(y * map_size + 0.5, 0, map_size - 1))
 
         return (pixel_x, pixel_y)
-    
+
+    # the batch of getPixcelXYByLatLon(), return (pixel_xs, pixel_ys) as int arrays if numpy is available, or lists
+    @classmethod
+    def getPixcelXYByLatLonBatch(C, latitudes, longitudes, level):
+        if np is None:
+            pixels = [C.getPixcelXYByLatLon(lat, lon, level) for lat, lon in zip(latitudes, longitudes)]
+            return ([px for px, py in pixels], [py for px, py in pixels])
+
+        latitude = np.clip(np.asarray(latitudes, dtype=np.float64), C.MIN_LATITUDE, C.MAX_LATITUDE)
+        longitude = np.clip(np.asarray(longitudes, dtype=np.float64), C.MIN_LONGITUDE, C.MAX_LONGITUDE)
+
+        x = (longitude + 180) / 360
+        sin_latitude = np.sin(latitude * math.pi / 180)
+        y = 0.5 - np.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+
+        map_size = C.getMapSize(level)
+        pixel_x = np.clip(x * map_size + 0.5, 0, map_size - 1).astype(np.int64)
+        pixel_y = np.clip(y * map_size + 0.5, 0, map_size - 1).astype(np.int64)
+
+        return (pixel_x, pixel_y)
 
     @classmethod
     def getLatLonByPixcelXY(C, pixel_x, pixel_y, level):
@@ -247,15 +271,25 @@ class CoordinateSystem:
     e = 1 - b**2 / a**2
     e2 = e / b**2 / a**2
 
+    #the constant terms of the series
+    e_2 = e**2
+    e_3 = e**3
+    M1 = 1.0 - e / 4.0 - 3.0 * e_2 / 64.0 - 5.0 * e_3 / 256.0
+    M2 = 3.0 * e / 8.0 + 3.0 * e_2 / 32.0 + 45.0 * e_3 / 1024.0
+    M4 = 15.0 * e_2 / 256.0 + 45.0 * e_3 / 1024.0
+    M6 = 35.0 * e_3 / 3072.0
+    e1 = (1.0 - (1.0 - e)**0.5) / (1.0 + (1.0 - e)**0.5)
+    J1 = (3 * e1 / 2 - 27 * e1**3 / 32.0)
+    J2 = (21 * e1**2 / 16 - 55 * e1**4 / 32.0)
+    J3 = (151 * e1**3 / 96.0)
+    J4 = (1097 * e1**4 / 512.0)
+
     #TWD97, lat/lon -> tm2
     @classmethod
     def TWD97_LatLonToTWD97_TM2(cls, lat, lon):
         a = cls.a
-        b = cls.b
         lon0 = cls.lon0
         k0 = cls.k0
-        dx = cls.dx
-        dy = cls.dy
         e = cls.e
         e2 = cls.e2
 
@@ -266,44 +300,57 @@ class CoordinateSystem:
         T = tan(lat)**2
         C = e2 * cos(lat)** 2
         A = cos(lat) * (lon - lon0)
-        e_2 = e**2
-        e_3 = e**3
-        M = a *((1.0 - e / 4.0 - 3.0 * e_2 / 64.0 - 5.0 * e_3 / 256.0) * lat -
-          (3.0 * e / 8.0 + 3.0 * e_2 / 32.0 + 45.0 * e_3 / 1024.0) *
-          sin(2.0 * lat) + (15.0 * e_2 / 256.0 + 45.0 * e_3 / 1024.0) *
-          sin(4.0 * lat) - (35.0 * e_3 / 3072.0) * sin(6.0 * lat))
-
-        x = dx + k0 * V * (A + (1 - T + C) * A**3 / 6 + (5 - 18 * T + T**2 + 72 * C - 58 * e2) * A**5 / 120)
-        y = dy + k0 * (M + V * tan(lat) * (A**2 / 2 + (5 - T + 9 * C + 4 * C**2) * A**4/ 24 + ( 61 - 58 * T + T**2 + 600 * C - 330 * e2) * A**6 / 720))
+        M = a * (cls.M1 * lat - cls.M2 * sin(2.0 * lat) + cls.M4 * sin(4.0 * lat) - cls.M6 * sin(6.0 * lat))
+
+        x = cls.dx + k0 * V * (A + (1 - T + C) * A**3 / 6 + (5 - 18 * T + T**2 + 72 * C - 58 * e2) * A**5 / 120)
+        y = cls.dy + k0 * (M + V * tan(lat) * (A**2 / 2 + (5 - T + 9 * C + 4 * C**2) * A**4/ 24 + ( 61 - 58 * T + T**2 + 600 * C - 330 * e2) * A**6 / 720))
+        return (x, y)
+
+    # the batch of TWD97_LatLonToTWD97_TM2(), return (xs, ys) as arrays if numpy is available, or lists
+    @classmethod
+    def TWD97_LatLonToTWD97_TM2Batch(cls, lats, lons):
+        if np is None:
+            xys = [cls.TWD97_LatLonToTWD97_TM2(lat, lon) for lat, lon in zip(lats, lons)]
+            return ([x for x, y in xys], [y for x, y in xys])
+
+        a = cls.a
+        k0 = cls.k0
+        e2 = cls.e2
+
+        lon = np.asarray(lons, dtype=np.float64)
+        lon = (lon - np.floor((lon + 180) / 360) * 360) * math.pi / 180
+        lat = np.asarray(lats, dtype=np.float64) * math.pi / 180
+
+        sin_lat = np.sin(lat)
+        cos_lat = np.cos(lat)
+        tan_lat = np.tan(lat)
+        V = a / (1 - cls.e * sin_lat**2)**0.5
+        T = tan_lat**2
+        C = e2 * cos_lat**2
+        A = cos_lat * (lon - cls.lon0)
+        M = a * (cls.M1 * lat - cls.M2 * np.sin(2.0 * lat) + cls.M4 * np.sin(4.0 * lat) - cls.M6 * np.sin(6.0 * lat))
+
+        A2 = A**2
+        x = cls.dx + k0 * V * A * (1 + (1 - T + C) * A2 / 6 + (5 - 18 * T + T**2 + 72 * C - 58 * e2) * A2**2 / 120)
+        y = cls.dy + k0 * (M + V * tan_lat * A2 * (1 / 2 + (5 - T + 9 * C + 4 * C**2) * A2 / 24 + (61 - 58 * T + T**2 + 600 * C - 330 * e2) * A2**2 / 720))
         return (x, y)
 
     @classmethod
     def TWD97_TM2ToTWD97_LatLon(cls, x, y):
         a = cls.a
-        b = cls.b
-        lon0 = cls.lon0
         k0 = cls.k0
-        dx = cls.dx
-        dy = cls.dy
         e = cls.e
         e2 = cls.e2
 
-        x -= dx
-        y -= dy
+        x -= cls.dx
+        y -= cls.dy
 
         #Calculate the Meridional Arc
         M = y / k0
 
         #Calculate Footprint Latitude
-        mu = M / (a * (1.0 - e / 4.0 - 3 * e**2 / 64.0 - 5 * e**3 / 256.0))
-        e1 = (1.0 - (1.0 - e)**0.5) / (1.0 + (1.0 - e)**0.5)
-
-        J1 = (3 * e1 / 2 - 27 * e1**3 / 32.0)
-        J2 = (21 * e1**2 / 16 - 55 * e1**4 / 32.0)
-        J3 = (151 * e1**3 / 96.0)
-        J4 = (1097 * e1**4 / 512.0)
-
-        fp = mu + J1 * sin(2 * mu) + J2 * sin(4 * mu) + J3 * sin(6 * mu) + J4 * sin(8 * mu)
+        mu = M / (a * cls.M1)
+        fp = mu + cls.J1 * sin(2 * mu) + cls.J2 * sin(4 * mu) + cls.J3 * sin(6 * mu) + cls.J4 * sin(8 * mu)
 
         # Calculate Latitude and Longitude
         C1 = e2 * cos(fp)**2
@@ -324,13 +371,55 @@ class CoordinateSystem:
         Q5 = D
         Q6 = (1 + 2 * T1 + C1) * (D**3) / 6
         Q7 = (5 - 2 * C1 + 28 * T1 - 3 * (C1**2) + 8 * e2 + 24 * (T1**2)) * (D**5) / 120.0
-        lon = lon0 + (Q5 - Q6 + Q7) / cos(fp)
+        lon = cls.lon0 + (Q5 - Q6 + Q7) / cos(fp)
 
         lat = degrees(lat)
         lon = degrees(lon)
 
         return (lat, lon)
 
+    # the batch of TWD97_TM2ToTWD97_LatLon(), return (lats, lons) as arrays if numpy is available, or lists
+    @classmethod
+    def TWD97_TM2ToTWD97_LatLonBatch(cls, xs, ys):
+        if np is None:
+            lat_lons = [cls.TWD97_TM2ToTWD97_LatLon(x, y) for x, y in zip(xs, ys)]
+            return ([lat for lat, lon in lat_lons], [lon for lat, lon in lat_lons])
+
+        a = cls.a
+        k0 = cls.k0
+        e = cls.e
+        e2 = cls.e2
+
+        x = np.asarray(xs, dtype=np.float64) - cls.dx
+        y = np.asarray(ys, dtype=np.float64) - cls.dy
+
+        mu = y / k0 / (a * cls.M1)
+        fp = mu + cls.J1 * np.sin(2 * mu) + cls.J2 * np.sin(4 * mu) + cls.J3 * np.sin(6 * mu) + cls.J4 * np.sin(8 * mu)
+
+        sin_fp = np.sin(fp)
+        cos_fp = np.cos(fp)
+        tan_fp = np.tan(fp)
+        C1 = e2 * cos_fp**2
+        T1 = tan_fp**2
+        W = 1 - e * sin_fp**2
+        R1 = a * (1 - e) / W**1.5
+        N1 = a / W**0.5
+
+        D = x / (N1 * k0)
+        D2 = D**2
+
+        Q1 = N1 * tan_fp / R1
+        Q2 = D2 / 2.0
+        Q3 = (5 + 3 * T1 + 10 * C1 - 4 * C1**2 - 9 * e2) * D2**2 / 24.0
+        Q4 = (61 + 90 * T1 + 298 * C1 + 45 * T1**2 - 3 * (C1**2) - 252 * e2) * (D2**3) / 720.0
+        lat = fp - Q1 * (Q2 - Q3 + Q4)
+
+        Q6 = (1 + 2 * T1 + C1) * D2 / 6
+        Q7 = (5 - 2 * C1 + 28 * T1 - 3 * (C1**2) + 8 * e2 + 24 * (T1**2)) * D2**2 / 120.0
+        lon = cls.lon0 + D * (1 - Q6 + Q7) / cos_fp
+
+        return (np.degrees(lat), np.degrees(lon))
+
     TM2_A= 0.00001549
     TM2_B= 0.000006521
 
@@ -356,6 +445,24 @@ class CoordinateSystem:
         (x, y) = CoordinateSystem.TWD97_LatLonToTWD97_TM2(lat, lon)
         return CoordinateSystem.TWD97_TM2ToTWD67_TM2(x, y)
 
+    # TWD67_TM2ToTWD97_TM2() and TWD97_TM2ToTWD67_TM2() are linear, which work on arrays as well
+    @staticmethod
+    def TWD67_TM2ToTWD97_LatLonBatch(xs, ys):
+        if np is None:
+            xys = [CoordinateSystem.TWD67_TM2ToTWD97_TM2(x, y) for x, y in zip(xs, ys)]
+            xs, ys = [x for x, y in xys], [y for x, y in xys]
+        else:
+            xs, ys = CoordinateSystem.TWD67_TM2ToTWD97_TM2(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        return CoordinateSystem.TWD97_TM2ToTWD97_LatLonBatch(xs, ys)
+
+    @staticmethod
+    def TWD97_LatLonToTWD67_TM2Batch(lats, lons):
+        xs, ys = CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch(lats, lons)
+        if np is None:
+            xys = [CoordinateSystem.TWD97_TM2ToTWD67_TM2(x, y) for x, y in zip(xs, ys)]
+            return ([x for x, y in xys], [y for x, y in xys])
+        return CoordinateSystem.TWD97_TM2ToTWD67_TM2(xs, ys)
+
 class CoordinateSystem2:
 
     """This object provide method for converting lat/lon coordinate to TWD97
@@ -3,16 +3,26 @@
 """ handle gpx file """
 
 import os
+import math
 import logging
 import src.util as util
+import src.conf as conf
 import pytz
+from array import array
 from xml.etree import ElementTree as ET
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import BytesIO
+from collections import OrderedDict
 from PIL import Image
 import xml.dom.minidom
 from src.coord import TileSystem
 from src.util import GeoPoint
 
+try:
+    import numpy as np  #for the pixels of tracks
+except ImportError:
+    np = None
+
 class GpsDocument:
     @property
     def maxlon(self): return self.__maxlon
@@ -44,119 +54,142 @@ class GpsDocument:
         self.ns['xsi'] = "http://www.w3.org/2001/XMLSchema-instance"
         self.ns['gpxx'] = "http://www.garmin.com/xmlschemas/GpxExtensions/v3"
 
-    def load(self, filename=None, filestring=None):
-        #get root element
-        xml_root = None
+    PROGRESS_PERIOD = 10000  #points between the progress callbacks
+
+    # load by streaming the elements, which are dropped once they are read,
+    # so the memory is for the loaded points, not for the whole xml tree.
+    # @progress_cb(read_bytes, total_bytes) is called periodically, if any
+    def load(self, filename=None, filestring=None, progress_cb=None):
         if filename is not None:
-            xml_root = ET.parse(filename).getroot()
+            with open(filename, 'rb') as f:
+                self.__load(f, os.fstat(f.fileno()).st_size, progress_cb)
         elif filestring is not None:
-            xml_root = ET.fromstring(filestring)
+            data = filestring.encode('utf-8') if isinstance(filestring, str) else filestring
+            self.__load(BytesIO(data), len(data), progress_cb)
         else:
             raise ValueError("Gpx filename and filestring both None")
 
-        #override 'gpx ns
-        if xml_root.tag[0] == '{':
-            ns, name = xml_root.tag[1:].split("}")
-            self.ns["gpx"] = ns 
+    def __load(self, f, total_bytes, progress_cb):
+        root = None
+        trk = None
+        trkseg = None
+        tags = None
+        has_bounds = False
+        count = 0
+        minlat = maxlat = minlon = maxlon = None
+
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                    tags = self.__genTags(root)
+                elif elem.tag == tags['trk']:
+                    trk = self.__trks[self.genTrk("(No Title)", "DarkMagenta")]
+                elif elem.tag == tags['trkseg']:
+                    trkseg = elem
+                continue
+
+            tag = elem.tag
+            if tag == tags['trkpt'] and trkseg is not None:
+                lat = float(elem.attrib["lat"])
+                lon = float(elem.attrib["lon"])
+                pt = TrackPoint(lat, lon)
+                pt.ele = None
+                for child in elem:
+                    if child.tag == tags['ele']:
+                        pt.ele = float(child.text)
+                    elif child.tag == tags['time']:
+                        pt.time = self.__toUTCTime(child.text)
+                trk.add(pt)
+                trkseg.clear()  #drop the read points
+
+                #bounds
+                if minlat is None:
+                    minlat = maxlat = lat
+                    minlon = maxlon = lon
+                else:
+                    if lat < minlat: minlat = lat
+                    elif lat > maxlat: maxlat = lat
+                    if lon < minlon: minlon = lon
+                    elif lon > maxlon: maxlon = lon
+
+                count += 1
+                if progress_cb is not None and count % self.PROGRESS_PERIOD == 0:
+                    progress_cb(f.tell(), total_bytes)
+
+            elif tag == tags['wpt']:
+                self.addWpt(self.__toWpt(elem, tags))
+                elem.clear()
+            elif tag == tags['trk']:
+                trk = None
+                elem.clear()
+            elif trk is not None and trkseg is None and tag == tags['name']:
+                trk.name = elem.text
+            elif trk is not None and tag == tags['color']:
+                trk.color = elem.text
+            elif tag == tags['trkseg']:
+                trkseg = None
+            elif tag == tags['bounds'] and not has_bounds:
+                has_bounds = True
+                self.__mergeBounds(float(elem.attrib['minlat']), float(elem.attrib['maxlat']),
+                        float(elem.attrib['minlon']), float(elem.attrib['maxlon']))
+            elif tag == tags['metadata']:
+                elem.clear()
+
+        self.__mergeBounds(minlat, maxlat, minlon, maxlon)
+        if progress_cb is not None:
+            progress_cb(total_bytes, total_bytes)
+
+    # the full tag names, after overriding 'gpx' ns by the root element
+    def __genTags(self, root):
+        if root.tag[0] == '{':
+            ns, name = root.tag[1:].split("}")
+            self.ns["gpx"] = ns
             if name != "gpx":
                 logging.warning("Warning: the root element's namespace is not 'gpx'")
 
-        #load data
-        self.__loadMetadata(xml_root)
-        self.__loadWpt(xml_root)
-        self.__loadTrk(xml_root)
-
-        '''
-        #debug outptu
-        for wpt in self.__wpts:
-            print(wpt.time.strftime("%c"), wpt.name, wpt.lon, wpt.lat, wpt.ele)
-
-        for trk in self.__trks:
-            print(trk.name, trk.color)
-            for pt in trk:
-                print("  ", pt.time.strftime("%c"), pt.lon, pt.lat, pt.ele)
-        '''
-
-    def __loadMetadata(self, xml_root):
-        #bounds = xml_root.find("./gpx:metadata/gpx:bounds", self.ns)  #gpx1.1
-        #bounds = xml_root.findall("./gpx:bounds", self.ns)  #gpx1.0 
-        bounds = xml_root.find(".//gpx:bounds", self.ns)  #for gpx1.0/gpx1.1
-        self.__maxlat = float(bounds.attrib['maxlat']) if bounds is not None else None
-        self.__maxlon = float(bounds.attrib['maxlon']) if bounds is not None else None
-        self.__minlat = float(bounds.attrib['minlat']) if bounds is not None else None
-        self.__minlon = float(bounds.attrib['minlon']) if bounds is not None else None
-
-    def __loadWpt(self, xml_root):
-        wpt_elems = xml_root.findall("./gpx:wpt", self.ns)
-        if wpt_elems is None:
-            return
-
-        for wpt_elem in wpt_elems:
-            #read lat, lon, necessarily
-            wpt = WayPoint(
-                float(wpt_elem.attrib['lat']),
-                float(wpt_elem.attrib['lon']))
-
-            #read info from child elements, if any
-            elem = wpt_elem.find("./gpx:ele", self.ns)
-            wpt.ele = float(elem.text) if elem is not None and elem.text else 0.0
-
-            elem = wpt_elem.find("./gpx:time", self.ns)
-            wpt.time = self.__toUTCTime(elem.text) if elem is not None and elem.text else None
-
-            elem = wpt_elem.find("./gpx:name", self.ns)
-            wpt.name = elem.text if elem is not None and elem.text is not None else ""
-
-            elem = wpt_elem.find("./gpx:sym", self.ns)
-            wpt.sym = elem.text if elem is not None and elem.text else ""
-
-            elem = wpt_elem.find("./gpx:cmt", self.ns)
-            wpt.cmt = elem.text if elem is not None and elem.text else ""
-
-            elem = wpt_elem.find("./gpx:desc", self.ns)
-            wpt.desc = elem.text if elem is not None and elem.text else ""
-
-            self.addWpt(wpt)
-
-    def __loadTrk(self, xml_root):
-        trk_elems = xml_root.findall("./gpx:trk", self.ns)
-        if trk_elems is None:
-            return
-
-        for trk_elem in trk_elems:
-            elem = trk_elem.find("./gpx:name", self.ns)
-            name = elem.text if elem is not None else "(No Title)"
-
-            elem = trk_elem.find("./gpx:extensions/gpxx:TrackExtension/gpxx:DisplayColor", self.ns)
-            color = elem.text if elem is not None else "DarkMagenta"
-
-            trk_idx = self.genTrk(name, color)
-
-            #may have multi trkseg
-            elems = trk_elem.findall("./gpx:trkseg", self.ns)
-            if elems is not None:
-                for elem in elems:
-                    self.__loadTrkSeg(elem, trk_idx)
-
-    def __loadTrkSeg(self, trkseg_elem, trk_idx):
-        trkpt_elems = trkseg_elem.findall("./gpx:trkpt", self.ns)
-        if trkpt_elems is None:
-            return
-
-        for trkpt_elem in trkpt_elems:
-            pt = TrackPoint(float(trkpt_elem.attrib["lat"]), float(trkpt_elem.attrib["lon"]))
-
-            elem = trkpt_elem.find("./gpx:ele", self.ns)
-            pt.ele = None if elem is None else float(elem.text)
-
-            elem = trkpt_elem.find("./gpx:time", self.ns)
-            pt.time = None if elem is None else self.__toUTCTime(elem.text)
-
-            self.addTrkpt(trk_idx, pt)
+        gpx = "{%s}" % (self.ns['gpx'],) if root.tag[0] == '{' else ""
+        gpxx = "{%s}" % (self.ns['gpxx'],)
+        tags = {name: gpx + name for name in ('metadata', 'bounds', 'wpt', 'trk', 'trkseg', 'trkpt',
+                                              'name', 'ele', 'time', 'sym', 'cmt', 'desc')}
+        tags['color'] = gpxx + "DisplayColor"
+        return tags
+
+    def __toWpt(self, wpt_elem, tags):
+        #read lat, lon, necessarily
+        wpt = WayPoint(
+            float(wpt_elem.attrib['lat']),
+            float(wpt_elem.attrib['lon']))
+        wpt.ele = 0.0
+        wpt.time = None
+
+        #read info from child elements, if any
+        for elem in wpt_elem:
+            if not elem.text:
+                continue
+            if elem.tag == tags['ele']:
+                wpt.ele = float(elem.text)
+            elif elem.tag == tags['time']:
+                wpt.time = self.__toUTCTime(elem.text)
+            elif elem.tag == tags['name']:
+                wpt.name = elem.text
+            elif elem.tag == tags['sym']:
+                wpt.sym = elem.text
+            elif elem.tag == tags['cmt']:
+                wpt.cmt = elem.text
+            elif elem.tag == tags['desc']:
+                wpt.desc = elem.text
+        return wpt
+
+    def __mergeBounds(self, minlat, maxlat, minlon, maxlon):
+        self.__minlat = self.safe_min(self.__minlat, minlat)
+        self.__maxlat = self.safe_max(self.__maxlat, maxlat)
+        self.__minlon = self.safe_min(self.__minlon, minlon)
+        self.__maxlon = self.safe_max(self.__maxlon, maxlon)
 
     #should not allow users to create Track() by themself, because we want to force users to user addTrkpt()
     def genTrk(self, name, color):
-        trk = Track()
+        trk = ColumnarTrack() if conf.TRK_STORAGE == 'columnar' else Track()
         trk.name = name
         trk.color = color
         self.__trks.append(trk)
@@ -230,6 +263,19 @@ class GpsDocument:
         return "0" * ( 4 - txt.index('-')) + txt
 
     def __toUTCTime(self, txt):
+        #fast path for 'YYYY-MM-DDThh:mm:ssZ' and 'YYYY-MM-DDThh:mm:ss.fffZ'
+        try:
+            if txt[-1] == 'Z' and txt[4] == '-' and txt[10] == 'T':
+                usec = 0
+                if len(txt) > 20 and txt[19] == '.':
+                    usec = int(txt[20:-1].ljust(6, '0')[:6])
+                elif len(txt) != 20:
+                    raise ValueError()
+                return datetime(int(txt[0:4]), int(txt[5:7]), int(txt[8:10]),
+                        int(txt[11:13]), int(txt[14:16]), int(txt[17:19]), usec, tzinfo=pytz.utc)
+        except (ValueError, IndexError):
+            pass
+
         fmt = "%Y-%m-%dT%H:%M:%S.%fZ" if "." in txt else "%Y-%m-%dT%H:%M:%SZ"
         return datetime.strptime(txt, fmt).replace(tzinfo=pytz.utc)
 
@@ -334,22 +380,41 @@ class GpsDocument:
             self.__trks = sorted(self.__trks, key=lambda trk: trk.time)
 
     def splitTrk(self, split_fn):
-        sp_trks = []
-        for trk in self.__trks:
-            sp_trks.extend(trk.split(split_fn))
+        return self.__replaceSplitTrks([trk.split(split_fn) for trk in self.__trks])
+
+    # split the tracks before the points of the indices @idxs_fn(trk)
+    def splitTrkAt(self, idxs_fn):
+        return self.__replaceSplitTrks([trk.splitAt(idxs_fn(trk)) for trk in self.__trks])
 
-        #replace
+    def __replaceSplitTrks(self, trks_list):
+        sp_trks = [trk for trks in trks_list for trk in trks]
         has_split = len(self.__trks) != len(sp_trks)
         self.__trks = sp_trks
         return has_split
 
+# the bounds (minlat, maxlat, minlon, maxlon) extended to cover (@lat, @lon)
+def extendBounds(bounds, lat, lon):
+    minlat, maxlat, minlon, maxlon = bounds
+    return (min(minlat, lat), max(maxlat, lat), min(minlon, lon), max(maxlon, lon))
+
 class Track:
     @property
     def time(self):
         return self.__trkseg[0].time if len(self.__trkseg) > 0 else datetime.min
 
+    # (minlat, maxlat, minlon, maxlon) of the points, or None if no any point
+    @property
+    def bounds(self):
+        if self.__bounds is None and len(self.__trkseg) > 0:
+            lats = [pt.lat for pt in self.__trkseg]
+            lons = [pt.lon for pt in self.__trkseg]
+            self.__bounds = (min(lats), max(lats), min(lons), max(lons))
+        return self.__bounds
+
     def __init__(self):
         self.__trkseg = []
+        self.__pixels = None  #TrackPixels, until the track is edited
+        self.__bounds = None  #extended as adding points, and computed again lazily if others are edited
         self.name = ''
         self.color = 'DarkMagenta'
 
@@ -361,37 +426,534 @@ class Track:
 
     def __setitem__(self, idx, val):
         self.__trkseg[idx] = val
+        self.__pixels = None
+        self.__bounds = None
 
     def __delitem__(self, idx):
         del self.__trkseg[idx]
+        self.__pixels = None
+        self.__bounds = None
 
     def __len__(self):
         return len(self.__trkseg)
 
     def add(self, pt):
         self.__trkseg.append(pt)
+        self.__pixels = None
+        if self.__bounds is not None:
+            self.__bounds = extendBounds(self.__bounds, pt.lat, pt.lon)
 
     def remove(self, pt):
         self.__trkseg.remove(pt)
+        self.__pixels = None
+        self.__bounds = None
+
+    # (lats, lons, times) of the points
+    def getLatLonTimes(self):
+        pts = self.__trkseg
+        return ([pt.lat for pt in pts], [pt.lon for pt in pts], [pt.time for pt in pts])
+
+    def getPixels(self):
+        if self.__pixels is None:
+            pixels = [pt.pixel(GeoPoint.MAX_LEVEL) for pt in self.__trkseg]
+            self.__pixels = TrackPixels([px for px, py in pixels], [py for px, py in pixels])
+        return self.__pixels
 
     def split(self, split_fn):
+        pts = self.__trkseg
+        return self.splitAt([i for i in range(1, len(pts)) if split_fn(pts[i-1], pts[i])])
+
+    # split before the points of the ascending indices @idxs
+    def splitAt(self, idxs):
         sp_trks = []
+        bounds = [0] + [i for i in idxs if 0 < i < len(self)] + [len(self)]
+        for start, stop in zip(bounds, bounds[1:]):
+            if start == stop:  #empty
+                continue
+            trk = Track()
+            trk.name = "%s-%d" % (self.name, len(sp_trks)+1)
+            trk.color = self.color
+            for pt in self.__trkseg[start:stop]:
+                trk.add(pt)
+            sp_trks.append(trk)
+        return sp_trks
+
+'''
+The track stores the fields of its points in arrays instead of a list of TrackPoint,
+which costs 48 bytes per point, rather than hundreds of bytes of a TrackPoint object.
+The points are created on access, as copies (TrackPointView); to modify a point, assign it back.
+A naive time is taken as UTC, and is returned as an aware one.
+'''
+class ColumnarTrack:
+    NO_TIME = -(1 << 63)  #the time of the point without time
+    EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+    US = timedelta(microseconds=1)
+
+    @property
+    def time(self):
+        return self.__toTime(self.__time[0]) if len(self.__lat) > 0 else datetime.min
+
+    # (minlat, maxlat, minlon, maxlon) of the points, or None if no any point
+    @property
+    def bounds(self):
+        if self.__bounds is None and len(self.__lat) > 0:
+            self.__bounds = (min(self.__lat), max(self.__lat), min(self.__lon), max(self.__lon))
+        return self.__bounds
+
+    def __init__(self):
+        self.name = ''
+        self.color = 'DarkMagenta'
+        self.__lat = array('d')
+        self.__lon = array('d')
+        self.__ele = array('d')   #nan if None
+        self.__time = array('q')  #microseconds since epoch, or NO_TIME
+        self.__px = array('q')    #pixel of max level, computed lazily for the points added since the last access
+        self.__py = array('q')
+        self.__pixels = None      #TrackPixels, until the track is edited
+        self.__bounds = None      #extended as adding points, and computed again lazily if others are edited
+
+    # all the columns, with the pixels computed
+    def __columns(self):
+        n = len(self.__px)
+        if n < len(self.__lat):
+            pxs, pys = TileSystem.getPixcelXYByLatLonBatch(self.__lat[n:], self.__lon[n:], GeoPoint.MAX_LEVEL)
+            self.__px.extend(pxs)
+            self.__py.extend(pys)
+        return (self.__lat, self.__lon, self.__ele, self.__time, self.__px, self.__py)
+
+    # the values of the columns of @pt, except the pixels
+    def __toFields(self, pt):
+        ele = math.nan if pt.ele is None else pt.ele
+        if pt.time is None:
+            t = self.NO_TIME
+        else:
+            t = pt.time if pt.time.tzinfo is not None else pt.time.replace(tzinfo=pytz.utc)
+            t = (t - self.EPOCH) // self.US
+        return (pt.lat, pt.lon, ele, t)
+
+    def __toTime(self, t):
+        return None if t == self.NO_TIME else self.EPOCH + timedelta(microseconds=t)
+
+    def __toPoint(self, i):
+        self.__columns()
+        ele = self.__ele[i]
+        return TrackPointView(self.__lat[i], self.__lon[i], None if ele != ele else ele,
+                self.__toTime(self.__time[i]), self.__px[i], self.__py[i])
+
+    def __iter__(self):
+        to_time = self.__toTime
+        for lat, lon, ele, t, px, py in zip(*self.__columns()):
+            yield TrackPointView(lat, lon, None if ele != ele else ele, to_time(t), px, py)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.__toPoint(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("track point index out of range")
+        return self.__toPoint(idx)
+
+    def __setitem__(self, idx, val):
+        if isinstance(idx, slice):
+            fields = [self.__toFields(pt) + pt.pixel(GeoPoint.MAX_LEVEL) for pt in val]
+            for col, values in zip(self.__columns(), zip(*fields) if fields else [()] * 6):
+                col[idx] = array(col.typecode, values)
+        else:
+            fields = self.__toFields(val) + val.pixel(GeoPoint.MAX_LEVEL)
+            for col, value in zip(self.__columns(), fields):
+                col[idx] = value
+        self.__pixels = None
+        self.__bounds = None
 
+    def __delitem__(self, idx):
+        for col in self.__columns():
+            del col[idx]
+        self.__pixels = None
+        self.__bounds = None
+
+    def __len__(self):
+        return len(self.__lat)
+
+    def add(self, pt):
+        fields = self.__toFields(pt)
+        for col, value in zip((self.__lat, self.__lon, self.__ele, self.__time), fields):
+            col.append(value)
+        self.__pixels = None
+        if self.__bounds is not None:
+            self.__bounds = extendBounds(self.__bounds, fields[0], fields[1])
+
+    # (lats, lons, times) of the points, without copying the points
+    def getLatLonTimes(self):
+        to_time = self.__toTime
+        return (self.__lat, self.__lon, [to_time(t) for t in self.__time])
+
+    def getPixels(self):
+        if self.__pixels is None:
+            self.__columns()
+            self.__pixels = TrackPixels(self.__px, self.__py)
+        return self.__pixels
+
+    # remove the first point which has the same fields as @pt
+    def remove(self, pt):
+        lat, lon, ele, t = self.__toFields(pt)
+        for i in range(len(self)):
+            if self.__lat[i] == lat and self.__lon[i] == lon and self.__time[i] == t and \
+                    (self.__ele[i] == ele or (ele != ele and self.__ele[i] != self.__ele[i])):
+                del self[i]
+                return
+        raise ValueError("the point is not in the track")
+
+    # the track of the points [@start, @stop), which copies the arrays only
+    def __subTrack(self, start, stop):
+        trk = ColumnarTrack()
+        for col, sub_col in zip(self.__columns(), trk.__columns()):
+            sub_col.extend(col[start:stop])
+        return trk
+
+    def split(self, split_fn):
+        idxs = []
         last_pt = None
-        for pt in self.__trkseg:
-            #create new trk
-            if last_pt is None or split_fn(last_pt, pt):
-                trk=Track()
-                trk.name = "%s-%d" % (self.name, len(sp_trks)+1)
-                trk.color = self.color
-                sp_trks.append(trk)
-            #append trkpt
-            sp_trks[-1].add(pt)
-            #iterate
+        for i, pt in enumerate(self):
+            if last_pt is not None and split_fn(last_pt, pt):
+                idxs.append(i)
             last_pt = pt
-
+        return self.splitAt(idxs)
+
+    # split before the points of the ascending indices @idxs
+    def splitAt(self, idxs):
+        bounds = [0] + [i for i in idxs if 0 < i < len(self)] + [len(self)]
+        sp_trks = [self.__subTrack(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+        for i, trk in enumerate(sp_trks, 1):
+            trk.name = "%s-%d" % (self.name, i)
+            trk.color = self.color
         return sp_trks
 
+'''
+The pixels of the points of a track, for drawing.
+The flat pixels [x0, y0, x1, y1, ...] of a level are derived from the pixels of max level by shifting,
+and are simplified within the tolerance (in pixels), if any, so the points to draw are bounded by
+the resolution rather than the length of the track. They are kept for the recent levels,
+and the track drops its TrackPixels once edited.
+'''
+class TrackPixels:
+    MAX_LEVELS = 4     #the levels to keep
+
+    def __init__(self, pxs, pys):
+        if np is not None:
+            self.__pxs = np.array(pxs, dtype=np.int64)
+            self.__pys = np.array(pys, dtype=np.int64)
+        else:
+            self.__pxs = list(pxs)
+            self.__pys = list(pys)
+        self.__levels = OrderedDict()  #(level, tolerance) -> TrackLevelPixels
+
+    def __len__(self):
+        return len(self.__pxs)
+
+    def __getLevel(self, level, tolerance):
+        key = (level, tolerance)
+        lv = self.__levels.get(key)
+        if lv is not None:
+            self.__levels.move_to_end(key)
+            return lv
+
+        shift = GeoPoint.MAX_LEVEL - level
+        if np is not None:
+            xy = np.empty(2 * len(self.__pxs), dtype=np.int64)
+            xy[0::2] = self.__pxs >> shift
+            xy[1::2] = self.__pys >> shift
+        else:
+            xy = [0] * (2 * len(self.__pxs))
+            xy[0::2] = [px >> shift for px in self.__pxs]
+            xy[1::2] = [py >> shift for py in self.__pys]
+
+        lv = self.__levels[key] = TrackLevelPixels(xy, tolerance)
+        if len(self.__levels) > self.MAX_LEVELS:
+            self.__levels.popitem(last=False)
+        return lv
+
+    # the flat pixels of @level, as an int array if numpy is available, or a list
+    def getXY(self, level, tolerance=0):
+        return self.__getLevel(level, tolerance).getXY()
+
+    # the flat pixels of @level in the image whose left-top pixel is (@left, @top), as a list for ImageDraw
+    def getImageXY(self, level, left, top, tolerance=0):
+        xy = self.getXY(level, tolerance)
+        if np is not None:
+            return (xy.reshape(-1, 2) - (left, top)).ravel().tolist()
+
+        img_xy = [0] * len(xy)
+        img_xy[0::2] = [x - left for x in xy[0::2]]
+        img_xy[1::2] = [y - top for y in xy[1::2]]
+        return img_xy
+
+    # if any segment of @level crosses @rect (left, top, right, bottom), inclusive
+    def intersects(self, level, rect, tolerance=0):
+        return any(len(self.__hitSegments(xy, rect)) > 0
+                for xy in self.__getLevel(level, tolerance).genNearXYs(rect))
+
+    # the runs of the successive segments of @level which cross @rect (left, top, right, bottom), inclusive.
+    # each run is the flat pixels in the image whose left-top pixel is (@left, @top), as a list for ImageDraw.
+    def getImageRuns(self, level, rect, left, top, tolerance=0):
+        runs = []
+        for xy in self.__getLevel(level, tolerance).genNearXYs(rect):
+            segs = self.__hitSegments(xy, rect)
+            if len(segs) == 0:
+                continue
+
+            if np is not None:
+                breaks = np.flatnonzero(np.diff(segs) != 1)
+                starts = segs[np.r_[0, breaks + 1]]
+                ends = segs[np.r_[breaks, len(segs) - 1]] + 1  #the last point of the run
+                for start, end in zip(starts.tolist(), ends.tolist()):
+                    run = xy[2*start:2*end+2].reshape(-1, 2) - (left, top)
+                    runs.append(run.ravel().tolist())
+            else:
+                start = prev = segs[0]
+                for seg in segs[1:] + [None]:
+                    if seg != prev + 1:
+                        run = xy[2*start:2*prev+4]
+                        runs.append([v - (top if i % 2 else left) for i, v in enumerate(run)])
+                        start = seg
+                    prev = seg
+        return runs
+
+    # the indices of the segments of the flat pixels @xy which cross @rect, in order.
+    # a segment crosses the rect if their bounding boxes overlap, and the corners of the rect are not all
+    # on the same side of the segment, so the segment across the rect without any end in it is found as well.
+    @staticmethod
+    def __hitSegments(xy, rect):
+        left, top, right, bottom = rect
+
+        if np is None:
+            segs = []
+            for i in range(len(xy) // 2 - 1):
+                x1, y1, x2, y2 = xy[2*i:2*i+4]
+                if max(x1, x2) < left or min(x1, x2) > right or max(y1, y2) < top or min(y1, y2) > bottom:
+                    continue
+                dx, dy = x2 - x1, y2 - y1
+                sides = [dx * (cy - y1) - dy * (cx - x1) for cx in (left, right) for cy in (top, bottom)]
+                if not (all(side > 0 for side in sides) or all(side < 0 for side in sides)):
+                    segs.append(i)
+            return segs
+
+        x1, y1 = xy[0:-2:2].astype(np.float64), xy[1:-2:2].astype(np.float64)
+        x2, y2 = xy[2::2].astype(np.float64), xy[3::2].astype(np.float64)
+        hit = (np.maximum(x1, x2) >= left) & (np.minimum(x1, x2) <= right) & \
+              (np.maximum(y1, y2) >= top) & (np.minimum(y1, y2) <= bottom)
+        dx, dy = x2 - x1, y2 - y1
+        sides = [dx * (cy - y1) - dy * (cx - x1) for cx in (left, right) for cy in (top, bottom)]
+        above = (sides[0] > 0) & (sides[1] > 0) & (sides[2] > 0) & (sides[3] > 0)
+        below = (sides[0] < 0) & (sides[1] < 0) & (sides[2] < 0) & (sides[3] < 0)
+        return np.flatnonzero(hit & ~above & ~below)
+
+'''
+The flat pixels of a track at a level, for TrackPixels.
+The points are cut into the chunks of CHUNK segments, which share their end points, and the bounding box
+of each chunk is kept, so only the chunks near the view are tested for culling, and simplified.
+For the tolerance, the successive points on the same pixel are dropped first. If that leaves few of the
+points, i.e. the points are dense at the level, the chunks are simplified by Douglas-Peucker when needed;
+otherwise Douglas-Peucker costs more than drawing the points it would drop, and is skipped.
+'''
+class TrackLevelPixels:
+    CHUNK = 256        #the segments per chunk
+    DENSE_RATIO = 0.5  #the ratio of the points on distinct pixels to all, at most, to simplify
+
+    def __init__(self, xy, tolerance):
+        n = len(xy) // 2
+        if tolerance > 0:
+            xy = self.__dropSamePixels(xy)
+        self.__xy = xy
+        self.__tolerance = tolerance
+        self.__boxes = None  #(lefts, tops, rights, bottoms) of the chunks
+
+        #the points kept by the simplified chunks
+        self.__keep = None
+        if tolerance > 0 and 2 < len(self) <= n * self.DENSE_RATIO:
+            self.__keep = np.zeros(len(self), dtype=bool) if np is not None else [False] * len(self)
+            self.__simplified = [False] * self.__chunks()
+
+    def __len__(self):
+        return len(self.__xy) // 2
+
+    def __chunks(self):
+        return max(len(self) - 2, 0) // self.CHUNK + 1
+
+    # the first and the last points of the chunks [@start, @stop)
+    def __pointRange(self, start, stop):
+        return start * self.CHUNK, min(stop * self.CHUNK, len(self) - 1)
+
+    @staticmethod
+    def __dropSamePixels(xy):
+        if np is not None:
+            xys = xy.reshape(-1, 2)
+            keep = np.ones(len(xys), dtype=bool)
+            keep[1:] = (xys[1:] != xys[:-1]).any(axis=1)
+            return xys[keep].ravel()
+
+        pts = []
+        for pt in zip(xy[0::2], xy[1::2]):
+            if not pts or pts[-1] != pt:
+                pts.append(pt)
+        return [v for pt in pts for v in pt]
+
+    # simplify the chunks [@start, @stop) which are not yet
+    def __simplify(self, start, stop):
+        i = start
+        while i < stop:
+            if self.__simplified[i]:
+                i += 1
+                continue
+            j = i + 1
+            while j < stop and not self.__simplified[j]:
+                j += 1
+
+            first, last = self.__pointRange(i, j)
+            xy = self.__xy[2*first:2*last+2]
+            if np is not None:
+                self.__keep[first:last+1] = self.__simplifyArray(xy, self.__tolerance)
+            else:
+                self.__keep[first:last+1] = self.__simplifyList(xy, self.__tolerance)
+            self.__simplified[i:j] = [True] * (j - i)
+            i = j
+
+    # the points [@first, @last] kept
+    def __keptXY(self, first, last):
+        xy = self.__xy[2*first:2*last+2]
+        if self.__keep is None:
+            return xy
+        keep = self.__keep[first:last+1]
+        if np is not None:
+            return xy.reshape(-1, 2)[keep].ravel()
+        return [v for x, y, kept in zip(xy[0::2], xy[1::2], keep) if kept for v in (x, y)]
+
+    def getXY(self):
+        if self.__keep is None:
+            return self.__xy
+        self.__simplify(0, self.__chunks())
+        return self.__keptXY(0, len(self) - 1)
+
+    # generate the flat pixels of the successive chunks near @rect, at least two points each,
+    # where the only point of the track (if so) is taken as a segment of zero length.
+    # without numpy, all the points are taken as near.
+    def genNearXYs(self, rect):
+        if len(self) == 0:
+            return
+        if len(self) == 1:
+            yield self.__xy * 2 if np is None else np.tile(self.__xy, 2)
+            return
+        if np is None:
+            yield self.getXY()
+            return
+
+        left, top, right, bottom = rect
+        lefts, tops, rights, bottoms = self.__getBoxes()
+        chunks = np.flatnonzero((lefts <= right) & (rights >= left) & (tops <= bottom) & (bottoms >= top))
+        if len(chunks) == 0:
+            return
+
+        breaks = np.flatnonzero(np.diff(chunks) != 1)
+        starts = chunks[np.r_[0, breaks + 1]]
+        stops = chunks[np.r_[breaks, len(chunks) - 1]] + 1
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            if self.__keep is not None:
+                self.__simplify(start, stop)
+            yield self.__keptXY(*self.__pointRange(start, stop))
+
+    # the bounding boxes of the chunks, which cover the simplified chunks as well
+    def __getBoxes(self):
+        if self.__boxes is None:
+            xs, ys = self.__xy[0::2], self.__xy[1::2]
+            starts = np.arange(0, self.__chunks()) * self.CHUNK
+            boxes = []
+            for vs in (xs, ys):
+                mins = np.minimum.reduceat(vs, starts)
+                maxs = np.maximum.reduceat(vs, starts)
+                #the last point of a chunk is the first point of the next one
+                mins[:-1] = np.minimum(mins[:-1], vs[starts[1:]])
+                maxs[:-1] = np.maximum(maxs[:-1], vs[starts[1:]])
+                boxes.append((mins, maxs))
+            (lefts, rights), (tops, bottoms) = boxes
+            self.__boxes = (lefts, tops, rights, bottoms)
+        return self.__boxes
+
+    # the mask of the points of @xy kept by Douglas-Peucker within @tolerance, where the chunks are simplified alone.
+    # it is by the distance to the segment rather than the line, for the tracks turning back;
+    # and all the segments of a depth are split at once, rather than recursively one by one.
+    @classmethod
+    def __simplifyArray(cls, xy, tolerance):
+        xs = xy[0::2].astype(np.float64)
+        ys = xy[1::2].astype(np.float64)
+        n = len(xs)
+        keep = np.zeros(n, dtype=bool)
+        keep[::cls.CHUNK] = True
+        keep[-1] = True
+
+        tolerance2 = tolerance * tolerance
+        active = np.flatnonzero(~keep)  #the points not decided, in order
+        while len(active):
+            kept = np.flatnonzero(keep)
+            seg = np.searchsorted(kept, active, side='right') - 1  #the segment which each point is in
+            a, b = kept[seg], kept[seg + 1]
+            ax, ay = xs[a], ys[a]
+            dx, dy = xs[b] - ax, ys[b] - ay
+            vx, vy = xs[active] - ax, ys[active] - ay
+            len2 = dx * dx + dy * dy
+            t = np.clip((vx * dx + vy * dy) / np.where(len2 > 0, len2, 1), 0.0, 1.0)
+            vx -= t * dx
+            vy -= t * dy
+            dist2 = vx * vx + vy * vy
+
+            #the max distance of each segment, and its first point
+            starts = np.flatnonzero(np.r_[True, seg[1:] != seg[:-1]])
+            seg_max = np.repeat(np.maximum.reduceat(dist2, starts), np.diff(np.r_[starts, len(seg)]))
+            split = seg_max > tolerance2
+            maxs = np.flatnonzero(split & (dist2 == seg_max))
+            if len(maxs) == 0:
+                break
+            firsts = maxs[np.r_[True, seg[maxs][1:] != seg[maxs][:-1]]]
+            keep[active[firsts]] = True
+
+            split[firsts] = False
+            active = active[split]
+
+        return keep
+
+    @classmethod
+    def __simplifyList(cls, xy, tolerance):
+        pts = list(zip(xy[0::2], xy[1::2]))
+        n = len(pts)
+        keep = [False] * n
+        keep[::cls.CHUNK] = [True] * len(keep[::cls.CHUNK])
+        keep[-1] = True
+
+        tolerance2 = tolerance * tolerance
+        kept = [i for i in range(n) if keep[i]]
+        stack = list(zip(kept, kept[1:]))
+        while stack:
+            i, j = stack.pop()
+            if j - i < 2:
+                continue
+            ax, ay = pts[i]
+            dx, dy = pts[j][0] - ax, pts[j][1] - ay
+            len2 = dx * dx + dy * dy
+            max_dist2, max_k = -1, None
+            for k in range(i + 1, j):
+                vx, vy = pts[k][0] - ax, pts[k][1] - ay
+                if len2 > 0:
+                    t = min(max((vx * dx + vy * dy) / len2, 0.0), 1.0)
+                    vx, vy = vx - t * dx, vy - t * dy
+                dist2 = vx * vx + vy * vy
+                if dist2 > max_dist2:
+                    max_dist2, max_k = dist2, k
+            if max_dist2 > tolerance2:
+                keep[max_k] = True
+                stack.append((i, max_k))
+                stack.append((max_k, j))
+
+        return keep
+
 class TrackPoint(GeoPoint):
     #property lat
     #property lon
@@ -400,6 +962,23 @@ class TrackPoint(GeoPoint):
         self.ele = 0.0
         self.time = None
 
+'''
+The point copied from ColumnarTrack, whose pixel of max level is from the track.
+'''
+class TrackPointView(TrackPoint):
+    def __init__(self, lat, lon, ele, time, px, py):
+        super().__init__(lat, lon)
+        self.ele = ele
+        self.time = time
+        self.__px = px
+        self.__py = py
+
+    def px(self, level):
+        return self.__px >> (self.MAX_LEVEL - level)
+
+    def py(self, level):
+        return self.__py >> (self.MAX_LEVEL - level)
+
 class WayPoint(TrackPoint):
     def __init__(self, lat, lon):
         super().__init__(lat, lon)
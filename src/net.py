@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+""" network helpers for downloading tiles """
+
+import ssl
+import asyncio
+import logging
+import http.client
+from urllib.parse import urlsplit, urljoin
+from threading import Thread, Lock, Condition
+
+class HttpError(Exception):
+    def __init__(self, status, reason, url):
+        super().__init__("HTTP %d %s: %s" % (status, reason, url))
+        self.status = status
+        self.reason = reason
+        self.url = url
+
+#return (key, host header, path) of the url
+def splitUrl(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise ValueError("not support url scheme '%s': %s" % (scheme, url))
+    default_port = 443 if scheme == 'https' else 80
+    port = parts.port or default_port
+    key = (scheme, parts.hostname, port)
+    host = parts.hostname if port == default_port else "%s:%d" % (parts.hostname, port)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return key, host, path
+
+'''
+The http client keeping persistent(keep-alive) connections, pooled by host.
+One pool can be shared by all the tile agents, so that the requests to the same host reuse the sockets.
+'''
+class HttpPool:
+    MAX_REDIRECTS = 5
+
+    #the errors that a kept-alive connection is closed by the server
+    STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+    @property
+    def max_conns_per_host(self): return self.__max_conns
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return {'requests': self.__requests,
+                    'created': self.__created,
+                    'reused': self.__reused,
+                    'idle': sum(len(conns) for conns in self.__idle.values())}
+
+    def __init__(self, max_conns_per_host=4, timeout=30):
+        self.__max_conns = max_conns_per_host
+        self.__timeout = timeout
+        self.__ssl_ctx = None
+
+        self.__lock = Lock()
+        self.__cv = Condition(self.__lock)
+        self.__idle = {}    #host key -> idle connections
+        self.__busy = {}    #host key -> number of connections in use
+        self.__is_closed = False
+
+        #counters
+        self.__requests = 0
+        self.__created = 0
+        self.__reused = 0
+
+    def close(self):
+        with self.__cv:
+            self.__is_closed = True
+            for conns in self.__idle.values():
+                for conn in conns:
+                    conn.close()
+            self.__idle.clear()
+            self.__cv.notify_all()
+
+    def __newConn(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            if self.__ssl_ctx is None:
+                self.__ssl_ctx = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, timeout=self.__timeout, context=self.__ssl_ctx)
+        else:
+            return http.client.HTTPConnection(host, port, timeout=self.__timeout)
+
+    #return (conn, is_reused)
+    def __acquire(self, key):
+        with self.__cv:
+            while True:
+                if self.__is_closed:
+                    raise RuntimeError("http pool is closed")
+
+                idle = self.__idle.get(key)
+                if idle:
+                    self.__busy[key] = self.__busy.get(key, 0) + 1
+                    self.__reused += 1
+                    return idle.pop(), True
+
+                if self.__busy.get(key, 0) < self.__max_conns:
+                    self.__busy[key] = self.__busy.get(key, 0) + 1
+                    self.__created += 1
+                    break
+
+                self.__cv.wait()
+
+        return self.__newConn(key), False
+
+    def __release(self, key, conn, reusable):
+        with self.__cv:
+            self.__busy[key] -= 1
+            if reusable and not self.__is_closed:
+                self.__idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+            self.__cv.notify()
+
+    def __request(self, key, path, headers, timeout):
+        while True:
+            conn, is_reused = self.__acquire(key)
+            reusable = False
+            try:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request('GET', path, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+                reusable = not res.will_close
+                return res.status, res.reason, res.getheader('Location'), data
+            except self.STALE_ERRORS as ex:
+                if not is_reused:
+                    raise ex
+                logging.debug("http connection to %s:%s is stale, reconnect" % key[1:])  #retry by a new one
+            finally:
+                self.__release(key, conn, reusable)
+
+    def get(self, url, headers=None, timeout=None):
+        if timeout is None:
+            timeout = self.__timeout
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            key, host, path = splitUrl(url)
+
+            with self.__lock:
+                self.__requests += 1
+
+            status, reason, location, data = self.__request(key, path, headers or {}, timeout)
+
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if status != 200:
+                raise HttpError(status, reason, url)
+            return data
+
+        raise HttpError(status, "Too many redirects", url)
+
+'''
+The asyncio http client, whose event loop runs in one background thread.
+Hundreds of requests can be in flight, while the connections to a host are limited by @max_conns_per_host,
+and kept alive to be reused. A request is retried with exponential backoff on network errors,
+timeouts, or the server errors (5xx).
+Requests are submitted from any thread by submit(), which returns a concurrent.futures.Future.
+'''
+class AsyncHttpEngine:
+    MAX_REDIRECTS = 5
+    RETRY_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    @property
+    def max_conns_per_host(self): return self.__max_conns
+
+    @property
+    def stats(self):
+        return {'requests': self.__requests,
+                'created': self.__created,
+                'reused': self.__reused,
+                'retries': self.__retries_count,
+                'in_flight': self.__in_flight}
+
+    def __init__(self, max_conns_per_host=8, timeout=30, retries=2, backoff=0.5):
+        self.__max_conns = max_conns_per_host
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__ssl_ctx = None
+
+        self.__loop = None
+        self.__thread = None
+        self.__start_lock = Lock()
+
+        #only accessed in the loop thread
+        self.__idle = {}    #host key -> idle (reader, writer)
+        self.__sems = {}    #host key -> semaphore to limit connections
+
+        #counters, only updated in the loop thread
+        self.__requests = 0
+        self.__created = 0
+        self.__reused = 0
+        self.__retries_count = 0
+        self.__in_flight = 0
+
+    def start(self):
+        with self.__start_lock:
+            if self.__thread is not None:
+                return
+            self.__loop = asyncio.new_event_loop()
+            self.__thread = Thread(name="http-async", target=self.__runLoop, daemon=True)
+            self.__thread.start()
+
+    def close(self):
+        with self.__start_lock:
+            if self.__thread is None:
+                return
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__thread = None
+            self.__loop = None
+
+    def __runLoop(self):
+        loop = self.__loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            #cancel the pending requests, and close the connections
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            for conns in self.__idle.values():
+                for reader, writer in conns:
+                    writer.close()
+            self.__idle.clear()
+            loop.close()
+
+    # Submit the request from any thread, and return a concurrent.futures.Future of the data
+    def submit(self, url, headers=None, timeout=None):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.get(url, headers, timeout), self.__loop)
+
+    # The coroutine to get the data of @url, raise HttpError if the status is not 200.
+    async def get(self, url, headers=None, timeout=None):
+        if timeout is None:
+            timeout = self.__timeout
+
+        self.__in_flight += 1
+        try:
+            for i in range(self.MAX_REDIRECTS + 1):
+                key, host, path = splitUrl(url)
+                self.__requests += 1
+                status, reason, res_headers, data = await self.__requestWithRetry(key, host, path, headers or {}, timeout)
+
+                if status in (301, 302, 303, 307, 308) and 'location' in res_headers:
+                    url = urljoin(url, res_headers['location'])
+                    continue
+                if status != 200:
+                    raise HttpError(status, reason, url)
+                return data
+
+            raise HttpError(status, "Too many redirects", url)
+        finally:
+            self.__in_flight -= 1
+
+    async def __requestWithRetry(self, key, host, path, headers, timeout):
+        for attempt in range(self.__retries + 1):
+            if attempt:
+                self.__retries_count += 1
+                await asyncio.sleep(self.__backoff * (2 ** (attempt-1)))
+            try:
+                res = await self.__request(key, host, path, headers, timeout)
+            except self.RETRY_ERRORS as ex:
+                if attempt == self.__retries:
+                    raise
+                logging.debug("request %s%s error: %s, retry" % (host, path, str(ex)))
+                continue
+
+            status = res[0]
+            if status in self.RETRY_STATUS and attempt < self.__retries:
+                logging.debug("request %s%s status: %d, retry" % (host, path, status))
+                continue
+            return res
+
+    async def __request(self, key, host, path, headers, timeout):
+        sem = self.__sems.get(key)
+        if sem is None:
+            sem = self.__sems[key] = asyncio.Semaphore(self.__max_conns)
+
+        async with sem:
+            while True:
+                (reader, writer), is_reused = await self.__acquire(key, timeout)
+                try:
+                    status, reason, res_headers, data, reusable = \
+                        await asyncio.wait_for(self.__exchange(reader, writer, host, path, headers), timeout)
+                except (ConnectionError, EOFError) as ex:
+                    writer.close()
+                    if not is_reused:
+                        raise
+                    logging.debug("http connection to %s:%s is stale, reconnect" % key[1:])  #retry by a new one
+                    continue
+                except BaseException:
+                    writer.close()
+                    raise
+
+                if reusable:
+                    self.__idle.setdefault(key, []).append((reader, writer))
+                else:
+                    writer.close()
+                return status, reason, res_headers, data
+
+    #return ((reader, writer), is_reused)
+    async def __acquire(self, key, timeout):
+        idle = self.__idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.__reused += 1
+                return (reader, writer), True
+            writer.close()
+
+        scheme, hostname, port = key
+        ssl_ctx = None
+        if scheme == 'https':
+            if self.__ssl_ctx is None:
+                self.__ssl_ctx = ssl.create_default_context()
+            ssl_ctx = self.__ssl_ctx
+
+        conn = await asyncio.wait_for(asyncio.open_connection(hostname, port, ssl=ssl_ctx), timeout)
+        self.__created += 1
+        return conn, False
+
+    #return (status, reason, headers, data, reusable)
+    async def __exchange(self, reader, writer, host, path, headers):
+        lines = ["GET %s HTTP/1.1" % (path,),
+                 "Host: %s" % (host,),
+                 "Connection: keep-alive",
+                 "Accept-Encoding: identity"]
+        lines.extend("%s: %s" % (k, v) for k, v in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+
+        #status line
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by the server")
+        tokens = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(tokens) < 2 or not tokens[0].startswith('HTTP/'):
+            raise ConnectionError("bad status line: %r" % (line,))
+        version = tokens[0]
+        status = int(tokens[1])
+        reason = tokens[2] if len(tokens) > 2 else ''
+
+        #headers
+        res_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise EOFError("connection closed in headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            res_headers[name.strip().lower()] = value.strip()
+
+        #body
+        reusable = (version == 'HTTP/1.1') and res_headers.get('connection', '').lower() != 'close'
+        if status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif 'chunked' in res_headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):  #trailers
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)  #CRLF
+            data = b''.join(chunks)
+        elif 'content-length' in res_headers:
+            data = await reader.readexactly(int(res_headers['content-length']))
+        else:
+            data = await reader.read()  #till the connection is closed
+            reusable = False
+
+        return status, reason, res_headers, data, reusable
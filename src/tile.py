@@ -6,26 +6,30 @@
 import os
 import math
 import tkinter as tk
-from urllib.request import Request, urlopen
 import shutil
 import sqlite3
 import logging
-import random
+import itertools
+import heapq
 import time
+import hashlib
+import weakref
 from xml.etree import ElementTree as ET
 from datetime import datetime, timedelta
 from os import listdir
 from os.path import isdir, isfile, exists
 from PIL import Image, ImageTk, ImageDraw, ImageTk
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock, Condition, Event, BoundedSemaphore
 from math import tan, sin, cos, radians, degrees
 from collections import OrderedDict
 from io import BytesIO
+from urllib.request import pathname2url
 
 import src.coord as coord
 import src.conf as conf
 import src.util as util
 from src.util import mkdirSafely, saveXml
+from src.net import HttpPool, AsyncHttpEngine
 
 to_pixel = coord.TileSystem.getPixcelXYByTileXY
 to_tile = coord.TileSystem.getTileXYByPixcelXY
@@ -38,6 +42,7 @@ class MapDescriptor:
         #set default value
         self.enabled = False
         self.alpha = 1.00
+        self.max_downloads = 0  #0 means to use the app setting
 
     def save(self, dirpath, id=None):
         root = ET.Element("customMapSource")
@@ -88,6 +93,10 @@ class MapDescriptor:
             expire = ET.SubElement(root, "expireDays")
             expire.text = exp_text
 
+        if self.max_downloads:
+            max_downloads = ET.SubElement(root, "maxDownloads")
+            max_downloads.text = str(self.max_downloads)
+
         #write to file
         filename = id if id else self.map_id
         filepath = os.path.join(dirpath, filename) + ".xml"
@@ -107,6 +116,7 @@ class MapDescriptor:
         desc.lower_corner = self.lower_corner
         desc.upper_corner = self.upper_corner
         desc.expire_sec = self.expire_sec
+        desc.max_downloads = self.max_downloads
         desc.alpha = self.alpha
         desc.enabled = self.enabled
         return desc
@@ -195,6 +205,9 @@ class MapDescriptor:
         expire_days = cls.__getElemText(xml_root, "./expireDays", "0")
         expire_sec = cls.__parseExpireDays(expire_days, id)
 
+        max_downloads = int(cls.__getElemText(xml_root, "./maxDownloads", "0"))
+        max_downloads = cls.__cropValue(max_downloads, 0, 32, "[map desc '%s'] max downloads should be in 0~32" % (id,))
+
         #collection data
         desc = MapDescriptor()
         desc.map_id = id
@@ -208,6 +221,7 @@ class MapDescriptor:
         desc.lower_corner = lower_corner
         desc.upper_corner = upper_corner
         desc.expire_sec = expire_sec
+        desc.max_downloads = max_downloads
         desc.tile_format = tile_type
         return desc
 
@@ -230,6 +244,296 @@ class MapDescriptor:
         return []
 
 
+class MemoryBudget:
+    '''
+    The byte budget shared by a group of MemoryCache, e.g. the caches of all the maps.
+    If the total bytes exceed the budget, the largest caches are shrunk first.
+    '''
+    @property
+    def used_bytes(self): return self.__used_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.__used_bytes = 0
+        self.__used_lock = Lock()
+        self.__reclaim_lock = Lock()  #only one reclaimer at a time
+        self.__caches = weakref.WeakSet()
+
+    def register(self, cache):
+        self.__caches.add(cache)
+
+    def charge(self, nbytes):
+        with self.__used_lock:
+            self.__used_bytes += nbytes
+
+    def isOver(self):
+        return self.max_bytes > 0 and self.__used_bytes > self.max_bytes
+
+    #NOTICE: do not call this while holding the lock of any cache
+    def reclaim(self):
+        if not self.isOver():
+            return
+        with self.__reclaim_lock:
+            caches = sorted(self.__caches, key=lambda c: c.used_bytes, reverse=True)
+            for cache in caches:
+                if not self.isOver():
+                    break
+                cache.shrink(self.__used_bytes - self.max_bytes)
+
+class MemoryCache:
+    '''
+    class Item:
+        self.__init__(data=None, status=None, timestamp=None):
+        self.data = data
+        self.status = status
+        self.timestamp = timestamp
+
+    The items are kept in LRU order, and evicted if the cache exceeds @max_bytes,
+    or the shared @budget is exhausted. The item whose status is pinned (by @is_pinned) is never evicted.
+    '''
+    ITEM_OVERHEAD = 128  #approximate bytes of an item without data
+
+    @property
+    def is_concurrency(self):
+        return self.__repo_lock is not None
+
+    @property
+    def used_bytes(self): return self.__used_bytes
+
+    @property
+    def max_bytes(self): return self.__max_bytes
+
+    @property
+    def stats(self):
+        return {'items': len(self.__repo),
+                'bytes': self.__used_bytes,
+                'max_bytes': self.__max_bytes,
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions}
+
+    def __init__(self, init_status, is_concurrency=False, max_bytes=0, budget=None, is_pinned=None):
+        self.__init_status = init_status
+        self.__repo = OrderedDict()   #id -> (data, status, timestamp, nbytes)
+        self.__repo_lock = Lock() if is_concurrency else None
+
+        #bound
+        self.__max_bytes = max_bytes  #0 means unlimited
+        self.__used_bytes = 0
+        self.__budget = budget
+        self.__is_pinned = is_pinned
+        if budget is not None:
+            budget.register(self)
+
+        #counters
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    @classmethod
+    def sizeOf(cls, data):
+        if data is None:
+            return cls.ITEM_OVERHEAD
+        if getattr(data, 'fill_color', None) is not None:
+            return cls.ITEM_OVERHEAD  #the shared uniform tile, which is not owned by the cache
+        if isinstance(data, Image.Image):
+            w, h = data.size
+            return cls.ITEM_OVERHEAD + w * h * len(data.getbands())
+        if isinstance(data, (bytes, bytearray)):
+            return cls.ITEM_OVERHEAD + len(data)
+        return cls.ITEM_OVERHEAD
+
+    def __charge(self, nbytes):
+        self.__used_bytes += nbytes
+        if self.__budget is not None:
+            self.__budget.charge(nbytes)
+
+    def __put(self, id, item):
+        old = self.__repo.pop(id, None)
+        if old is not None:
+            self.__charge(-old[3])
+        self.__repo[id] = item
+        self.__charge(item[3])
+
+    #evict LRU items until the used bytes is not over @limit
+    def __evict(self, limit):
+        scan = len(self.__repo)
+        while self.__used_bytes > limit and scan > 0:
+            scan -= 1
+            id, item = next(iter(self.__repo.items()))
+            if self.__is_pinned is not None and self.__is_pinned(item[1]):
+                self.__repo.move_to_end(id)  #in use, skip it
+                continue
+            del self.__repo[id]
+            self.__charge(-item[3])
+            self.__evictions += 1
+
+    def __set(self, id, status, data):
+        if data is None:      #using old data
+            item = self.__repo.get(id)
+            if item is not None:
+                data = item[0]
+        self.__put(id, (data, status, time.time(), self.sizeOf(data)))
+        if self.__max_bytes > 0:
+            self.__evict(self.__max_bytes)
+
+    def __get(self, id):
+        item = self.__repo.get(id)
+        if item is None:
+            self.__misses += 1
+            item = (None, self.__init_status, time.time(), self.sizeOf(None))
+            self.__put(id, item)
+        else:
+            if item[0] is not None:
+                self.__hits += 1
+            else:
+                self.__misses += 1
+            self.__repo.move_to_end(id)
+        return item[:3]
+
+    def __shrink(self, nbytes):
+        self.__evict(max(0, self.__used_bytes - nbytes))
+
+    def __remove(self, id):
+        item = self.__repo.pop(id, None)
+        if item is not None:
+            self.__charge(-item[3])
+
+    def set(self, id, status, data=None):
+        if self.is_concurrency:
+            with self.__repo_lock:
+                self.__set(id, status, data)
+        else:
+            self.__set(id, status, data)
+
+        if self.__budget is not None:
+            self.__budget.reclaim()
+
+    def get(self, id):
+        if self.is_concurrency:
+            with self.__repo_lock:
+                return self.__get(id)
+        else:
+            return self.__get(id)
+
+    #the status of the item, without counting or touching the LRU order
+    def getStatus(self, id):
+        if self.is_concurrency:
+            with self.__repo_lock:
+                item = self.__repo.get(id)
+        else:
+            item = self.__repo.get(id)
+        return self.__init_status if item is None else item[1]
+
+    def remove(self, id):
+        if self.is_concurrency:
+            with self.__repo_lock:
+                self.__remove(id)
+        else:
+            self.__remove(id)
+
+    #free at least @nbytes, if possible
+    def shrink(self, nbytes):
+        if self.is_concurrency:
+            with self.__repo_lock:
+                self.__shrink(nbytes)
+        else:
+            self.__shrink(nbytes)
+
+'''
+The pending download requests, served by the priority.
+The priority is the distance (in tiles) to the center of the focus area,
+so that the tiles in the viewport are downloaded first, and the tiles scrolled off-screen can be cancelled.
+'''
+class TileReqQueue:
+    LEVEL_WEIGHT = 8  #a level difference costs as much as the distance of 8 tiles
+    PREFETCH_WEIGHT = 1 << 20  #the prefetch requests are after all the others
+
+    def __init__(self):
+        self.__heap = []   #(priority, seq, id)
+        self.__reqs = {}   #id -> (req, seq, is_prefetch)
+        self.__seq = 0
+        self.__focus = None  #(level, center_x, center_y, bounds)
+
+    def __len__(self):
+        return len(self.__reqs)
+
+    def __contains__(self, id):
+        return id in self.__reqs
+
+    def isPrefetch(self, id):
+        item = self.__reqs.get(id)
+        return item is not None and item[2]
+
+    def get(self, id):
+        item = self.__reqs.get(id)
+        return None if item is None else item[0]
+
+    def priority(self, level, x, y, seq=0, is_prefetch=False):
+        weight = self.PREFETCH_WEIGHT if is_prefetch else 0
+        if self.__focus is None:
+            return weight - seq  #LIFO
+        f_level, cx, cy, bounds = self.__focus
+        scale = 2 ** (level - f_level)
+        dx = x + 0.5 - cx * scale
+        dy = y + 0.5 - cy * scale
+        return weight + math.sqrt(dx*dx + dy*dy) + abs(level - f_level) * self.LEVEL_WEIGHT
+
+    #push the req, or replace the req of the same id
+    def push(self, id, req, is_prefetch=False):
+        self.__seq += 1
+        level, x, y = req[:3]
+        self.__reqs[id] = (req, self.__seq, is_prefetch)
+        heapq.heappush(self.__heap, (self.priority(level, x, y, self.__seq, is_prefetch), self.__seq, id))
+
+    #return (id, req)
+    def pop(self):
+        while self.__heap:
+            prio, seq, id = heapq.heappop(self.__heap)
+            item = self.__reqs.get(id)
+            if item is not None and item[1] == seq:  #skip the stale entry
+                del self.__reqs[id]
+                return id, item[0]
+        raise IndexError("pop from empty queue")
+
+    #the bounds of tiles scaled by the level difference @diff
+    @staticmethod
+    def scaleBounds(bounds, diff):
+        t_left, t_upper, t_right, t_lower = bounds
+        if diff >= 0:
+            return (t_left << diff, t_upper << diff, ((t_right + 1) << diff) - 1, ((t_lower + 1) << diff) - 1)
+        return (t_left >> -diff, t_upper >> -diff, t_right >> -diff, t_lower >> -diff)
+
+    #the prefetch requests of the adjacent levels are in focus if they are in the area scaled to the level
+    def isInFocus(self, level, x, y, margin=0, is_prefetch=False):
+        if self.__focus is None:
+            return True
+        f_level, cx, cy, bounds = self.__focus
+        diff = level - f_level
+        if diff != 0 and not (is_prefetch and abs(diff) == 1):
+            return False
+        t_left, t_upper, t_right, t_lower = self.scaleBounds(bounds, diff)
+        return (t_left - margin) <= x <= (t_right + margin) and \
+               (t_upper - margin) <= y <= (t_lower + margin)
+
+    #set the focus area, re-prioritize the requests, and return the requests out of the area (with the margin)
+    def setFocus(self, level, bounds, margin=0):
+        t_left, t_upper, t_right, t_lower = bounds
+        cx = (t_left + t_right + 1) / 2
+        cy = (t_upper + t_lower + 1) / 2
+        self.__focus = (level, cx, cy, bounds)
+
+        dropped = []
+        for id, (req, seq, is_prefetch) in list(self.__reqs.items()):
+            if not self.isInFocus(req[0], req[1], req[2], margin, is_prefetch):
+                del self.__reqs[id]
+                dropped.append((id, req))
+
+        self.__heap = [(self.priority(req[0], req[1], req[2], seq, is_prefetch), seq, id)
+                for id, (req, seq, is_prefetch) in self.__reqs.items()]
+        heapq.heapify(self.__heap)
+        return dropped
+
 '''
 The agent for getting tiles, using memory cache and db to be efficient.
 '''
@@ -246,6 +550,23 @@ class TileAgent:
     TILE_REQ         = 0x10
     TILE_REQ_FAILED  = 0x20
 
+    #memory budget of decoded tiles, shared by all the agents
+    mem_budget = MemoryBudget(conf.TILE_MEM_TOTAL_MB * 1024 * 1024)
+
+    #keep-alive connections, shared by all the agents
+    http_pool = HttpPool(conf.TILE_HTTP_CONNS_PER_HOST)
+    async_engine = None   #for the 'async' download backend, see getAsyncEngine()
+    async_engine_lock = Lock()
+
+    HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
+    MAX_PREFETCHED = 4096  #the prefetched tiles to trace the hit rate
+
+    #the images of the uniform tiles, shared by all the agents, RGBA -> image in LRU order
+    uniform_tiles = OrderedDict()
+    uniform_tiles_lock = Lock()
+    MAX_UNIFORM_TILES = 256
+
     #properties from map_desc
     @property
     def map_id(self): return self.__map_desc.map_id
@@ -284,20 +605,46 @@ class TileAgent:
         self.__cache_dir = cache_dir
         self.__disk_cache = None
 
+        #round-robin server parts
+        self.__server_parts = itertools.cycle(self.server_parts) if self.server_parts else None
+
         #memory cache
-        self.__mem_cache = MemoryCache(self.TILE_NOT_IN_MEM, is_concurrency=True)
+        self.__mem_cache = MemoryCache(self.TILE_NOT_IN_MEM, is_concurrency=True,
+                max_bytes=conf.TILE_MEM_CACHE_MB * 1024 * 1024,
+                budget=self.mem_budget,
+                is_pinned=self.isReqStatus)
+
+        #fake tiles generated from the tiles of other levels
+        self.__fake_cache = MemoryCache(None, is_concurrency=True,
+                max_bytes=conf.TILE_FAKE_CACHE_MB * 1024 * 1024,
+                budget=self.mem_budget)
+        self.__fake_levels = set()  #the levels which have ever had fake tiles, to skip invalidating the others
 
         #download helpers
-        self.__MAX_WORKS = 3
         self.__download_lock = Lock()
         self.__download_cv = Condition(self.__download_lock)
-        self.__workers = {}
-        #self.__workers_lock = Lock()
-        #self.__workers_cv = Condition(self.__workers_lock)
-        self.__req_queue = OrderedDict()
-        #self.__req_lock = Lock()
-        #self.__req_cv = Condition(self.__req_lock)
-        self.__download_monitor = Thread(target=self.__runDownloadMonitor)
+        self.__req_queue = TileReqQueue()
+        self.__in_progress = {}      #id of the downloading tile -> cb
+        if conf.TILE_DL_BACKEND == "async":
+            #one dispatcher, and the requests in flight are limited by max works
+            self.__max_works = conf.TILE_DL_ASYNC_IN_FLIGHT
+            self.__fetched = []      #(id, req, tile_data) downloaded by the async engine
+            self.__futures = {}      #id -> future of the in-flight request
+            self.__workers = [Thread(name="%s-dl" % (map_desc.map_id,), target=self.__runDownloadDispatcher)]
+        else:
+            self.__max_works = map_desc.max_downloads or conf.TILE_DL_WORKERS
+            self.__workers = [Thread(name="%s-dl-%d" % (map_desc.map_id, i), target=self.__runDownloadWorker)
+                    for i in range(self.__max_works)]
+
+        #prefetch the tiles around the viewport, when downloads are idle
+        self.__prefetch_cv = Condition(self.__download_lock)
+        self.__prefetch_area = None  #(level, t_left, t_upper, t_right, t_lower)
+        self.__prefetch_ts = 0
+        self.__prefetched = OrderedDict()  #id of the prefetched but not used tiles
+        self.__prefetch_tiles = 0
+        self.__prefetch_reqs = 0
+        self.__prefetch_hits = 0
+        self.__prefetcher = Thread(name="%s-prefetch" % (map_desc.map_id,), target=self.__runPrefetcher)
 
         if auto_start:
             self.start()
@@ -306,16 +653,26 @@ class TileAgent:
         #create cache dir for the map
         self.__disk_cache = DBDiskCache(self.__cache_dir, self.__map_desc, conf.DB_SCHEMA)
         self.__disk_cache.start()
-        #start download thread
+        #start download workers
         self.__state = self.ST_RUN
-        self.__download_monitor.start()
+        for worker in self.__workers:
+            worker.start()
+        if conf.TILE_PREFETCH_MAX_TILES > 0:
+            self.__prefetcher.start()
 
     def close(self):
-        #notify download monitor to exit
+        #notify download workers to exit
         with self.__download_cv:
             self.__state = self.ST_CLOSING
-            self.__download_cv.notify()
-        self.__download_monitor.join()
+            self.__download_cv.notify_all()
+            self.__prefetch_cv.notify()
+        for worker in self.__workers + [self.__prefetcher]:
+            if worker.is_alive():
+                worker.join()
+
+        with self.__download_cv:
+            self.__state = self.ST_IDLE
+            logging.debug("[%s] status(idle), download workers closed" % (self.map_id,))
 
         #close resources
         if self.__disk_cache is not None:
@@ -326,14 +683,42 @@ class TileAgent:
             if self.__state == self.ST_RUN:
                 self.__state = self.ST_PAUSE
                 logging.debug("[%s] Change status from run to pause" % (self.map_id,))
-                self.__download_cv.notify()
+                self.__download_cv.notify_all()
 
     def resume(self):
         with self.__download_cv:
             if self.__state == self.ST_PAUSE:
                 self.__state = self.ST_RUN
                 logging.debug("[%s] Change status from pasue to run" % (self.map_id,))
-                self.__download_cv.notify()
+                self.__download_cv.notify_all()
+                self.__prefetch_cv.notify()
+
+    #the tile is requesting, which should be kept in memory
+    @classmethod
+    def isReqStatus(cls, status):
+        return (status & 0xF0) == cls.TILE_REQ
+
+    #the async engine is shared by all the agents, and created as needed
+    @classmethod
+    def getAsyncEngine(cls):
+        with cls.async_engine_lock:
+            if cls.async_engine is None:
+                cls.async_engine = AsyncHttpEngine(conf.TILE_HTTP_ASYNC_CONNS_PER_HOST)
+            return cls.async_engine
+
+    def getStats(self):
+        stats = {'mem': self.__mem_cache.stats,
+                 'fake': self.__fake_cache.stats,
+                 'http': self.http_pool.stats}
+        if self.__disk_cache is not None:
+            stats['disk'] = self.__disk_cache.stats
+        if self.async_engine is not None:
+            stats['http_async'] = self.async_engine.stats
+        stats['prefetch'] = {'tiles': self.__prefetch_tiles,
+                             'reqs': self.__prefetch_reqs,
+                             'hits': self.__prefetch_hits,
+                             'hit_rate': self.__prefetch_hits / (self.__prefetch_tiles + self.__prefetch_reqs or 1)}
+        return stats
 
     def isSupportedLevel(self, level):
         return self.level_min <= level and level <= self.level_max
@@ -354,8 +739,8 @@ class TileAgent:
 
         url = self.url_template;
 
-        if self.server_parts:
-            url = url.replace("{$serverpart}", random.choice(self.server_parts))
+        if self.__server_parts:
+            url = url.replace("{$serverpart}", next(self.__server_parts))
         url = url.replace("{$x}", str(x))
         url = url.replace("{$y}", str(y))
         url = url.replace("{$z}", str(level))
@@ -368,14 +753,18 @@ class TileAgent:
         tile_data = None
         try:
             url = self.genTileUrl(level, x, y)
-            req = Request(url, headers={'User-Agent': 'Mozilla/5.0'})
             logging.info("[%s] DL %s" % (self.map_id, url))
-            with urlopen(req, timeout=30) as response:
-                tile_data = response.read()
+            tile_data = self.http_pool.get(url, headers=self.HTTP_HEADERS, timeout=30)
             logging.info('[%s] DL %s [OK]' % (self.map_id, url))
         except Exception as ex:
             logging.warning('[%s] DL %s [FAILED][%s]' % (self.map_id, url, str(ex)))
 
+        return self.__saveTileData(id, req, tile_data)
+
+    #save the downloaded data to memory/disk, and return the tile image
+    def __saveTileData(self, id, req, tile_data):
+        level, x, y, status, cb = req  #unpack the req
+
         #as failed, and not save to memory/disk
         if self.__state == self.ST_CLOSING:
             return None
@@ -387,103 +776,192 @@ class TileAgent:
             return None
 
         #get tile_img, and save to memory
+        #decode it here to detect the uniform tile, which is saved with the color and not decoded again
         tile_img = None
         try:
             tile_img = Image.open(BytesIO(tile_data))
+            color = util.getUniformColor(tile_img)
+            if color is not None:
+                tile_img = self.getUniformTile(color)
             self.__mem_cache.set(id, self.TILE_VALID, tile_img)
         except Exception as ex:
             logging.error("[%s] Error to open tile data: %s" % (self.map_id, str(ex)))
             return None
+        self.__invalidateFakeTiles(level, x, y)
 
         #save tile_data to disk
         try:
-            self.__disk_cache.put(level, x, y, tile_data)
+            self.__disk_cache.put(level, x, y, tile_data, color=color)
         except Exception as ex:
             logging.error("[%s] Error to save tile data: %s" % (self.map_id, str(ex)))
 
         return tile_img
 
-    #The therad to download
-    def __runDownloadJob(self, id, req):
+    def __invokeCb(self, req, cb):
+        level, x, y = req[:3]
+        if cb is not None:
+            tile_info = (self.map_id, level, x, y)
+            try:
+                cb(tile_info)
+            except Exception as ex:
+                 logging.warning("[%s] Invoke cb of download tile error: %s" % (self.map_id, str(ex)))
+
+    #The thread to serve download requests
+    def __runDownloadWorker(self):
+        def has_job():
+            return self.__state == self.ST_CLOSING or \
+                   (self.__state == self.ST_RUN and len(self.__req_queue) > 0)
+
+        while True:
+            #wait for requests
+            with self.__download_cv:
+                self.__download_cv.wait_for(has_job)
+                if self.__state == self.ST_CLOSING:
+                    break
+                id, req = self.__req_queue.pop()
+                self.__in_progress[id] = req[4]
 
-        #do download
-        tile_img = self.__downloadTile(id, req)
+            #do download
+            tile_img = self.__downloadTile(id, req)
 
-        #the download is done
-        #(do this before thread exit, to ensure monitor is notified)
-        with self.__download_cv:
-            self.__workers.pop(id, None)
-            self.__download_cv.notify()
-            #premature done
-            if self.__state == self.ST_CLOSING:
-                return
+            #the download is done
+            with self.__download_cv:
+                cb = self.__in_progress.pop(id, None)
+                self.__notifyIfIdle()
+                #premature done
+                if self.__state == self.ST_CLOSING:
+                    break
 
-        #invoke cb. cb may be blocking, so do this AFTER removing the thread from __workers
-        if tile_img is not None:
-            level, x, y, status, cb = req  #unpack the req
-            if cb is not None:
-                tile_info = (self.map_id, level, x, y)
-                try:
-                    cb(tile_info)
-                except Exception as ex:
-                     logging.warning("[%s] Invoke cb of download tile error: %s" % (self.map_id, str(ex)))
+            #invoke cb. cb may be blocking, so do this AFTER the tile is out of progress
+            if tile_img is not None:
+                self.__invokeCb(req, cb)
 
-    #The thread to handle all download requests
-    def __runDownloadMonitor(self):
-        def no_worker():
-            return len(self.__workers) == 0
+        logging.debug("[%s] status(closing), download worker closing" % (self.map_id,))
 
-        #http_handler = urllib.request.HTTPHandler()
-        #opener = urllib.request.build_opener(http_handler)
-        #urllib.request.install_opener(opener)
+    #The thread to dispatch requests to the async engine, and to save the downloaded tiles
+    def __runDownloadDispatcher(self):
+        def has_job():
+            return self.__state == self.ST_CLOSING or self.__fetched or \
+                   (self.__state == self.ST_RUN and len(self.__req_queue) > 0 and
+                    len(self.__in_progress) < self.__max_works)
 
         while True:
-            #wait for requests
             with self.__download_cv:
-                self.__download_cv.wait()
-
+                self.__download_cv.wait_for(has_job)
                 if self.__state == self.ST_CLOSING:
-                    logging.debug("[%s] status(closing), download monitor closing" % (self.map_id,))
                     break
-                elif self.__state == self.ST_PAUSE:
-                    logging.debug("[%s] status(pause), continue to wait" % (self.map_id,))
-                    continue
+                #take the downloaded
+                fetched, self.__fetched = self.__fetched, []
+                #take the requests
+                reqs = []
+                while self.__state == self.ST_RUN and len(self.__req_queue) > 0 and \
+                      len(self.__in_progress) < self.__max_works:
+                    id, req = self.__req_queue.pop()
+                    self.__in_progress[id] = req[4]
+                    reqs.append((id, req))
+
+            for id, req in reqs:
+                level, x, y, status, cb = req  #unpack the req
+                url = self.genTileUrl(level, x, y)
+                logging.info("[%s] DL %s" % (self.map_id, url))
+                future = self.getAsyncEngine().submit(url, headers=self.HTTP_HEADERS, timeout=30)
+                self.__futures[id] = future
+                future.add_done_callback(lambda f, id=id, req=req, url=url: self.__onFetched(id, req, url, f))
+
+            for id, req, tile_data in fetched:
+                tile_img = self.__saveTileData(id, req, tile_data)
+                with self.__download_cv:
+                    cb = self.__in_progress.pop(id, None)
+                    self.__futures.pop(id, None)
+                    self.__notifyIfIdle()
+                if tile_img is not None:
+                    self.__invokeCb(req, cb)
+
+        #cancel the in-flight requests
+        for future in list(self.__futures.values()):
+            future.cancel()
+        self.__futures.clear()
+        logging.debug("[%s] status(closing), download dispatcher closing" % (self.map_id,))
+
+    #called in the loop thread of the async engine, so just hand the result to the dispatcher
+    def __onFetched(self, id, req, url, future):
+        tile_data = None
+        if not future.cancelled():
+            try:
+                tile_data = future.result()
+                logging.info('[%s] DL %s [OK]' % (self.map_id, url))
+            except Exception as ex:
+                logging.warning('[%s] DL %s [FAILED][%s]' % (self.map_id, url, str(ex)))
 
-                if len(self.__req_queue) > 0 and len(self.__workers) < self.__MAX_WORKS:
-                    #the req
-                    id, req = self.__req_queue.popitem() #LIFO
-                    if id in self.__workers:
-                        logging.warning("[%s] Opps! the req is DUP and in progress." % (self.map_id,)) #should not happen
-                    else:
-                        #create the job and run the worker
-                        job = lambda: self.__runDownloadJob(id, req)
-                        worker = Thread(name=id, target=job)
-                        self.__workers[id] = worker
-                        worker.start()
-
-        #todo: interrupt urllib.request.openurl to stop download workers.
-        #http_handler.close()
         with self.__download_cv:
-            #self.__download_cv.wait_for(no_worker)
-            self.__state = self.ST_IDLE
-            logging.debug("[%s] status(idle), download monitor closed" % (self.map_id,))
+            self.__fetched.append((id, req, tile_data))
+            self.__download_cv.notify()
 
-    def __requestTile(self, id, req):
+    def __requestTile(self, id, req, is_prefetch=False):
         #check and add to req queue
         with self.__download_cv:
             if id in self.__req_queue:
                 return
-            if id in self.__workers:
+            if id in self.__in_progress:
                 return
             #add the req
-            self.__req_queue[id] = req
+            self.__req_queue.push(id, req, is_prefetch)
             self.__download_cv.notify()
 
+    #the tile is requested already, maybe by prefetch, which should be as a normal request with the cb
+    def __upgradeRequest(self, id, cb):
+        with self.__download_cv:
+            if self.__req_queue.isPrefetch(id):
+                level, x, y, status, req_cb = self.__req_queue.get(id)
+                self.__req_queue.push(id, (level, x, y, status, cb))
+            elif id in self.__in_progress and self.__in_progress[id] is None:
+                self.__in_progress[id] = cb
+
+    #NOTICE: call with the download lock
+    def __notifyIfIdle(self):
+        if not self.__in_progress and len(self.__req_queue) == 0:
+            self.__prefetch_cv.notify()
+
+    # Set the viewport in tiles, which prioritizes the download requests.
+    # The requests which are scrolled off-screen are cancelled.
+    def setViewport(self, level, t_left, t_upper, t_right, t_lower):
+        with self.__download_cv:
+            bounds = (t_left, t_upper, t_right, t_lower)
+            dropped = self.__req_queue.setFocus(level, bounds, conf.TILE_DL_KEEP_MARGIN)
+            #prefetch around the new viewport
+            self.__prefetch_area = (level,) + bounds
+            self.__prefetch_ts = time.time()
+            self.__prefetch_cv.notify()
+
+        #reset status, so that the tile can be requested again
+        for id, req in dropped:
+            level, x, y, status, cb = req
+            self.__mem_cache.set(id, status & 0x0F)
+        if dropped:
+            logging.debug("[%s] cancel %d download requests out of viewport" % (self.map_id, len(dropped)))
+
+    # return the shared image of the uniform tile, with the attribute 'fill_color' to paste by filling.
+    # NOTICE: the image is shared, which must not be modified
+    @classmethod
+    def getUniformTile(cls, color):
+        with cls.uniform_tiles_lock:
+            img = cls.uniform_tiles.get(color)
+            if img is not None:
+                cls.uniform_tiles.move_to_end(color)
+            else:
+                if len(cls.uniform_tiles) >= cls.MAX_UNIFORM_TILES:
+                    cls.uniform_tiles.popitem(last=False)
+                img = Image.new("RGBA", coord.TileSystem.getPixcelXYByTileXY(1, 1), color)
+                img.fill_color = color
+                cls.uniform_tiles[color] = img
+            return img
+
     def __getTileFromDisk(self, level, x, y):
         try:
             data, ts = self.__disk_cache.get(level, x, y)
             if data is not None:
-                img = Image.open(BytesIO(data))
+                colors = self.__disk_cache.getColors(level, range(x, x+1), range(y, y+1))
+                img = self.getUniformTile(colors[(x, y)]) if (x, y) in colors else Image.open(BytesIO(data))
                 return img, ts
         except Exception as ex:
             logging.warning("[%s] Error to read tile data: %s" % (self.map_id, str(ex)))
@@ -499,9 +977,13 @@ class TileAgent:
         status_bak = status
 
         if status == self.TILE_VALID:
+            if req_type and self.__prefetched:
+                self.__countPrefetchHit(id)
             return img
 
-        if (status & 0xF0) == self.TILE_REQ:
+        if self.isReqStatus(status):
+            if req_type == "async":
+                self.__upgradeRequest(id, cb)
             return img    # None or Expire
 
         if (status & 0xF0) == self.TILE_REQ_FAILED:
@@ -517,6 +999,7 @@ class TileAgent:
                 status = self.TILE_EXPIRE
             else:
                 self.__mem_cache.set(id, self.TILE_VALID, img)
+                self.__invalidateFakeTiles(level, x, y)
                 return img
 
         #check status, should be 'not in disk' or 'expire'
@@ -580,81 +1063,236 @@ class TileAgent:
     #gen fake from lower/higher level
     #return None if not avaliable
     def __genFakeTile(self, level, x, y):
+        id = self.genTileId(level, x, y)
+        img, status, ts = self.__fake_cache.get(id)
+        if img is not None:
+            return img
+
         #gen from lower level
-        level_diff = min(level - self.level_min, 3)
+        level_diff = min(level - self.level_min, conf.TILE_FAKE_MAGNIFY_DEPTH)
         img = self.__genMagnifyFakeTile(level, x, y, level_diff)
-        if img:
-            return img
 
         #gen from upper level
-        level_diff = min(self.level_max - level, 1)
-        img = self.__genMinifyFakeTile(level, x, y, level_diff)
-        if img:
-            return img
+        if img is None:
+            level_diff = min(self.level_max - level, conf.TILE_FAKE_MINIFY_DEPTH)
+            img = self.__genMinifyFakeTile(level, x, y, level_diff)
 
-        return None
+        if img is not None:
+            self.__fake_levels.add(level)
+            self.__fake_cache.set(id, self.TILE_VALID, img)
+        else:
+            self.__fake_cache.remove(id)
+        return img
+
+    #the real tile arrives (downloaded, or loaded from disk), remove the fake tiles which are (or could be) generated from it
+    def __invalidateFakeTiles(self, level, x, y):
+        fake_levels = self.__fake_levels
+        if level in fake_levels:
+            self.__fake_cache.remove(self.genTileId(level, x, y))
+
+        #the magnified from the tile
+        for i in range(1, min(self.level_max - level, conf.TILE_FAKE_MAGNIFY_DEPTH) + 1):
+            if level+i not in fake_levels:
+                continue
+            scale = 2**i
+            for p in range(scale):
+                for q in range(scale):
+                    self.__fake_cache.remove(self.genTileId(level+i, x*scale+p, y*scale+q))
+
+        #the minified from the tile
+        for i in range(1, min(level - self.level_min, conf.TILE_FAKE_MINIFY_DEPTH) + 1):
+            if level-i not in fake_levels:
+                continue
+            scale = 2**i
+            self.__fake_cache.remove(self.genTileId(level-i, int(x/scale), int(y/scale)))
 
     # @cb is only for req_type == "async" to nitify the tile is done,
     # which call cb(tile_info), tile_info = (map_id, level, x, y)
     def getTile(self, level, x, y, req_type, cb=None, allow_fake=True):
+        return self.__getTileOrFake(level, x, y, req_type, cb, allow_fake)[0]
+
+    #return (img, is_fake), without marking the image, which may be cached or shared
+    def __getTileOrFake(self, level, x, y, req_type, cb, allow_fake):
         img = self.__getTile(level, x, y, req_type, cb)
         if img is not None:
-            img.is_fake = False
-            return img
+            return img, False
 
         if allow_fake:
             img = self.__genFakeTile(level, x, y)
             if img is not None:
-                img.is_fake = True
-                return img
-
-        return None
-
-class MemoryCache:
-    '''
-    class Item:
-        self.__init__(data=None, status=None, timestamp=None):
-        self.data = data
-        self.status = status
-        self.timestamp = timestamp
-    '''
-
-    @property
-    def is_concurrency(self):
-        return self.__repo_lock is not None
+                return img, True
+
+        return None, False
+
+    # load the tiles of the rectangle which are not in memory from disk by one query,
+    # and leave the status in memory for __getTile().
+    # @xys limits the tiles to load, and return ids of the loaded tiles.
+    def __loadTilesFromDisk(self, level, x_range, y_range, xys=None):
+        ids = {}
+        for xy in (xys if xys is not None else itertools.product(x_range, y_range)):
+            id = self.genTileId(level, *xy)
+            if self.__mem_cache.getStatus(id) == self.TILE_NOT_IN_MEM:  #not counted, __getTile() looks it up later
+                ids[xy] = id
+        if not ids:
+            return []
 
-    def __init__(self, init_status, is_concurrency=False):
-        self.__init_status = init_status
-        self.__repo = {}
-        self.__repo_lock = Lock() if is_concurrency else None
+        try:
+            tiles = self.__disk_cache.getMany(level, x_range, y_range)
+            colors = self.__disk_cache.getColors(level, x_range, y_range)
+        except Exception as ex:
+            logging.warning("[%s] Error to read tiles data: %s" % (self.map_id, str(ex)))
+            return []  #let __getTile() to read them one by one
+
+        loaded = []
+        for xy, id in ids.items():
+            data, ts = tiles.get(xy, (None, None))
+            if data is None:
+                self.__mem_cache.set(id, self.TILE_NOT_IN_DISK)
+                continue
+            try:
+                img = self.getUniformTile(colors[xy]) if xy in colors else Image.open(BytesIO(data))
+            except Exception as ex:
+                logging.warning("[%s] Error to read tile data: %s" % (self.map_id, str(ex)))
+                continue
+            if ts and self.expire_sec and (time.time() - ts) > self.expire_sec:
+                self.__mem_cache.set(id, self.TILE_EXPIRE, img)
+            else:
+                self.__mem_cache.set(id, self.TILE_VALID, img)
+                loaded.append(id)
+            self.__invalidateFakeTiles(level, *xy)
+        return loaded
 
-    def __set(self, id, status, data):
-        if data is None:      #using old data
-            item = self.__repo.get(id)
-            if item is not None:
-                data = item[0]
-        self.__repo[id] = (data, status, time.time())
+    #The thread to prefetch tiles around the viewport, when downloads are idle
+    def __runPrefetcher(self):
+        delay = conf.TILE_PREFETCH_DELAY_MS / 1000
 
-    def __get(self, id):
-        item = self.__repo.get(id)
-        if item is None:
-            item = (None, self.__init_status, time.time())
-            self.__repo[id] = item
-        return item
+        while True:
+            with self.__download_cv:
+                while True:
+                    if self.__state == self.ST_CLOSING:
+                        logging.debug("[%s] status(closing), prefetcher closing" % (self.map_id,))
+                        return
+                    is_idle = self.__state == self.ST_RUN and not self.__in_progress and len(self.__req_queue) == 0
+                    if self.__prefetch_area is not None and is_idle:
+                        #wait the viewport to be stable
+                        wait_sec = self.__prefetch_ts + delay - time.time()
+                        if wait_sec <= 0:
+                            break
+                        self.__prefetch_cv.wait(wait_sec)
+                    else:
+                        self.__prefetch_cv.wait()
+                area, self.__prefetch_area = self.__prefetch_area, None
+
+            try:
+                self.__prefetch(*area)
+            except Exception as ex:
+                logging.warning("[%s] prefetch error: %s" % (self.map_id, str(ex)))
+
+    #return the list of (level, x_range, y_range, xys) to prefetch, in the order of importance
+    def __genPrefetchAreas(self, level, t_left, t_upper, t_right, t_lower):
+        def clip(lv, left, upper, right, lower):
+            n = 1 << lv
+            return range(max(left, 0), min(right, n-1) + 1), range(max(upper, 0), min(lower, n-1) + 1)
+
+        def byDistance(xys, cx, cy):
+            return sorted(xys, key=lambda xy: (xy[0] + 0.5 - cx)**2 + (xy[1] + 0.5 - cy)**2)
+
+        areas = []
+        cx = (t_left + t_right + 1) / 2
+        cy = (t_upper + t_lower + 1) / 2
+
+        #the ring around the viewport
+        ring = conf.TILE_PREFETCH_RING
+        if ring > 0:
+            x_range, y_range = clip(level, t_left - ring, t_upper - ring, t_right + ring, t_lower + ring)
+            xys = [(x, y) for x in x_range for y in y_range
+                    if not (t_left <= x <= t_right and t_upper <= y <= t_lower)]
+            areas.append((level, x_range, y_range, byDistance(xys, cx, cy)))
+
+        #the upper level, to zoom out
+        if level - 1 >= self.level_min:
+            x_range, y_range = clip(level-1, t_left >> 1, t_upper >> 1, t_right >> 1, t_lower >> 1)
+            xys = [(x, y) for x in x_range for y in y_range]
+            areas.append((level-1, x_range, y_range, byDistance(xys, cx/2, cy/2)))
+
+        #the lower level, to zoom in at the center
+        if level + 1 <= self.level_max:
+            w, h = t_right - t_left + 1, t_lower - t_upper + 1
+            left, upper = int(cx*2 - w/2), int(cy*2 - h/2)
+            x_range, y_range = clip(level+1, left, upper, left + w - 1, upper + h - 1)
+            xys = [(x, y) for x in x_range for y in y_range]
+            areas.append((level+1, x_range, y_range, byDistance(xys, cx*2, cy*2)))
+
+        return areas
+
+    def __prefetch(self, level, t_left, t_upper, t_right, t_lower):
+        budget = conf.TILE_PREFETCH_MAX_TILES
+        for lv, x_range, y_range, xys in self.__genPrefetchAreas(level, t_left, t_upper, t_right, t_lower):
+            if budget <= 0:
+                break
+            xys = xys[:budget]
+            budget -= len(xys)
+
+            #warm the memory from disk
+            loaded = self.__loadTilesFromDisk(lv, x_range, y_range, xys)
+            self.__prefetch_tiles += len(loaded)
+            for id in loaded:
+                self.__addPrefetched(id)
+
+            #request the tiles not in disk
+            if not conf.TILE_PREFETCH_NETWORK:
+                continue
+            for x, y in xys:
+                id = self.genTileId(lv, x, y)
+                status = self.__mem_cache.getStatus(id)  #not counted as a lookup of the user
+                if status in (self.TILE_NOT_IN_DISK, self.TILE_EXPIRE):
+                    status |= self.TILE_REQ
+                    self.__mem_cache.set(id, status)
+                    self.__requestTile(id, (lv, x, y, status, None), is_prefetch=True)
+                    self.__prefetch_reqs += 1
+                    self.__addPrefetched(id)
+
+        logging.debug("[%s] prefetch around level %d (%d,%d)-(%d,%d), stats: %s" %
+                (self.map_id, level, t_left, t_upper, t_right, t_lower, self.getStats()['prefetch']))
+
+    def __addPrefetched(self, id):
+        with self.__download_cv:
+            self.__prefetched[id] = True
+            if len(self.__prefetched) > self.MAX_PREFETCHED:
+                self.__prefetched.popitem(last=False)
 
-    def set(self, id, status, data=None):
-        if self.is_concurrency:
-            with self.__repo_lock:
-                self.__set(id, status, data)
-        else:
-            self.__set(id, status, data)
+    def __countPrefetchHit(self, id):
+        with self.__download_cv:
+            if self.__prefetched.pop(id, None) is not None:
+                self.__prefetch_hits += 1
+
+    # get the tiles of the rectangle, x_range and y_range are ranges of tile x, y.
+    # return (tiles, missing), tiles is the dict (x, y) -> tile, and missing is the set of (x, y) without the real tile,
+    # which are requested if @req_type is given.
+    # @cb is the same as getTile() for req_type == "async"; and for req_type == "sync", to notify each tile is done.
+    # @expired, if given, is the set to add the (x, y) of the expired tiles, which are in tiles until refreshed.
+    def getTiles(self, level, x_range, y_range, req_type, cb=None, allow_fake=True, expired=None):
+        self.__loadTilesFromDisk(level, x_range, y_range)
+
+        tiles = {}
+        missing = set()
+        for x in x_range:
+            for y in y_range:
+                if req_type == "sync":
+                    tile, is_fake = self.__getTileOrFake(level, x, y, req_type, None, allow_fake)
+                    if cb is not None:
+                        cb((self.map_id, level, x, y))
+                else:
+                    tile, is_fake = self.__getTileOrFake(level, x, y, req_type, cb, allow_fake)
 
-    def get(self, id):
-        if self.is_concurrency:
-            with self.__repo_lock:
-                return self.__get(id)
-        else:
-            return self.__get(id)
+                if tile is None or is_fake:
+                    missing.add((x, y))
+                elif expired is not None and \
+                        (self.__mem_cache.getStatus(self.genTileId(level, x, y)) & 0x0F) == self.TILE_EXPIRE:
+                    expired.add((x, y))
+                if tile is not None:
+                    tiles[(x, y)] = tile
+        return tiles, missing
 
 class DiskCache:
     def start(self):
@@ -663,12 +1301,31 @@ class DiskCache:
     def close(self):
         pass
 
-    def put(self, level, x, y, data):
+    #@ts is the timestamp of the tile data, None for now; @color is the RGBA of the tile if it is uniform
+    def put(self, level, x, y, data, *, ts=None, color=None):
         pass
 
     def get(self, level, x, y):
         pass
 
+    # get the colors of the uniform tiles of the rectangle, return the dict (x, y) -> RGBA
+    def getColors(self, level, x_range, y_range):
+        return {}
+
+    # get the tiles of the rectangle, return the dict (x, y) -> (data, timestamp) of the found tiles
+    def getMany(self, level, x_range, y_range):
+        tiles = {}
+        for x in x_range:
+            for y in y_range:
+                data, ts = self.get(level, x, y)
+                if data is not None:
+                    tiles[(x, y)] = (data, ts)
+        return tiles
+
+    # get the timestamps of the tiles of the rectangle, return the dict (x, y) -> timestamp of the found tiles
+    def getTimestamps(self, level, x_range, y_range):
+        return {xy: ts for xy, (data, ts) in self.getMany(level, x_range, y_range).items()}
+
 class FileDiskCache(DiskCache):
     def __init__(self, cache_dir, map_desc):
         self.__cache_dir = os.path.join(cache_dir, map_desc.map_id) #create subfolder
@@ -685,20 +1342,64 @@ class FileDiskCache(DiskCache):
     def close(self):
         pass
 
-    def put(self, level, x, y, data):
+    #@ts is kept as the file mtime; not keep @color
+    def put(self, level, x, y, data, *, ts=None, color=None):
         path = self.__genTilePath(level, x, y)
         mkdirSafely(os.path.dirname(path))
         with open(path, 'wb') as file:
             file.write(data)
+        if ts is not None:
+            os.utime(path, (ts, ts))
 
     def get(self, level, x, y):
         path = self.__genTilePath(level, x, y)
         if os.path.exists(path):
             with open(path, 'rb') as file:
-                return file.read()
-        return None
+                return (file.read(), int(os.path.getmtime(path)))
+        return (None, None)
 
 class DBDiskCache(DiskCache):
+    CACHED_STATEMENTS = 32  #prepared statements kept by each connection
+    LOG_PERIOD = 10         #seconds between the read summaries
+
+    #the deduplicated schema: identical tiles share one row of 'images' by the hash of the data,
+    #and the view 'tiles' is kept for the mbtiles readers.
+    #the index of 'map' by tile_id is to find if the replaced image is still referenced.
+    DEDUP_INDEX_SQL = "CREATE INDEX IF NOT EXISTS map_tile_id ON map(tile_id)"
+    DEDUP_TABLES_SQLS = (
+        "CREATE TABLE images(tile_id TEXT PRIMARY KEY, tile_data BLOB NOT NULL)",
+        "CREATE TABLE map(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+            "tile_id TEXT NOT NULL, timestamp INTEGER NOT NULL, "
+            "PRIMARY KEY (zoom_level, tile_column, tile_row))",
+        "CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+            "map.tile_row AS tile_row, images.tile_data AS tile_data, map.timestamp AS timestamp "
+            "FROM map JOIN images ON images.tile_id = map.tile_id",
+        DEDUP_INDEX_SQL,
+    )
+
+    @classmethod
+    def genTileHash(cls, data):
+        return hashlib.sha1(data).hexdigest()
+
+    #the colors of the uniform tiles, to fill the tiles without decoding
+    COLORS_TABLE_SQL = "CREATE TABLE IF NOT EXISTS tile_colors(zoom_level INTEGER, tile_column INTEGER, " \
+            "tile_row INTEGER, color INTEGER NOT NULL, PRIMARY KEY (zoom_level, tile_column, tile_row))"
+
+    #the color as the integer 0xRRGGBBAA
+    @classmethod
+    def encodeColor(cls, rgba):
+        r, g, b, a = rgba
+        return (r << 24) | (g << 16) | (b << 8) | a
+
+    @classmethod
+    def decodeColor(cls, value):
+        return ((value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+
+    @classmethod
+    def isDedup(cls, conn):
+        sql = "SELECT count(*) FROM sqlite_master WHERE type='table' AND name IN ('images', 'map')"
+        return conn.execute(sql).fetchone()[0] == 2
+
     @property
     def map_id(self):
         return self.__map_desc.map_id
@@ -711,24 +1412,65 @@ class DBDiskCache(DiskCache):
         #configs
         self.__db_schema = db_schema
         self.__has_timestamp = True
+        self.__is_dedup = conf.TILE_DB_DEDUP  #for the new db, or read from the db
+        self.__has_colors = False
 
         self.__is_concurrency = is_concurrency
 
         if is_concurrency:
-            self.__surrogate = None  #the thread do All DB operations, due to sqlite3 requiring only the same thread.
+            self.__surrogate = None  #the thread do All DB writes, due to sqlite3 requiring only the same thread.
+            self.__ready = Event()   #the db is created and configured by the surrogate
 
             self.__is_closed = False
 
-            #concurrency get/put
-            self.__sql_queue = []
+            #concurrency put
+            self.__put_queue = OrderedDict()  #(level, x, y) -> (data, timestamp, color), puts to be written in a batch
+            self.__put_queue_ts = None      #the time of the first put in the batch
+            self.__inflight = {}            #(level, x, y) -> (data, timestamp, color), the batch being written
             self.__sql_queue_lock = Lock()
             self.__sql_queue_cv = Condition(self.__sql_queue_lock)
 
-            self.__get_lock = Lock()    #block the 'get' action
+            #concurrency get, by the pool of read-only connections
+            self.__readers = []     #idle connections
+            self.__readers_lock = Lock()
+            self.__readers_sem = BoundedSemaphore(conf.TILE_DB_READERS)
+
+        #the sqls, which are constant strings to reuse the prepared statements
+        self.__get_sql = None
+        self.__get_many_sql = None
+        self.__get_ts_sql = None
+        self.__put_sql = None
+        self.__put_image_sql = None  #for dedup
+        self.__get_image_id_sql = None
+        self.__del_image_sql = None
+        self.__put_color_sql = None
+        self.__del_color_sql = None
+        self.__get_colors_sql = None
+
+        #read stats
+        self.__stats_lock = Lock()
+        self.__get_hits = 0
+        self.__get_misses = 0
+        self.__log_ts = 0
+        self.__log_hits = 0
+        self.__log_misses = 0
+
+        #write stats
+        self.__put_tiles = 0
+        self.__put_bytes = 0
+        self.__put_batches = 0
+        self.__put_secs = 0.0
 
-            self.__get_respose = None   #the pair (data, exception)
-            self.__get_respose_lock = Lock()
-            self.__get_respose_cv = Condition(self.__get_respose_lock)
+    @property
+    def stats(self):
+        secs = self.__put_secs
+        return {'get_hits': self.__get_hits,
+                'get_misses': self.__get_misses,
+                'put_tiles': self.__put_tiles,
+                'put_bytes': self.__put_bytes,
+                'put_batches': self.__put_batches,
+                'put_secs': secs,
+                'put_tiles_per_sec': self.__put_tiles / secs if secs else 0.0}
 
     def __initDB(self):
         def getBoundsText(map_desc):
@@ -750,6 +1492,17 @@ class DBDiskCache(DiskCache):
                           "INSERT INTO metadata(name, value) VALUES('%s', '%s')" % ('bounds', getBoundsText(desc)),
                           "INSERT INTO metadata(name, value) VALUES('%s', '%s')" % ('schema', self.__db_schema),
                          )
+        #exec
+        conn.execute(meta_create_sql)
+        for sql in meta_data_sqls:
+            conn.execute(sql)
+
+        if self.__is_dedup:
+            for sql in self.DEDUP_TABLES_SQLS:
+                conn.execute(sql)
+            conn.commit()
+            return
+
         #tiles
         tiles_create_sql = "CREATE TABLE tiles("
         tiles_create_sql += "zoom_level  INTEGER, "
@@ -762,19 +1515,15 @@ class DBDiskCache(DiskCache):
         #tiles_idx
         tiles_idx_create_sql = "CREATE INDEX tiles_idx on tiles(zoom_level, tile_column, tile_row)"
 
-        #exec
-        conn.execute(meta_create_sql)
         conn.execute(tiles_create_sql)
         conn.execute(tiles_idx_create_sql)
-        for sql in meta_data_sqls:
-            conn.execute(sql)
         conn.commit()
 
 
     def __getMetadata(self, name):
         try:
-            sql = 'SELECT value FROM metadata WHERE name="%s"' % (name,)
-            cursor = self.__conn.execute(sql)
+            sql = 'SELECT value FROM metadata WHERE name=?'
+            cursor = self.__conn.execute(sql, (name,))
             row = cursor.fetchone()
             data = None if row is None else row[0]
             return data
@@ -804,80 +1553,249 @@ class DBDiskCache(DiskCache):
             self.__db_schema = schema
 
         self.__has_timestamp = self.__tableHasColumn("tiles", "timestamp")
+        self.__is_dedup = self.isDedup(self.__conn)
+
+    def __prepareSqls(self):
+        #the reads go through the view 'tiles' if dedup
+        if self.__is_dedup:
+            cols = "tile_data, timestamp"
+            self.__put_image_sql = "INSERT OR IGNORE INTO images(tile_id, tile_data) VALUES(?, ?)"
+            self.__put_sql = "INSERT OR REPLACE INTO map(zoom_level, tile_column, tile_row, tile_id, timestamp) VALUES(?, ?, ?, ?, ?)"
+            self.__get_image_id_sql = "SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+            self.__del_image_sql = "DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id=?)"
+        elif self.__has_timestamp:
+            cols = "tile_data, timestamp"
+            self.__put_sql = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data, timestamp) VALUES(?, ?, ?, ?, ?)"
+        else:
+            cols = "tile_data"
+            self.__put_sql = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?, ?, ?, ?)"
+        self.__get_sql = "SELECT %s FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?" % (cols,)
+        self.__get_many_sql = "SELECT tile_column, tile_row, %s FROM tiles" \
+                " WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % (cols,)
+        self.__get_ts_sql = "SELECT tile_column, tile_row, %s FROM tiles" \
+                " WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % \
+                ("timestamp" if self.__has_timestamp else "NULL",)
+        self.__put_color_sql = "INSERT OR REPLACE INTO tile_colors(zoom_level, tile_column, tile_row, color) VALUES(?, ?, ?, ?)"
+        self.__del_color_sql = "DELETE FROM tile_colors WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+        self.__get_colors_sql = "SELECT tile_column, tile_row, color FROM tile_colors" \
+                " WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+
+    def __connect(self, path, **kwargs):
+        return sqlite3.connect(path, cached_statements=self.CACHED_STATEMENTS, **kwargs)
+
+    #count the reads, and log the summary periodically instead of every tile
+    def __countReads(self, hits, misses):
+        now = time.time()
+        with self.__stats_lock:
+            self.__get_hits += hits
+            self.__get_misses += misses
+            self.__log_hits += hits
+            self.__log_misses += misses
+            if now - self.__log_ts < self.LOG_PERIOD:
+                return
+            log_hits, log_misses = self.__log_hits, self.__log_misses
+            self.__log_ts = now
+            self.__log_hits = self.__log_misses = 0
+        logging.info("[%s] DB read %d tiles, %d not found" % (self.map_id, log_hits, log_misses))
 
     #the true actions which are called by Surrogate
     def __start(self):
         if not os.path.exists(self.__db_path):
             logging.info("[%s] Initializing local cache DB..." % (self.map_id,))
             mkdirSafely(os.path.dirname(self.__db_path))
-            self.__conn = sqlite3.connect(self.__db_path)
+            self.__conn = self.__connect(self.__db_path)
             self.__initDB()
         else:
-            self.__conn = sqlite3.connect(self.__db_path)
+            self.__conn = self.__connect(self.__db_path)
             self.__readConfig()
+        self.__prepareSqls()
+
+        #the table added after the db created
+        try:
+            with self.__conn:
+                self.__conn.execute(self.COLORS_TABLE_SQL)
+            self.__has_colors = True
+        except Exception as ex:
+            logging.warning("[%s] Create the table of tile colors error: %s" % (self.map_id, str(ex)))
+
+        #the index added after the db deduplicated
+        if self.__is_dedup:
+            with self.__conn:
+                self.__conn.execute(self.DEDUP_INDEX_SQL)
+
+        #WAL lets readers go with the writer, and commits without syncing the whole db
+        self.__conn.execute("PRAGMA journal_mode=%s" % (conf.TILE_DB_JOURNAL_MODE,))
+        self.__conn.execute("PRAGMA synchronous=%s" % (conf.TILE_DB_SYNCHRONOUS,))
 
         logging.info("[%s][Config] db schema: %s" % (self.map_id, self.__db_schema))
         logging.info("[%s][Config] suuport tile timestamp: %s" % (self.map_id, self.__has_timestamp))
+        logging.info("[%s][Config] dedup tiles: %s" % (self.map_id, self.__is_dedup))
 
     def __close(self):
         logging.info("[%s] Closing local cache DB..." % (self.map_id,))
         self.__conn.close()
 
+    #the read-only connection can be used by any thread, but by one thread at a time
+    def __openReader(self):
+        uri = "file:%s?mode=ro" % (pathname2url(os.path.abspath(self.__db_path)),)
+        return self.__connect(uri, uri=True, check_same_thread=False)
+
+    def __acquireReader(self):
+        self.__readers_sem.acquire()
+        try:
+            with self.__readers_lock:
+                if self.__readers:
+                    return self.__readers.pop()
+            return self.__openReader()
+        except Exception:
+            self.__readers_sem.release()
+            raise
+
+    def __releaseReader(self, conn):
+        with self.__readers_lock:
+            if self.__is_closed:
+                conn.close()
+            else:
+                self.__readers.append(conn)
+        self.__readers_sem.release()
+
+    def __closeReaders(self):
+        with self.__readers_lock:
+            for conn in self.__readers:
+                conn.close()
+            self.__readers = []
+
     @classmethod
     def flipY(cls, y, level):
         return (1 << level) - 1 - y
 
-    def __put(self, level, x, y, data):
-        #sql
-        if self.__db_schema == 'tms':
-            y = self.flipY(y, level)
-
-        sql = None
-        if self.__has_timestamp:
-            sql  = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data, timestamp)"
-            sql += " VALUES(%d, %d, %d, ?, %d)" % (level, x, y, int(time.time()))
-        else:
-            sql = "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data)"
-            sql += " VALUES(%d, %d, %d, ?)" % (level, x, y)
+    # write the tiles in one transaction
+    # @items is the list of (level, x, y, data, timestamp[, color])
+    def __putMany(self, items):
+        items = [item if len(item) > 5 else item + (None,) for item in items]
+
+        def genParams():
+            now = int(time.time())
+            for level, x, y, data, ts, color in items:
+                if self.__db_schema == 'tms':
+                    y = self.flipY(y, level)
+                if ts is None:
+                    ts = now
+                yield (level, x, y, data, ts) if self.__has_timestamp else (level, x, y, data)
+
+        def genDedupParams(hashes):
+            now = int(time.time())
+            for (level, x, y, data, ts, color), tile_id in zip(items, hashes):
+                if self.__db_schema == 'tms':
+                    y = self.flipY(y, level)
+                yield (level, x, y, tile_id, now if ts is None else ts)
+
+        def genColorParams(is_uniform):
+            for level, x, y, data, ts, color in items:
+                if (color is not None) != is_uniform:
+                    continue
+                if self.__db_schema == 'tms':
+                    y = self.flipY(y, level)
+                yield (level, x, y, self.encodeColor(color)) if is_uniform else (level, x, y)
 
         #query
+        t = time.time()
         try:
-            self.__conn.execute(sql, (data,))
-            self.__conn.commit()
-            logging.info("[%s] %s [OK]" % (self.map_id, sql))
+            with self.__conn:  #commit, or rollback on error
+                if self.__is_dedup:
+                    hashes = [self.genTileHash(item[3]) for item in items]
+                    params = list(genDedupParams(hashes))
+                    #the images to replace, which are removed if not referenced any more
+                    old_ids = set()
+                    for param in params:
+                        row = self.__conn.execute(self.__get_image_id_sql, param[:3]).fetchone()
+                        if row is not None:
+                            old_ids.add(row[0])
+                    old_ids.difference_update(hashes)
+
+                    self.__conn.executemany(self.__put_image_sql, ((h, item[3]) for h, item in zip(hashes, items)))
+                    self.__conn.executemany(self.__put_sql, params)
+                    self.__conn.executemany(self.__del_image_sql, ((id, id) for id in old_ids))
+                else:
+                    self.__conn.executemany(self.__put_sql, genParams())
+                if self.__has_colors:
+                    self.__conn.executemany(self.__del_color_sql, genColorParams(False))
+                    self.__conn.executemany(self.__put_color_sql, genColorParams(True))
         except Exception as ex:
-            logging.info("[%s] %s [Fail]" % (self.map_id, sql))
+            logging.info("[%s] put %d tiles [Fail]" % (self.map_id, len(items)))
             raise ex
+        secs = time.time() - t
+
+        nbytes = sum(len(item[3]) for item in items)
+        self.__put_tiles += len(items)
+        self.__put_bytes += nbytes
+        self.__put_batches += 1
+        self.__put_secs += secs
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("[%s] put %d tiles (%d bytes) in %.3f sec [OK]" % (self.map_id, len(items), nbytes, secs))
 
-    def __get(self, level, x, y):
+    def __get(self, level, x, y, conn=None):
         #sql
         if self.__db_schema == 'tms':
             y = self.flipY(y, level)
 
-        cols = "tile_data, timestamp" if self.__has_timestamp else "tile_data"
-        sql = "SELECT %s FROM tiles WHERE zoom_level=%d AND tile_column=%d AND tile_row=%d" % \
-                (cols, level, x, y,)
-
         row = None
         try:
             #query
-            cursor = self.__conn.execute(sql)
+            cursor = (conn or self.__conn).execute(self.__get_sql, (level, x, y))
             row = cursor.fetchone()
         except Exception as ex:
-            logging.info("[%s] %s [Fail]" % (self.map_id, sql))
+            logging.info("[%s] get tile (%d, %d, %d) [Fail]" % (self.map_id, level, x, y))
             raise ex
 
         #result (tile, timestamp)
         if row is None:
-            logging.info("[%s] %s [NA]" % (self.map_id, sql))
+            self.__countReads(0, 1)
             return (None, None)
-        elif self.__has_timestamp:
-            logging.info("[%s] %s [OK][TS]" % (self.map_id, sql))
+
+        self.__countReads(1, 0)
+        if self.__has_timestamp:
             return row
         else:
-            logging.info("[%s] %s [OK]" % (self.map_id, sql))
             return (row[0], None)
 
+    #query the rows (tile_column, tile_row, ...) of the rectangle, return the dict (x, y) -> row[2:]
+    def __queryRect(self, sql, level, x_range, y_range, conn=None):
+        y_min, y_max = min(y_range), max(y_range)
+        if self.__db_schema == 'tms':
+            y_min, y_max = self.flipY(y_max, level), self.flipY(y_min, level)
+        params = (level, min(x_range), max(x_range), y_min, y_max)
+
+        try:
+            rows = (conn or self.__conn).execute(sql, params).fetchall()
+        except Exception as ex:
+            logging.info("[%s] get tiles of level %d, x %s, y %s [Fail]" % (self.map_id, level, x_range, y_range))
+            raise ex
+
+        #result (x, y) -> row[2:]
+        result = {}
+        for row in rows:
+            x, y = row[0], row[1]
+            if self.__db_schema == 'tms':
+                y = self.flipY(y, level)
+            if x in x_range and y in y_range:  #for the range with step
+                result[(x, y)] = row[2:]
+        return result
+
+    def __getMany(self, level, x_range, y_range, conn=None):
+        if not x_range or not y_range:
+            return {}
+
+        #result (x, y) -> (tile, timestamp)
+        tiles = {}
+        for xy, row in self.__queryRect(self.__get_many_sql, level, x_range, y_range, conn).items():
+            tiles[xy] = (row[0], row[1] if self.__has_timestamp else None)
+
+        self.__countReads(len(tiles), len(x_range) * len(y_range) - len(tiles))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("[%s] get %d tiles of level %d, x %s, y %s" % (self.map_id, len(tiles), level, x_range, y_range))
+        return tiles
+
     #the interface which are called by the user
     def start(self):
         if not self.__is_concurrency:
@@ -894,80 +1812,191 @@ class DBDiskCache(DiskCache):
                 self.__is_closed = True
                 self.__sql_queue_cv.notify()
             self.__surrogate.join()
+            self.__closeReaders()
 
-    def put(self, level, x, y, data):
+    #@ts is the timestamp of the tile data, None for now; @color is the RGBA of the tile if it is uniform
+    def put(self, level, x, y, data, *, ts=None, color=None):
+        ts = int(time.time()) if ts is None else ts
         if not self.__is_concurrency:
-            self.__put(level, x, y, data)
+            self.__putMany([(level, x, y, data, ts, color)])
         else:
             with self.__sql_queue_cv:
-                item = (level, x, y, data)
-                self.__sql_queue.append(item)
+                is_first = not self.__put_queue
+                if is_first:
+                    self.__put_queue_ts = time.time()
+                self.__put_queue[(level, x, y)] = (data, ts, color)
+                #wake up the surrogate to wait the batch window, or to flush the full batch
+                if is_first or len(self.__put_queue) >= conf.TILE_DB_BATCH_SIZE:
+                    self.__sql_queue_cv.notify()
+
+    # put the tiles in one transaction, or in the batches of the surrogate,
+    # @items is the list of (level, x, y, data, timestamp[, color]), timestamp None for now
+    def putMany(self, items):
+        if not self.__is_concurrency:
+            self.__putMany(items)
+        else:
+            with self.__sql_queue_cv:
+                if not self.__put_queue:
+                    self.__put_queue_ts = time.time()
+                now = int(time.time())
+                for item in items:
+                    level, x, y, data, ts = item[:5]
+                    color = item[5] if len(item) > 5 else None
+                    self.__put_queue[(level, x, y)] = (data, now if ts is None else ts, color)
                 self.__sql_queue_cv.notify()
 
     def get(self, level, x, y):
         if not self.__is_concurrency:
             return self.__get(level, x, y)
         else:
-            def has_respose():
-                return self.__get_respose is not None
+            #the tile not written yet, or being written
+            with self.__sql_queue_cv:
+                pending = self.__put_queue.get((level, x, y))
+                if pending is None:
+                    pending = self.__inflight.get((level, x, y))
+            if pending is not None:
+                return (pending[0], pending[1] if self.__has_timestamp else None)
+
+            #read by any reader
+            self.__ready.wait()
+            conn = self.__acquireReader()
+            try:
+                return self.__get(level, x, y, conn)
+            finally:
+                self.__releaseReader(conn)
+
+    # get the tiles of the rectangle by one query, return the dict (x, y) -> (data, timestamp) of the found tiles
+    def getMany(self, level, x_range, y_range):
+        if not self.__is_concurrency:
+            return self.__getMany(level, x_range, y_range)
 
-            with self.__get_lock:  #for blocking the continuous get
-                #req tile
-                with self.__sql_queue_cv:
-                    item = (level, x, y, None)
-                    self.__sql_queue.insert(0, item)  #service first
-                    self.__sql_queue_cv.notify()
+        pendings = self.__getPendings(level, x_range, y_range)
+        self.__ready.wait()
+        conn = self.__acquireReader()
+        try:
+            tiles = self.__getMany(level, x_range, y_range, conn)
+        finally:
+            self.__releaseReader(conn)
+
+        for xy, (data, ts, color) in pendings.items():
+            tiles[xy] = (data, ts if self.__has_timestamp else None)
+        return tiles
+
+    # get the timestamps of the tiles of the rectangle without the tile data,
+    # return the dict (x, y) -> timestamp of the found tiles (None if the db has no timestamp)
+    def getTimestamps(self, level, x_range, y_range):
+        if not x_range or not y_range:
+            return {}
+
+        if not self.__is_concurrency:
+            rows = self.__queryRect(self.__get_ts_sql, level, x_range, y_range)
+            return {xy: row[0] for xy, row in rows.items()}
+
+        pendings = self.__getPendings(level, x_range, y_range)
+        self.__ready.wait()
+        conn = self.__acquireReader()
+        try:
+            rows = self.__queryRect(self.__get_ts_sql, level, x_range, y_range, conn)
+        finally:
+            self.__releaseReader(conn)
+        tss = {xy: row[0] for xy, row in rows.items()}
+
+        for xy, (data, ts, color) in pendings.items():
+            tss[xy] = ts if self.__has_timestamp else None
+        return tss
 
-                #wait resposne
-                res = None
-                with self.__get_respose_cv:
-                    self.__get_respose_cv.wait_for(has_respose)
-                    res, self.__get_respose = self.__get_respose, res   #swap: pop response of get()
+    # get the colors of the uniform tiles of the rectangle, return the dict (x, y) -> RGBA
+    def getColors(self, level, x_range, y_range):
+        if not x_range or not y_range:
+            return {}
 
-                #return data
-                data, ex = res
-                if ex:
-                    raise ex
-                return data
+        if not self.__is_concurrency:
+            if not self.__has_colors:
+                return {}
+            rows = self.__queryRect(self.__get_colors_sql, level, x_range, y_range)
+            return {xy: self.decodeColor(row[0]) for xy, row in rows.items()}
+
+        pendings = self.__getPendings(level, x_range, y_range)
+        self.__ready.wait()
+        if not self.__has_colors:
+            return {}
+        conn = self.__acquireReader()
+        try:
+            rows = self.__queryRect(self.__get_colors_sql, level, x_range, y_range, conn)
+        finally:
+            self.__releaseReader(conn)
+        colors = {xy: self.decodeColor(row[0]) for xy, row in rows.items()}
+
+        for xy, (data, ts, color) in pendings.items():
+            if color is None:
+                colors.pop(xy, None)
+            else:
+                colors[xy] = color
+        return colors
+
+    # the puts of the rectangle not committed yet, as the dict (x, y) -> (data, timestamp, color).
+    # they are taken before querying the db: a put committed after that is found by the query.
+    def __getPendings(self, level, x_range, y_range):
+        pendings = {}
+        with self.__sql_queue_cv:
+            for queue in (self.__inflight, self.__put_queue):  #the later puts override
+                for (p_level, x, y), val in queue.items():
+                    if p_level == level and x in x_range and y in y_range:
+                        pendings[(x, y)] = val
+        return pendings
+
+    # iterate all the tiles as (level, x, y, data, timestamp), only for the non-concurrency mode
+    def iterTiles(self):
+        if self.__is_concurrency:
+            raise RuntimeError("iterate tiles in the concurrency mode")
+        cols = "tile_data, timestamp" if self.__has_timestamp else "tile_data, NULL"
+        cursor = self.__conn.execute("SELECT zoom_level, tile_column, tile_row, %s FROM tiles" % (cols,))
+        for level, x, y, data, ts in cursor:
+            if self.__db_schema == 'tms':
+                y = self.flipY(y, level)
+            yield (level, x, y, data, ts)
 
     #the Surrogate thread
     def __runSurrogate(self):
-        def has_sql_events():
-            return self.__is_closed or len(self.__sql_queue)
-        
-        self.__start()
+        #return put items, wait until the batch of puts is full or timeout
+        def waitPuts():
+            window = conf.TILE_DB_BATCH_MS / 1000
+            while True:
+                if self.__put_queue and (self.__is_closed or
+                        len(self.__put_queue) >= conf.TILE_DB_BATCH_SIZE or
+                        time.time() - self.__put_queue_ts >= window):
+                    #keep the batch readable until it is committed
+                    self.__inflight = self.__put_queue
+                    self.__put_queue = OrderedDict()
+                    return [key + val for key, val in self.__inflight.items()]
+
+                if self.__is_closed:
+                    return None
+
+                timeout = (self.__put_queue_ts + window - time.time()) if self.__put_queue else None
+                self.__sql_queue_cv.wait(timeout)
+
+        try:
+            self.__start()
+        finally:
+            self.__ready.set()  #readers get errors if the db is failed to start
+
         try:
             while True:
                 #wait events
-                item = None
                 with self.__sql_queue_cv:
-                    self.__sql_queue_cv.wait_for(has_sql_events)
-                    if self.__is_closed:
+                    put_items = waitPuts()
+                    if put_items is None:
                         return
-                    item = self.__sql_queue.pop(0)
 
-                level, x, y, data = item
                 #put data
-                if data:
-                    try:
-                        self.__put(level, x, y, data)
-                    except Exception as ex:
-                        logging.error("[%s] DB put data error: %s" % (self.map_id, str(ex)))
-                #get data
-                else:
-                    res_data, res_ex = None, None
-                    try:
-                        res_data = self.__get(level, x, y)
-                        res_ex = None
-                    except Exception as ex:
-                        logging.error("[%s] DB get data error: %s" % (self.map_id, str(ex)))
-                        res_data = None
-                        res_ex = ex
-
-                    #notify
-                    with self.__get_respose_cv:
-                        self.__get_respose = (res_data, res_ex)
-                        self.__get_respose_cv.notify()
+                try:
+                    self.__putMany(put_items)
+                except Exception as ex:
+                    logging.error("[%s] DB put data error: %s" % (self.map_id, str(ex)))
+                finally:
+                    with self.__sql_queue_cv:
+                        self.__inflight = {}
 
         finally:
             self.__close()
@@ -6,11 +6,13 @@ import xml.dom.minidom
 import logging
 import tempfile
 import urllib.request
+from io import BytesIO
 from tkinter import messagebox
 from xml.etree import ElementTree as ET
-from threading import Timer
+from threading import Timer, Lock
 from PIL import Image, ImageTk, ImageDraw, ImageColor
 from uuid import uuid4
+from datetime import timedelta
 from src.raw import *
 
 import pytz
@@ -20,9 +22,116 @@ from timezonefinder import TimezoneFinder
 import src.conf as conf
 from src.coord import TileSystem, CoordinateSystem
 
+'''
+Resolve the timezones of locations, shared in the process.
+The finder is loaded at the first use, and the timezones are memorized by the location
+rounded to the grid of MEMO_GRID degree (~1 km), since the points nearby are mostly in the same timezone.
+'''
+class TimezoneResolver:
+    MEMO_GRID = 100    #cells per degree
+    MEMO_MAX = 65536   #cells to memorize
+    SLOT = timedelta(minutes=15)  #the utc offsets change only at the quarters of utc (except LMT in 19th century)
+
+    __finder = None
+    __finder_lock = Lock()
+    __memo = {}
+    __memo_lock = Lock()
+    __last_slot = (None, None, None, None, None)  #(tz, utc start, utc end, utc offset, tzinfo) of the last conversion
+    __last_slot_lock = Lock()
+
+    @classmethod
+    def __getFinder(cls):
+        if cls.__finder is None:
+            with cls.__finder_lock:
+                if cls.__finder is None:
+                    cls.__finder = TimezoneFinder()
+        return cls.__finder
+
+    @classmethod
+    def __resolve(cls, lat, lon):
+        tz_loc = cls.__getFinder().timezone_at(lat=lat, lng=lon)  #ex: Asia/Taipei
+        if tz_loc is None:
+            logging.warning("no timezone found at (%f, %f), use UTC" % (lat, lon))
+            return pytz.utc
+        return pytz.timezone(tz_loc)
+
+    @classmethod
+    def getTimezone(cls, lat, lon):
+        key = (int(lat * cls.MEMO_GRID // 1), int(lon * cls.MEMO_GRID // 1))
+        with cls.__memo_lock:
+            tz = cls.__memo.get(key)
+        if tz is None:
+            tz = cls.__resolve(lat, lon)  #not hold the lock while resolving
+            with cls.__memo_lock:
+                if len(cls.__memo) >= cls.MEMO_MAX:
+                    cls.__memo.clear()
+                cls.__memo[key] = tz
+        return tz
+
+    # the timezones of the points, in order
+    @classmethod
+    def getTimezones(cls, pts):
+        pts = list(pts)
+        return cls.getTimezonesOf([pt.lat for pt in pts], [pt.lon for pt in pts])
+
+    # the timezones of the locations of @lats and @lons, in order
+    @classmethod
+    def getTimezonesOf(cls, lats, lons):
+        grid = cls.MEMO_GRID
+        tzs = []
+        lat0, lat1, lon0, lon1 = 0, 0, 0, 0  #the cell of the last point, empty at first
+        last_tz = None
+        for lat, lon in zip(lats, lons):
+            if not (lat0 <= lat < lat1 and lon0 <= lon < lon1):  #successive points are mostly in the same cell
+                lat0, lon0 = (lat * grid // 1) / grid, (lon * grid // 1) / grid
+                lat1, lon1 = lat0 + 1 / grid, lon0 + 1 / grid
+                last_tz = cls.getTimezone(lat, lon)
+            tzs.append(last_tz)
+        return tzs
+
+    # convert the aware @time to @tz, reusing the utc offset of the last conversion in the same slot
+    @classmethod
+    def toLocaltime(cls, time, tz):
+        with cls.__last_slot_lock:
+            local, cls.__last_slot = cls.__toLocaltime(time, tz, cls.__last_slot)
+        return local
+
+    # convert the aware @time to @tz, reusing the utc offset of @slot if @time is in it,
+    # return (the local time, the slot of the conversion)
+    @classmethod
+    def __toLocaltime(cls, time, tz, slot):
+        last_tz, start, end, offset, tzinfo = slot
+        if tz is last_tz and time.tzinfo is pytz.utc and start <= time < end:
+            return (time + offset).replace(tzinfo=tzinfo), slot
+
+        local = time.astimezone(tz)
+        if time.tzinfo is pytz.utc:
+            start = time.replace(minute=time.minute - time.minute % 15, second=0, microsecond=0)
+            slot = (tz, start, start + cls.SLOT, local.utcoffset(), local.tzinfo)
+        return local, slot
+
+    # the local times of the points, in order; None if the point has no time
+    @classmethod
+    def getLocaltimes(cls, pts):
+        pts = list(pts)
+        return cls.getLocaltimesOf([pt.lat for pt in pts], [pt.lon for pt in pts], [pt.time for pt in pts])
+
+    # the local times of @times at the locations of @lats and @lons, in order; None if the time is None
+    @classmethod
+    def getLocaltimesOf(cls, lats, lons, times):
+        to_local = cls.__toLocaltime
+        slot = (None, None, None, None, None)  #kept by the call, not shared with other threads
+        local_times = []
+        for t, tz in zip(times, cls.getTimezonesOf(lats, lons)):
+            if t is None:
+                local_times.append(None)
+            else:
+                local, slot = to_local(t, tz, slot)
+                local_times.append(local)
+        return local_times
+
 def getLocTimezone(lat, lon):
-    tz_loc = TimezoneFinder().timezone_at(lat=lat, lng=lon)  #ex: Asia/Taipei
-    return pytz.timezone(tz_loc)
+    return TimezoneResolver.getTimezone(lat, lon)
 
 def downloadAsTemp(url):
     ext = url.split('.')[-1]
@@ -45,6 +154,12 @@ def getPtPosText(wpt, fmt='(%.3f, %.3f)'):
     text = fmt % (x/1000, y/1000)
     return text
 
+# the batch of getPtPosText()
+def getPtPosTexts(pts, fmt='(%.3f, %.3f)'):
+    pts = list(pts)
+    xs, ys = CoordinateSystem.TWD97_LatLonToTWD67_TM2Batch([pt.lat for pt in pts], [pt.lon for pt in pts])
+    return [fmt % (x/1000, y/1000) for x, y in zip(xs, ys)]
+
 def getPtEleText(wpt):
     if wpt is not None and wpt.ele is not None:
         return "%.1f m" % (wpt.ele) 
@@ -53,12 +168,19 @@ def getPtEleText(wpt):
 def getPtTimezone(pt):
     return getLocTimezone(lat=pt.lat, lon=pt.lon)
 
+def getPtTimezones(pts):
+    return TimezoneResolver.getTimezones(pts)
+
+# the local times of the points of @trk, in order, from the columns of the track
+def getTrkLocaltimes(trk):
+    return TimezoneResolver.getLocaltimesOf(*trk.getLatLonTimes())
+
 def getPtLocaltime(pt, tz=None):
-    if tz is None:
-        tz = getLocTimezone(lat=pt.lat, lon=pt.lon)
     if pt is not None and pt.time is not None:
+        if tz is None:
+            tz = getLocTimezone(lat=pt.lat, lon=pt.lon)
         #assume time is localized by pytz.utc
-        return pt.time.astimezone(tz)
+        return TimezoneResolver.toLocaltime(pt.time, tz)
     return None
 
 def getPtTimeText(wpt, tz=None):
@@ -97,7 +219,10 @@ Draw Text with Color-filled Bounding-Box
 '''
 def drawTextBg(draw, xy, text, fill, font, bg_fill="white"):
     x, y = xy
-    w, h = font.getsize(text)
+    if hasattr(font, 'getsize'):
+        w, h = font.getsize(text)
+    else:  #Pillow >= 10
+        left, top, w, h = font.getbbox(text)
     #bg
     draw.rectangle((x, y, x + w, y + h), fill=bg_fill)
     #text
@@ -192,6 +317,63 @@ def imageIsTransparent(img):
         return True
     return False
 
+#return the RGBA if all the pixels of @img are the same color, or None
+def getUniformColor(img):
+    extrema = img.getextrema()
+    if not isinstance(extrema[0], tuple):  #single band
+        extrema = (extrema,)
+    for _min, _max in extrema:
+        if _min != _max:
+            return None
+    return img.crop((0, 0, 1, 1)).convert("RGBA").getpixel((0, 0))
+
+#return the RGBA if the tile image of the encoded @data is uniform, or None (also if not decodable)
+def getUniformColorOfData(data):
+    try:
+        return getUniformColor(Image.open(BytesIO(data)))
+    except Exception as ex:
+        logging.warning("decode tile error: %s" % (str(ex),))
+        return None
+
+#tune alpha channel by @alpha, which between 0.0~1.0
+def tuneAlpha(img, alpha):
+    logging.debug("prepare to tune alpha...")
+    if img.mode != "RGBA":
+        logging.warning("not support mode '%s' to tune alpha" % (img.mode,))
+        return
+
+    alpha = int(alpha*256)
+
+    #optimize
+    min_a, max_a = img.getextrema()[3];
+    if alpha == 256 or max_a == 0:
+        return img
+    if alpha == 0 or min_a == 255:
+        img = img.copy()  #the image may be cached or shared
+        img.putalpha(alpha)
+        return img
+
+    logging.debug("start to tune alpha...")
+
+    #tune alpha channel by the lookup table
+    bands = img.split()
+    lut = [(p * alpha) >> 8 for p in range(256)]
+    result = Image.merge("RGBA", bands[:3] + (bands[3].point(lut),))
+
+    logging.debug("end to tune alpha...")
+    return result
+
+#combine @img over @basemap, alpha between 0.0~1.0
+def combineImage(basemap, img, alpha):
+    if imageIsTransparent(img):
+        if alpha != 1.0:
+            img = tuneAlpha(img, alpha)
+        return Image.alpha_composite(basemap, img)
+    else:
+        if alpha != 1.0:
+            return Image.blend(basemap, img, alpha)
+        return img
+
 def saveXml(xml_root, filepath, enc="UTF-8"):
     #no fromat
     #tree = ET.ElementTree(element=root)
@@ -210,7 +392,7 @@ def listdiff(list1, list2):
 def mkdirSafely(path, is_recursive=True):
     if not os.path.exists(path):
         if is_recursive:
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)  #may be created by other threads
         else:
             os.mkdir(path)
 
@@ -437,6 +619,20 @@ class GeoInfo:
             raise ValueError("Unknown coord system '%s'" % (self.__coord_sys,))
         return geo.pixel(self.__level)
 
+    # the batch of getPixelByCoord(), return the list of (px, py)
+    def getPixelsByCoords(self, xs, ys):
+        if self.__coord_sys == TWD67:
+            lats, lons = CoordinateSystem.TWD67_TM2ToTWD97_LatLonBatch(xs, ys)
+        elif self.__coord_sys == TWD97:
+            lats, lons = CoordinateSystem.TWD97_TM2ToTWD97_LatLonBatch(xs, ys)
+        else:
+            raise ValueError("Unknown coord system '%s'" % (self.__coord_sys,))
+
+        #as GeoPoint, convert to the pixel of max level, then to the level
+        shift = GeoPoint.MAX_LEVEL - self.__level
+        pxs, pys = TileSystem.getPixcelXYByLatLonBatch(lats, lons, GeoPoint.MAX_LEVEL)
+        return [(int(px) >> shift, int(py) >> shift) for px, py in zip(pxs, pys)]
+
 #The UI of settings to access conf
 class AreaSelectorSettings(Dialog):
     def __init__(self, master):
@@ -0,0 +1,75 @@
+import os
+import pytest
+from io import BytesIO
+from PIL import Image
+
+from src import conf
+from src.tile import MapDescriptor, DBDiskCache, FileDiskCache
+from script.cache_convert import parseTilePath, importTiles, exportTiles
+
+
+MAP_XML = """<customMapSource>
+    <name>convert</name>
+    <minZoom>0</minZoom>
+    <maxZoom>18</maxZoom>
+    <tileType>png</tileType>
+    <url>http://127.0.0.1:1/{$z}/{$x}/{$y}.png</url>
+</customMapSource>"""
+
+def genPngData(color):
+    buf = BytesIO()
+    Image.new("RGB", (256, 256), color).save(buf, "PNG")
+    return buf.getvalue()
+
+def genDesc():
+    return MapDescriptor.parseXml(xmlstr=MAP_XML, id="convert")
+
+#the tile files of the 3 layouts, as the relative path -> (level, x, y, data, mtime)
+TILE_FILES = {
+    "16-1-2.png": (16, 1, 2, genPngData("green"), 1000000),
+    "16/3-4.png": (16, 3, 4, genPngData("red"), 2000000),
+    "17/5/6.png": (17, 5, 6, b'not a png', 3000000),
+}
+
+
+class TestParseTilePath:
+    @pytest.mark.parametrize("dirpath, filename, expected", [
+        ("/tiles", "16-1-2.jpg", (16, 1, 2)),
+        ("/tiles/16", "1-2.png", (16, 1, 2)),
+        ("/tiles/16/1", "2.png", (16, 1, 2)),
+        ("/tiles/a", "1-2.png", None),
+        ("/tiles", "readme.txt", None),
+    ])
+    def test_parse(self, dirpath, filename, expected):
+        assert parseTilePath(dirpath, filename) == expected
+
+
+class TestConvert:
+    def writeTileFiles(self, src_dir):
+        for relpath, (level, x, y, data, mtime) in TILE_FILES.items():
+            path = os.path.join(src_dir, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (mtime, mtime))
+
+    def test_round_trip(self, tmp_path):
+        src_dir, db_dir, dst_dir = (str(tmp_path / name) for name in ("src", "db", "dst"))
+        os.makedirs(db_dir)
+        self.writeTileFiles(src_dir)
+        desc = genDesc()
+
+        importTiles(desc, src_dir, db_dir, workers=2, batch_size=2)
+        db = DBDiskCache(db_dir, desc, conf.DB_SCHEMA, is_concurrency=False)
+        db.start()
+        try:
+            tiles = sorted(db.iterTiles())
+            assert tiles == sorted(TILE_FILES.values())
+            assert db.getColors(16, range(5), range(5)) == {(1, 2): (0, 128, 0, 255), (3, 4): (255, 0, 0, 255)}
+        finally:
+            db.close()
+
+        exportTiles(desc, db_dir, dst_dir, workers=2, batch_size=2)
+        files = FileDiskCache(dst_dir, desc)
+        for level, x, y, data, mtime in TILE_FILES.values():
+            assert files.get(level, x, y) == (data, mtime)
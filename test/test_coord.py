@@ -1,8 +1,82 @@
+import random
 import pytest
 
+from src import coord
+from src.coord import TileSystem, CoordinateSystem
+
+
+def genLatLons(n, seed=0):
+    rnd = random.Random(seed)
+    #mostly around Taiwan, and some over the world
+    lats = [rnd.uniform(21.5, 25.5) if i % 4 else rnd.uniform(-85.0, 85.0) for i in range(n)]
+    lons = [rnd.uniform(119.0, 122.5) if i % 4 else rnd.uniform(-180.0, 180.0) for i in range(n)]
+    return lats, lons
+
+@pytest.fixture(params=["numpy", "python"])
+def batch_impl(request, monkeypatch):
+    if request.param == "numpy":
+        if coord.np is None:
+            pytest.skip("numpy is not installed")
+    else:
+        monkeypatch.setattr(coord, "np", None)
+    return request.param
+
 
 class TestCoord:
-    pass
+    def test_scalar_values(self):
+        x, y = CoordinateSystem.TWD97_LatLonToTWD97_TM2(23.97, 120.97)
+        assert x == pytest.approx(246947.04476728308, abs=1e-6)
+        assert y == pytest.approx(2651701.041948539, abs=1e-6)
+        x, y = CoordinateSystem.TWD97_LatLonToTWD67_TM2(25.04, 121.56)
+        assert x == pytest.approx(305678.0473142746, abs=1e-6)
+        assert y == pytest.approx(2770528.6215622514, abs=1e-6)
+        assert TileSystem.getPixcelXYByLatLon(22.0, 120.7, 23) == (1793745369, 939157741)
+
+    def test_latlon_to_tm2_batch(self, batch_impl):
+        lats, lons = genLatLons(10000)
+        xs, ys = CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch(lats, lons)
+        assert len(xs) == len(ys) == len(lats)
+        for lat, lon, x, y in zip(lats, lons, xs, ys):
+            exp_x, exp_y = CoordinateSystem.TWD97_LatLonToTWD97_TM2(lat, lon)
+            assert x == pytest.approx(exp_x, rel=1e-12, abs=1e-6)
+            assert y == pytest.approx(exp_y, rel=1e-12, abs=1e-6)
+
+    def test_tm2_to_latlon_batch(self, batch_impl):
+        xs, ys = CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch(*genLatLons(10000, seed=1))
+        lats, lons = CoordinateSystem.TWD97_TM2ToTWD97_LatLonBatch(xs, ys)
+        for x, y, lat, lon in zip(xs, ys, lats, lons):
+            exp_lat, exp_lon = CoordinateSystem.TWD97_TM2ToTWD97_LatLon(x, y)
+            assert lat == pytest.approx(exp_lat, rel=1e-12, abs=1e-9)
+            assert lon == pytest.approx(exp_lon, rel=1e-12, abs=1e-9)
+
+    def test_twd67_batch(self, batch_impl):
+        lats, lons = genLatLons(1000, seed=2)
+        xs, ys = CoordinateSystem.TWD97_LatLonToTWD67_TM2Batch(lats, lons)
+        for lat, lon, x, y in zip(lats, lons, xs, ys):
+            exp_x, exp_y = CoordinateSystem.TWD97_LatLonToTWD67_TM2(lat, lon)
+            assert (x, y) == pytest.approx((exp_x, exp_y), rel=1e-12, abs=1e-6)
+
+        lats, lons = CoordinateSystem.TWD67_TM2ToTWD97_LatLonBatch(xs, ys)
+        for x, y, lat, lon in zip(xs, ys, lats, lons):
+            exp_lat, exp_lon = CoordinateSystem.TWD67_TM2ToTWD97_LatLon(x, y)
+            assert (lat, lon) == pytest.approx((exp_lat, exp_lon), rel=1e-12, abs=1e-9)
+
+    @pytest.mark.parametrize("level", [0, 10, 16, 23])
+    def test_pixel_batch(self, batch_impl, level):
+        lats, lons = genLatLons(10000, seed=3)
+        lats += [90.0, -90.0, 0.0]  #out of the valid range, or the origin
+        lons += [190.0, -190.0, 0.0]
+        pxs, pys = TileSystem.getPixcelXYByLatLonBatch(lats, lons, level)
+        for lat, lon, px, py in zip(lats, lons, pxs, pys):
+            exp_px, exp_py = TileSystem.getPixcelXYByLatLon(lat, lon, level)
+            #the math lib may differ from numpy in the last bit, which may round to the next pixel
+            assert abs(px - exp_px) <= 1 and abs(py - exp_py) <= 1
+
+    def test_empty_batch(self, batch_impl):
+        xs, ys = CoordinateSystem.TWD97_LatLonToTWD97_TM2Batch([], [])
+        assert len(xs) == len(ys) == 0
+        pxs, pys = TileSystem.getPixcelXYByLatLonBatch([], [], 10)
+        assert len(pxs) == len(pys) == 0
 
 
 # (70.57927709, 45.59941973, 1548706.792, 8451449.199) latlon to tm2= (-1855491.6582705057, 9425042.93398287) diff= (-3404198.4502705056, 973593.7349828705)
@@ -0,0 +1,195 @@
+import os
+import time
+import pytest
+from io import BytesIO
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+from src import conf
+from src.tile import MapDescriptor, DBDiskCache
+from script.download_all_tiles import formatDuration, BBoxArea, RateLimiter, SeedJournal, Seeder
+
+
+MAP_XML = """<customMapSource>
+    <name>seed</name>
+    <minZoom>0</minZoom>
+    <maxZoom>18</maxZoom>
+    <tileType>png</tileType>
+    <url>http://%s:%d/{$z}/{$x}/{$y}.png</url>
+    <expireDays>30</expireDays>
+</customMapSource>"""
+
+def genPngData():
+    buf = BytesIO()
+    Image.new("RGB", (256, 256), "green").save(buf, "PNG")
+    return buf.getvalue()
+
+PNG_DATA = genPngData()
+
+AREA = BBoxArea(121.50, 25.02, 121.53, 25.05)
+LEVELS = range(14, 16)
+
+#the tiles of the area, as (level, x, y)
+def genTiles(area, levels):
+    return {(level, x, y) for level in levels
+            for x, y_ranges in area.genColumns(level) for r in y_ranges for y in r}
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  #keep-alive
+
+    def do_GET(self):
+        tile = tuple(int(v) for v in self.path[1:].replace('.png', '').split('/'))
+        with self.server.lock:
+            self.server.requested.append(tile)
+        if tile in self.server.failed:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(PNG_DATA)))
+        self.end_headers()
+        self.wfile.write(PNG_DATA)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def tile_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    server.daemon_threads = True
+    server.lock = Lock()
+    server.requested = []
+    server.failed = set()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestFormatDuration:
+    @pytest.mark.parametrize("secs, expected", [
+        (0, "00:00:00"),
+        (59.9, "00:00:59"),
+        (3661, "01:01:01"),
+        (86399, "23:59:59"),
+        (86400, "1d 00:00:00"),  #not wrap at a day
+        (100 * 86400 + 5, "100d 00:00:05"),
+    ])
+    def test_format(self, secs, expected):
+        assert formatDuration(secs) == expected
+
+
+class TestRateLimiter:
+    def test_shared_rate(self):
+        limiter = RateLimiter(100)
+
+        def job():
+            for i in range(5):
+                limiter.acquire()
+
+        start = time.time()
+        workers = [Thread(target=job) for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        assert time.time() - start >= 19 / 100 - 0.01  #the first is not delayed
+
+    def test_no_limit(self):
+        limiter = RateLimiter(0)
+        start = time.time()
+        for i in range(1000):
+            limiter.acquire()
+        assert time.time() - start < 0.1
+
+
+class TestSeedJournal:
+    JOB = {'map_id': 'seed', 'levels': [14, 15], 'area': AREA.toJson()}
+
+    def test_resume(self, tmp_path):
+        path = str(tmp_path / "seed.json")
+        journal = SeedJournal(path, self.JOB)
+        journal.setDone(14, 1)
+        journal.setDone(15, 3)
+        journal.save()
+
+        journal = SeedJournal(path, dict(self.JOB))
+        assert journal.isDone(14, 1) and journal.isDone(15, 3)
+        assert not journal.isDone(14, 3)
+
+        journal.remove()
+        assert not os.path.exists(path)
+
+    def test_save_periodically(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(SeedJournal, 'SAVE_PERIOD', 0)
+        path = str(tmp_path / "seed.json")
+        SeedJournal(path, self.JOB).setDone(14, 1)
+        assert SeedJournal(path, self.JOB).isDone(14, 1)
+
+    def test_another_job(self, tmp_path):
+        path = str(tmp_path / "seed.json")
+        journal = SeedJournal(path, self.JOB)
+        journal.setDone(14, 1)
+        journal.save()
+        assert not SeedJournal(path, dict(self.JOB, levels=[14, 16])).isDone(14, 1)
+
+    def test_broken(self, tmp_path):
+        path = tmp_path / "seed.json"
+        path.write_text('{"job": ')
+        assert not SeedJournal(str(path), self.JOB).isDone(14, 1)
+
+
+class TestSeeder:
+    @pytest.fixture
+    def desc(self, tile_server):
+        return MapDescriptor.parseXml(xmlstr=MAP_XML % tile_server.server_address, id="seed")
+
+    def seed(self, tmp_path, desc, force=False):
+        return Seeder(desc, str(tmp_path), AREA, LEVELS, workers=4, rate=0, force=force).run()
+
+    def cachedTiles(self, tmp_path, desc):
+        cache = DBDiskCache(str(tmp_path), desc, conf.DB_SCHEMA, is_concurrency=False)
+        cache.start()
+        try:
+            tiles = set()
+            for level in LEVELS:
+                for x, y_ranges in AREA.genColumns(level):
+                    for r in y_ranges:
+                        tiles.update((level, x, y) for x, y in cache.getMany(level, range(x, x+1), r))
+            return tiles
+        finally:
+            cache.close()
+
+    def test_seed(self, tmp_path, tile_server, desc):
+        tiles = genTiles(AREA, LEVELS)
+        assert self.seed(tmp_path, desc)
+        assert sorted(tile_server.requested) == sorted(tiles)
+        assert self.cachedTiles(tmp_path, desc) == tiles
+        assert not os.path.exists(str(tmp_path / "seed.seed.json"))
+
+        #the fresh tiles are skipped, unless forced
+        tile_server.requested.clear()
+        assert self.seed(tmp_path, desc)
+        assert tile_server.requested == []
+        assert self.seed(tmp_path, desc, force=True)
+        assert sorted(tile_server.requested) == sorted(tiles)
+
+    def test_resume(self, tmp_path, tile_server, desc):
+        tiles = genTiles(AREA, LEVELS)
+        failed = min(tiles)
+        tile_server.failed.add(failed)
+        assert not self.seed(tmp_path, desc)
+        assert self.cachedTiles(tmp_path, desc) == tiles - {failed}
+        assert os.path.exists(str(tmp_path / "seed.seed.json"))
+
+        #only the column with the failed tile is not done, even forced
+        tile_server.failed.clear()
+        tile_server.requested.clear()
+        assert self.seed(tmp_path, desc, force=True)
+        level, x, y = failed
+        assert sorted(tile_server.requested) == sorted(t for t in tiles if t[:2] == (level, x))
+        assert self.cachedTiles(tmp_path, desc) == tiles
+        assert not os.path.exists(str(tmp_path / "seed.seed.json"))
@@ -0,0 +1,333 @@
+import random
+import pytest
+import pytz
+from datetime import datetime, timedelta
+from xml.etree import ElementTree as ET
+
+from src import gpx, conf
+from src.gpx import TrackPixels, Track, ColumnarTrack, TrackPoint, GpsDocument
+from src.coord import TileSystem
+
+
+#the pixels of max level of a random walk, about 1 m per step
+def genTrackPixels(n, seed=0):
+    rnd = random.Random(seed)
+    lat, lon = 24.0, 121.0
+    pxs, pys = [], []
+    for i in range(n):
+        lat += rnd.uniform(-1e-5, 1e-5)
+        lon += rnd.uniform(-1e-5, 1e-5)
+        px, py = TileSystem.getPixcelXYByLatLon(lat, lon, 23)
+        pxs.append(px)
+        pys.append(py)
+    return pxs, pys
+
+def toList(xy):
+    return xy if isinstance(xy, list) else xy.tolist()
+
+
+class TestTrackPixels:
+    @pytest.mark.parametrize("level", [12, 14, 16, 18])
+    def test_simplify_numpy_list(self, level, monkeypatch):
+        pxs, pys = genTrackPixels(3000)
+        xy = toList(TrackPixels(pxs, pys).getXY(level, 0.5))
+        monkeypatch.setattr(gpx, 'np', None)
+        assert TrackPixels(pxs, pys).getXY(level, 0.5) == xy
+
+    def test_simplify_dense(self):
+        pxs, pys = genTrackPixels(3000)
+        raw = toList(TrackPixels(pxs, pys).getXY(14, 0))
+        xy = toList(TrackPixels(pxs, pys).getXY(14, 0.5))
+        assert xy[:2] == raw[:2] and xy[-2:] == raw[-2:]
+        assert len(xy) < len(raw) // 4
+
+    def test_simplify_sparse(self):
+        #the points are on distinct pixels mostly, which are not simplified but on the same pixel
+        pxs, pys = genTrackPixels(3000)
+        raw = toList(TrackPixels(pxs, pys).getXY(20, 0))
+        pts = list(zip(raw[0::2], raw[1::2]))
+        distinct = [pt for i, pt in enumerate(pts) if i == 0 or pt != pts[i-1]]
+        xy = toList(TrackPixels(pxs, pys).getXY(20, 0.5))
+        assert xy == [v for pt in distinct for v in pt]
+
+@pytest.fixture(params=["numpy", "python"])
+def pixels_impl(request, monkeypatch):
+    if request.param == "numpy":
+        if gpx.np is None:
+            pytest.skip("numpy is not installed")
+    else:
+        monkeypatch.setattr(gpx, "np", None)
+    return request.param
+
+#the pixels of max level from the flat pixels @xy, to get them back at max level
+def genPixels(xy):
+    return TrackPixels(xy[0::2], xy[1::2])
+
+MAX_LEVEL = 23
+
+class TestTrackPixelsHit:
+    RECT = (2, 2, 8, 8)
+
+    def test_crossing(self, pixels_impl):
+        pixels = genPixels([0, 5, 10, 5])  #both ends out of the rect
+        assert pixels.intersects(MAX_LEVEL, self.RECT)
+        assert pixels.getImageRuns(MAX_LEVEL, self.RECT, 0, 0) == [[0, 5, 10, 5]]
+
+        pixels = genPixels([0, 10, 10, 0])  #the diagonal across the corner (5, 5)
+        assert pixels.intersects(MAX_LEVEL, (5, 5, 9, 9))
+
+    def test_near_miss(self, pixels_impl):
+        pixels = genPixels([0, 10, 10, 0])  #the boxes overlap, but the diagonal passes by the corner
+        assert not pixels.intersects(MAX_LEVEL, (6, 6, 9, 9))
+        assert pixels.getImageRuns(MAX_LEVEL, (6, 6, 9, 9), 0, 0) == []
+
+        pixels = genPixels([0, 0, 1, 1, 20, 0])  #out of the rect
+        assert not pixels.intersects(MAX_LEVEL, self.RECT)
+
+    def test_single_point(self, pixels_impl):
+        pixels = genPixels([5, 5])
+        assert pixels.intersects(MAX_LEVEL, self.RECT)
+        assert pixels.getImageRuns(MAX_LEVEL, self.RECT, 1, 2) == [[4, 3, 4, 3]]
+        assert not pixels.intersects(MAX_LEVEL, (6, 6, 9, 9))
+        assert genPixels([]).getImageRuns(MAX_LEVEL, self.RECT, 0, 0) == []
+
+    def test_runs(self, pixels_impl):
+        #in, out, and in again
+        xy = [0, 5, 5, 5, 20, 5, 20, 20, 5, 7, 0, 7]
+        runs = genPixels(xy).getImageRuns(MAX_LEVEL, self.RECT, 1, 2)
+        assert runs == [[-1, 3, 4, 3, 19, 3], [19, 18, 4, 5, -1, 5]]
+
+    @pytest.mark.parametrize("tolerance", [0, 0.5])
+    def test_runs_chunks(self, tolerance, monkeypatch):
+        #the runs of the near chunks are the same as the ones of all the points
+        monkeypatch.setattr(gpx.TrackLevelPixels, 'CHUNK', 16)
+        pxs, pys = genTrackPixels(2000)
+        level = 17
+        xy = toList(TrackPixels(pxs, pys).getXY(level, 0))
+        xs, ys = xy[0::2], xy[1::2]
+        cx, cy = (min(xs) + max(xs)) // 2, (min(ys) + max(ys)) // 2
+        rects = [(cx - 5, cy - 5, cx + 5, cy + 5), (min(xs), min(ys), min(xs) + 3, min(ys) + 3),
+                 (cx - 50, cy, cx + 50, cy), (max(xs) + 1, cy, max(xs) + 9, cy + 9)]
+        expected = []
+        for rect in rects:
+            runs = TrackPixels(pxs, pys).getImageRuns(level, rect, cx, cy, tolerance)
+            expected.append(runs)
+        monkeypatch.setattr(gpx, "np", None)
+        assert [TrackPixels(pxs, pys).getImageRuns(level, rect, cx, cy, tolerance) for rect in rects] == expected
+        assert any(expected) and not expected[-1]
+
+    def test_chunk_boxes(self, monkeypatch):
+        if gpx.np is None:
+            pytest.skip("numpy is not installed")
+        monkeypatch.setattr(gpx.TrackLevelPixels, 'CHUNK', 2)
+        #the chunks: [p0, p1, p2], [p2, p3, p4], [p4, p5]
+        xy = gpx.np.array([0, 0, 1, 0, 2, 0, 50, 50, 100, 0, 101, 0], dtype=gpx.np.int64)
+        lv = gpx.TrackLevelPixels(xy, 0)
+        assert [len(xy) // 2 for xy in lv.genNearXYs((0, 0, 1, 1))] == [3]
+        assert [xy.tolist() for xy in lv.genNearXYs((99, 0, 101, 0))] == [[2, 0, 50, 50, 100, 0, 101, 0]]
+        assert [xy.tolist() for xy in lv.genNearXYs((40, 40, 60, 60))] == [[2, 0, 50, 50, 100, 0]]
+        assert list(lv.genNearXYs((200, 200, 300, 300))) == []
+
+
+def genPoint(i):
+    pt = TrackPoint(24.0 + i * 1e-3, 121.0 - i * 1e-3)
+    pt.ele = None if i % 5 == 1 else 100.0 + i
+    pt.time = None if i % 7 == 3 else datetime(2016, 3, 1, tzinfo=pytz.utc) + timedelta(hours=i)
+    return pt
+
+#the same track of @n points, in both storages
+def genTracks(n):
+    trks = (Track(), ColumnarTrack())
+    for trk in trks:
+        trk.name = "trk"
+        trk.color = "Red"
+        for i in range(n):
+            trk.add(genPoint(i))
+    return trks
+
+def toFields(trk):
+    return [(pt.lat, pt.lon, pt.ele, pt.time) for pt in trk]
+
+class TestColumnarTrack:
+    def assertSame(self, trk, ctrk):
+        assert toFields(ctrk) == toFields(trk)
+        assert len(ctrk) == len(trk)
+        assert ctrk.bounds == trk.bounds
+        assert ctrk.time == trk.time
+        assert toList(ctrk.getPixels().getXY(16, 0)) == toList(trk.getPixels().getXY(16, 0))
+
+    def test_add(self):
+        self.assertSame(*genTracks(20))
+
+    def test_getitem(self):
+        trk, ctrk = genTracks(20)
+        assert toFields(ctrk[3:9:2]) == toFields(trk[3:9:2])
+        assert toFields([ctrk[-1], ctrk[0]]) == toFields([trk[-1], trk[0]])
+        with pytest.raises(IndexError):
+            ctrk[20]
+
+    def test_setitem(self):
+        trk, ctrk = genTracks(20)
+        for t in (trk, ctrk):
+            t[0] = genPoint(100)
+            t[-1] = genPoint(101)
+            t[2:5] = [genPoint(102), genPoint(103)]  #shorter
+            t[8:9] = [genPoint(104), genPoint(105), genPoint(106)]  #longer
+            t[10:10] = [genPoint(107)]  #insert
+        self.assertSame(trk, ctrk)
+
+    def test_delitem(self):
+        trk, ctrk = genTracks(20)
+        for t in (trk, ctrk):
+            del t[0]
+            del t[-1]
+            del t[3:6]
+            del t[::4]
+        self.assertSame(trk, ctrk)
+
+    def test_remove(self):
+        trk, ctrk = genTracks(20)
+        trk.remove(trk[3])
+        ctrk.remove(ctrk[3])  #by the fields
+        self.assertSame(trk, ctrk)
+
+        for t in (trk, ctrk):
+            with pytest.raises(ValueError):
+                t.remove(genPoint(100))
+
+    def test_remove_no_ele(self):
+        trk, ctrk = genTracks(20)
+        trk.remove(trk[1])  #the ele is None
+        ctrk.remove(ctrk[1])
+        self.assertSame(trk, ctrk)
+
+    def test_split(self):
+        trk, ctrk = genTracks(30)
+        split_fn = lambda pt1, pt2: pt1.ele is None  #after the points without ele
+        trks, ctrks = trk.split(split_fn), ctrk.split(split_fn)
+        assert len(trks) == len(ctrks) > 1
+        for t, ct in zip(trks, ctrks):
+            assert (ct.name, ct.color) == (t.name, t.color)
+            self.assertSame(t, ct)
+
+        trks, ctrks = trk.splitAt([0, 5, 5, 12, 30]), ctrk.splitAt([0, 5, 5, 12, 30])  #the empty ones are skipped
+        assert [len(t) for t in ctrks] == [len(t) for t in trks] == [5, 7, 18]
+        assert [t.name for t in ctrks] == [t.name for t in trks] == ["trk-1", "trk-2", "trk-3"]
+
+    def test_trkseg_element(self):
+        doc = GpsDocument()
+        xmls = []
+        for t in genTracks(20):
+            parent = ET.Element('trk')
+            doc.subTrkSegElement(parent, t)
+            xmls.append(ET.tostring(parent))
+        assert xmls[0] == xmls[1]
+
+    def test_view_not_persisted(self):
+        trk, ctrk = genTracks(5)
+        pt = ctrk[2]
+        pt.ele, pt.time = 1.0, None
+        assert toFields(ctrk) == toFields(trk)  #the view is a copy
+
+        ctrk[2] = pt  #to persist
+        trk[2] = pt
+        self.assertSame(trk, ctrk)
+
+
+GPX_10 = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.0" creator="test">
+  <bounds minlat="23.0" minlon="120.0" maxlat="24.5" maxlon="121.5"/>
+  <wpt lat="24.1" lon="121.1">
+    <ele>1234.5</ele>
+    <time>2016-03-01T01:02:03Z</time>
+    <name>peak</name>
+    <cmt>comment</cmt>
+    <desc>description</desc>
+    <sym>Summit</sym>
+  </wpt>
+  <trk>
+    <name>day 1</name>
+    <trkseg>
+      <trkpt lat="24.0" lon="121.0"><ele>100</ele><time>2016-03-01T00:00:00Z</time><name>pt 1</name></trkpt>
+      <trkpt lat="25.0" lon="122.0"><time>2016-03-01T00:00:01.5Z</time></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+GPX_11 = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" version="1.1">
+  <metadata><bounds minlat="24.0" minlon="121.0" maxlat="24.1" maxlon="121.1"/></metadata>
+  <trk>
+    <name>A</name>
+    <extensions><gpxx:TrackExtension><gpxx:DisplayColor>Red</gpxx:DisplayColor></gpxx:TrackExtension></extensions>
+    <trkseg>%s</trkseg>
+  </trk>
+  <trk><trkseg><trkpt lat="24.5" lon="121.5"/></trkseg></trk>
+</gpx>
+""" % ("".join('<trkpt lat="24.0%d" lon="121.0%d"><ele>%d</ele></trkpt>' % (i, i, i) for i in range(10)),)
+
+@pytest.fixture(params=["list", "columnar"])
+def trk_storage(request, monkeypatch):
+    monkeypatch.setattr(conf, 'TRK_STORAGE', request.param)
+    return request.param
+
+class TestGpsDocumentLoad:
+    def test_gpx10(self, trk_storage):
+        doc = GpsDocument()
+        doc.load(filestring=GPX_10)
+
+        assert len(doc.way_points) == 1
+        wpt = doc.way_points[0]
+        assert (wpt.lat, wpt.lon, wpt.ele) == (24.1, 121.1, 1234.5)
+        assert wpt.time == datetime(2016, 3, 1, 1, 2, 3, tzinfo=pytz.utc)
+        assert (wpt.name, wpt.cmt, wpt.desc, wpt.sym) == ("peak", "comment", "description", "Summit")
+
+        assert len(doc.tracks) == 1
+        trk = doc.tracks[0]
+        assert trk.name == "day 1"  #not the name of the trkpt
+        assert isinstance(trk, ColumnarTrack if trk_storage == "columnar" else Track)
+        assert toFields(trk) == [
+                (24.0, 121.0, 100.0, datetime(2016, 3, 1, tzinfo=pytz.utc)),
+                (25.0, 122.0, None, datetime(2016, 3, 1, 0, 0, 1, 500000, tzinfo=pytz.utc))]
+
+        #the bounds of the file, merged with the points'
+        assert (doc.minlat, doc.maxlat, doc.minlon, doc.maxlon) == (23.0, 25.0, 120.0, 122.0)
+
+    def test_gpx11(self, trk_storage):
+        doc = GpsDocument()
+        doc.load(filestring=GPX_11)
+        assert [(trk.name, trk.color, len(trk)) for trk in doc.tracks] == \
+                [("A", "Red", 10), ("(No Title)", "DarkMagenta", 1)]
+        assert [pt.ele for pt in doc.tracks[0]] == [float(i) for i in range(10)]
+        assert (doc.minlat, doc.maxlat, doc.minlon, doc.maxlon) == (24.0, 24.5, 121.0, 121.5)
+
+    def test_progress(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(GpsDocument, 'PROGRESS_PERIOD', 4)
+        path = tmp_path / "test.gpx"
+        path.write_text(GPX_11)
+        total = path.stat().st_size
+
+        progress = []
+        GpsDocument().load(filename=str(path), progress_cb=lambda read, total: progress.append((read, total)))
+        assert len(progress) == 3  #per 4 of 11 points, and the end
+        assert all(t == total for read, t in progress)
+        assert [read for read, t in progress] == sorted(read for read, t in progress)
+        assert progress[-1] == (total, total)
+
+    @pytest.mark.parametrize("txt", [
+        "2016-03-01T01:02:03Z",
+        "0999-12-31T23:59:59Z",
+        "2016-03-01T01:02:03.5Z",
+        "2016-03-01T01:02:03.123Z",
+        "2016-03-01T01:02:03.000001Z",
+    ])
+    def test_time(self, txt):
+        fmt = "%Y-%m-%dT%H:%M:%S.%fZ" if "." in txt else "%Y-%m-%dT%H:%M:%SZ"
+        expected = datetime.strptime(txt, fmt).replace(tzinfo=pytz.utc)
+        assert GpsDocument()._GpsDocument__toUTCTime(txt) == expected
+
+    @pytest.mark.parametrize("txt", ["2016-03-01T01:02:03", "2016-03-01 01:02:03Z", "2016-13-01T01:02:03Z"])
+    def test_time_invalid(self, txt):
+        with pytest.raises(ValueError):
+            GpsDocument()._GpsDocument__toUTCTime(txt)
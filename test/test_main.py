@@ -0,0 +1,121 @@
+import pytest
+from PIL import Image
+
+import main
+from main import MapBoard, MapController, MapAgent, MapAttr
+from src.tile import MapDescriptor, TileAgent
+from src.raw import TWD97, COORD_100M
+from src.gpx import Track, TrackPoint
+from src.util import GeoPoint
+
+
+class TestExposedStrips:
+    def test_none(self):
+        assert MapBoard.getExposedStrips((0, 0, 800, 600), 800, 600, 64) == []
+
+    def test_pan_down_right(self):
+        #the rendered is moved by (30, 20)
+        strips = MapBoard.getExposedStrips((30, 20, 830, 620), 800, 600)
+        assert strips == [(0, 0, 800, 20), (0, 20, 30, 600)]
+
+    def test_pan_up_left(self):
+        strips = MapBoard.getExposedStrips((-30, -20, 770, 580), 800, 600)
+        assert strips == [(0, 580, 800, 600), (770, 0, 800, 580)]
+
+    def test_overdraw(self):
+        strips = MapBoard.getExposedStrips((30, 20, 830, 620), 800, 600, 64)
+        assert strips == [(0, 0, 800, 84), (0, 20, 94, 600)]
+        strips = MapBoard.getExposedStrips((-30, -20, 770, 580), 800, 600, 64)
+        assert strips == [(0, 516, 800, 600), (706, 0, 800, 580)]
+
+    def test_out_of_canvas(self):
+        assert MapBoard.getExposedStrips((900, 0, 1700, 600), 800, 600, 64) == [(0, 0, 800, 600)]
+
+
+class TestMapAgent:
+    MAP_XML = """<customMapSource>
+        <name>test</name>
+        <minZoom>0</minZoom>
+        <maxZoom>18</maxZoom>
+        <tileType>png</tileType>
+        <url>http://127.0.0.1:1/{$z}/{$x}/{$y}.png</url>
+    </customMapSource>"""
+    VIEW = MapAttr(16, (25600, 25600), (800, 600))
+    STRIP = MapAttr(16, (25600, 26136), (800, 64))  #the bottom of the view
+
+    @pytest.fixture
+    def agent(self, tmp_path, monkeypatch):
+        self.focused = []
+        monkeypatch.setattr(TileAgent, 'setViewport', lambda agent, *args: self.focused.append(args))
+        agent = MapAgent(MapDescriptor.parseXml(xmlstr=self.MAP_XML, id="test"), str(tmp_path))
+        yield agent
+        agent.close()
+
+    def test_part_not_focus(self, agent):
+        map, attr = agent.genMap(self.VIEW, "async")
+        assert self.focused == [(16, 100, 100, 103, 102)]
+
+        #the strip neither refocuses the downloads, nor replaces the cached map
+        map, strip_attr = agent.genMap(self.STRIP, "async", is_part=True)
+        assert strip_attr.toTileArea() != attr.toTileArea()
+        assert len(self.focused) == 1
+        assert agent._MapAgent__cache_attr is attr
+
+    def test_set_viewport(self, agent):
+        agent.setViewport(self.VIEW)
+        agent.setViewport(self.VIEW.zoomToLevel(20))  #over the max level
+        assert self.focused == [(16, 100, 100, 103, 102), (18, 400, 400, 412, 409)]
+
+
+class TestCoordLabels:
+    @pytest.fixture
+    def ctrl(self, monkeypatch):
+        monkeypatch.setattr(main.Options, 'coordLineSys', TWD97)
+        monkeypatch.setattr(main.Options, 'coordLineDensity', COORD_100M)
+        ctrl = MapController(None)
+        ctrl.level = 16
+        return ctrl
+
+    def drawLabels(self, ctrl, attr, view=None):
+        img = Image.new("RGBA", attr.size, "white")
+        ctrl._MapController__drawCoordValue(img, attr, view)
+        return img
+
+    @pytest.mark.parametrize("strip", [(0, 0, 800, 84), (0, 516, 800, 600), (0, 20, 94, 600), (706, 0, 800, 580)])
+    def test_strip_as_view(self, ctrl, strip):
+        #the labels of the strip are the same as the ones of the whole view, even across the edges
+        px, py = ctrl.geo.pixel(ctrl.level)
+        view = MapAttr(ctrl.level, (px, py), (800, 600))
+        whole = self.drawLabels(ctrl, view)
+
+        left, top, right, bottom = strip
+        attr = MapAttr(ctrl.level, (px + left, py + top), (right - left, bottom - top))
+        img = self.drawLabels(ctrl, attr, view)
+        assert img.tobytes() == whole.crop(strip).tobytes()
+        assert img.tobytes() != Image.new("RGBA", attr.size, "white").tobytes()  #something drawn
+
+
+class TestTrackInImage:
+    LEVEL = 16
+    ATTR = MapAttr(LEVEL, (1000000, 500000), (800, 600))
+
+    #the track of the pixels @pxys of LEVEL, from the left-top of ATTR
+    def genTrack(self, pxys):
+        trk = Track()
+        for px, py in pxys:
+            geo = GeoPoint(px=self.ATTR.left_px + px, py=self.ATTR.up_py + py, level=self.LEVEL)
+            trk.add(TrackPoint(geo.lat, geo.lon))
+        return trk
+
+    @pytest.mark.parametrize("pxys, expected", [
+        ([(400, 300)], True),
+        ([(-100, 300), (900, 300)], True),  #across the image, without any point in it
+        ([(-500, -500), (-100, -100)], False),  #out of the bounds
+        ([(-300, 100), (100, -300)], False),  #the bounds overlap, but the segment passes by the corner
+        ([(-1000, 300)], False),
+    ])
+    def test_in_image(self, pxys, expected):
+        assert MapController(None).isTrackInImage(self.genTrack(pxys), self.ATTR) == expected
+
+    def test_empty(self):
+        assert not MapController(None).isTrackInImage(Track(), self.ATTR)
@@ -0,0 +1,228 @@
+import time
+import pytest
+from io import BytesIO
+from threading import Thread, Lock, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+from src import conf
+from src.net import HttpPool, HttpError, AsyncHttpEngine
+from src.tile import MapDescriptor, TileAgent
+
+
+TILE_DATA = b'\x89PNG fake tile data'
+
+def genPngData():
+    buf = BytesIO()
+    Image.new("RGB", (256, 256), "green").save(buf, "PNG")
+    return buf.getvalue()
+
+PNG_DATA = genPngData()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  #keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.conn_lock:
+            self.server.conn_count += 1
+
+    def do_GET(self):
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path.replace('/redirect/', '/tile/', 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/tile/'):
+            self.sendData(TILE_DATA)
+        elif self.path.startswith('/png/'):
+            self.sendData(PNG_DATA)
+        elif self.path.startswith('/flaky/'):
+            #fail at the first time
+            with self.server.conn_lock:
+                is_first = self.path not in self.server.flaky_paths
+                self.server.flaky_paths.add(self.path)
+            if is_first:
+                self.send_error(503)
+            else:
+                self.sendData(TILE_DATA)
+        elif self.path.startswith('/slow/'):
+            time.sleep(0.5)
+            self.sendData(TILE_DATA)
+        else:
+            self.send_error(404)
+
+    def sendData(self, data):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def tile_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    server.daemon_threads = True
+    server.conn_lock = Lock()
+    server.conn_count = 0
+    server.flaky_paths = set()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def tile_url(server, level, x, y, kind='tile'):
+    host, port = server.server_address
+    return "http://%s:%d/%s/%d/%d/%d.png" % (host, port, kind, level, x, y)
+
+
+class TestHttpPool:
+    def test_reuse_connection(self, tile_server):
+        pool = HttpPool(max_conns_per_host=2)
+        try:
+            for x in range(20):
+                assert pool.get(tile_url(tile_server, 16, x, 0)) == TILE_DATA
+            stats = pool.stats
+            assert stats['requests'] == 20
+            assert stats['created'] == 1
+            assert stats['reused'] == 19
+            assert tile_server.conn_count == 1
+        finally:
+            pool.close()
+
+    def test_max_conns_per_host(self, tile_server):
+        pool = HttpPool(max_conns_per_host=3)
+        errors = []
+
+        def job(x):
+            try:
+                for y in range(10):
+                    assert pool.get(tile_url(tile_server, 16, x, y)) == TILE_DATA
+            except Exception as ex:
+                errors.append(ex)
+
+        try:
+            workers = [Thread(target=job, args=(x,)) for x in range(8)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            assert not errors
+            assert pool.stats['created'] <= 3
+            assert tile_server.conn_count <= 3
+        finally:
+            pool.close()
+
+    def test_redirect(self, tile_server):
+        pool = HttpPool()
+        try:
+            assert pool.get(tile_url(tile_server, 16, 1, 1, 'redirect')) == TILE_DATA
+            assert pool.stats['requests'] == 2
+        finally:
+            pool.close()
+
+    def test_http_error(self, tile_server):
+        pool = HttpPool()
+        try:
+            with pytest.raises(HttpError) as ex:
+                pool.get(tile_url(tile_server, 16, 1, 1, 'none'))
+            assert ex.value.status == 404
+        finally:
+            pool.close()
+
+
+class TestAsyncHttpEngine:
+    def test_many_in_flight(self, tile_server):
+        engine = AsyncHttpEngine(max_conns_per_host=4)
+        try:
+            futures = [engine.submit(tile_url(tile_server, 16, x, y)) for x in range(20) for y in range(10)]
+            for f in futures:
+                assert f.result(timeout=10) == TILE_DATA
+            stats = engine.stats
+            assert stats['requests'] == 200
+            assert stats['created'] <= 4
+            assert stats['created'] + stats['reused'] == 200
+            assert stats['in_flight'] == 0
+            assert tile_server.conn_count <= 4
+        finally:
+            engine.close()
+
+    def test_redirect(self, tile_server):
+        engine = AsyncHttpEngine()
+        try:
+            assert engine.submit(tile_url(tile_server, 16, 1, 1, 'redirect')).result(timeout=10) == TILE_DATA
+            assert engine.stats['requests'] == 2
+        finally:
+            engine.close()
+
+    def test_retry(self, tile_server):
+        engine = AsyncHttpEngine(retries=2, backoff=0.01)
+        try:
+            assert engine.submit(tile_url(tile_server, 16, 1, 1, 'flaky')).result(timeout=10) == TILE_DATA
+            assert engine.stats['retries'] == 1
+        finally:
+            engine.close()
+
+    def test_http_error(self, tile_server):
+        engine = AsyncHttpEngine(retries=2, backoff=0.01)
+        try:
+            with pytest.raises(HttpError) as ex:
+                engine.submit(tile_url(tile_server, 16, 1, 1, 'none')).result(timeout=10)
+            assert ex.value.status == 404
+            assert engine.stats['retries'] == 0  #no retry for 4xx
+        finally:
+            engine.close()
+
+    def test_timeout(self, tile_server):
+        engine = AsyncHttpEngine(timeout=0.1, retries=1, backoff=0.01)
+        try:
+            with pytest.raises(TimeoutError):
+                engine.submit(tile_url(tile_server, 16, 1, 1, 'slow')).result(timeout=10)
+            assert engine.stats['retries'] == 1
+        finally:
+            engine.close()
+
+
+MAP_XML = """<customMapSource>
+    <name>test</name>
+    <minZoom>0</minZoom>
+    <maxZoom>18</maxZoom>
+    <tileType>png</tileType>
+    <url>%s</url>
+</customMapSource>"""
+
+class TestAsyncBackend:
+    def test_get_tile(self, tile_server, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_DL_BACKEND', 'async')
+        host, port = tile_server.server_address
+        url = "http://%s:%d/png/{$z}/{$x}/{$y}.png" % (host, port)
+        desc = MapDescriptor.parseXml(xmlstr=MAP_XML % (url,), id="test_async")
+
+        tiles = [(16, x, y) for x in range(4) for y in range(4)]
+        done = []
+        done_lock = Lock()
+        all_done = Event()
+        def onTileReady(tile_info):
+            with done_lock:
+                done.append(tile_info)
+                if len(done) == len(tiles):
+                    all_done.set()
+
+        agent = TileAgent(desc, str(tmp_path), auto_start=True)
+        try:
+            for level, x, y in tiles:
+                agent.getTile(level, x, y, "async", onTileReady, allow_fake=False)
+            assert all_done.wait(10)
+            assert sorted(done) == sorted(("test_async",) + t for t in tiles)
+
+            img = agent.getTile(16, 1, 1, "async", allow_fake=False)
+            assert img is not None and img.size == (256, 256)
+        finally:
+            agent.close()
@@ -0,0 +1,451 @@
+import time
+import sqlite3
+import pytest
+from io import BytesIO
+from threading import Thread, Event
+from collections import OrderedDict
+from PIL import Image
+
+from src import conf
+from src.tile import MapDescriptor, FileDiskCache, DBDiskCache, TileReqQueue, TileAgent, MemoryCache, MemoryBudget
+
+
+MAP_XML = """<customMapSource>
+    <name>test</name>
+    <minZoom>0</minZoom>
+    <maxZoom>18</maxZoom>
+    <tileType>png</tileType>
+    <url>http://127.0.0.1:1/{$z}/{$x}/{$y}.png</url>
+    <expireDays>%s</expireDays>
+</customMapSource>"""
+
+def genMapDesc(id="test", expire_days=0):
+    return MapDescriptor.parseXml(xmlstr=MAP_XML % (expire_days,), id=id)
+
+def tileData(level, x, y):
+    return b'tile %d-%d-%d' % (level, x, y)
+
+def genPngData():
+    buf = BytesIO()
+    Image.new("RGB", (256, 256), "green").save(buf, "PNG")
+    return buf.getvalue()
+
+PNG_DATA = genPngData()
+
+def waitUntil(cond, timeout=10):
+    deadline = time.time() + timeout
+    while not cond():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+ITEM_BYTES = MemoryCache.ITEM_OVERHEAD + 100  #of the item of 100 bytes data
+
+class TestMemoryCache:
+    def genCache(self, items, **kwargs):
+        return MemoryCache(0, max_bytes=items * ITEM_BYTES, **kwargs)
+
+    def test_evict_lru(self):
+        cache = self.genCache(3)
+        for id in "abc":
+            cache.set(id, 1, b'x' * 100)
+        cache.get("a")  #a is used recently
+        cache.set("d", 1, b'x' * 100)
+        assert cache.getStatus("b") == 0  #evicted, as the initial status
+        assert [cache.get(id)[0] is not None for id in "acd"] == [True] * 3
+        assert cache.stats['evictions'] == 1
+        assert cache.used_bytes == 3 * ITEM_BYTES
+
+    def test_pinned(self):
+        cache = self.genCache(3, is_pinned=TileAgent.isReqStatus)
+        cache.set("a", TileAgent.TILE_EXPIRE | TileAgent.TILE_REQ, b'x' * 100)  #requesting
+        for id in "bcd":
+            cache.set(id, 1, b'x' * 100)
+        assert cache.getStatus("a") == TileAgent.TILE_EXPIRE | TileAgent.TILE_REQ
+        assert cache.getStatus("b") == 0
+        assert cache.stats['evictions'] == 1
+
+    def test_stats(self):
+        cache = self.genCache(10)
+        cache.set("a", 1, b'x' * 100)
+        cache.set("b", 2)  #status only
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        cache.get("c")  #unknown
+        cache.getStatus("a")  #not counted
+        stats = cache.stats
+        assert (stats['hits'], stats['misses']) == (2, 2)
+        assert stats['items'] == 3
+        assert stats['bytes'] == cache.used_bytes == ITEM_BYTES + 2 * MemoryCache.ITEM_OVERHEAD
+
+    def test_budget(self):
+        budget = MemoryBudget(4 * ITEM_BYTES)
+        small = MemoryCache(0, budget=budget)
+        large = MemoryCache(0, budget=budget)
+        small.set("s", 1, b'x' * 100)
+        for id in "abc":
+            large.set(id, 1, b'x' * 100)
+        assert budget.used_bytes == 4 * ITEM_BYTES
+        large.set("d", 1, b'x' * 100)  #the largest is shrunk
+        assert budget.used_bytes == 4 * ITEM_BYTES
+        assert small.getStatus("s") == 1
+        assert large.getStatus("a") == 0
+
+
+class TestDiskCache:
+    @pytest.mark.parametrize("genCache", [
+        lambda path: FileDiskCache(path, genMapDesc()),
+        lambda path: DBDiskCache(path, genMapDesc(), conf.DB_SCHEMA),
+        lambda path: DBDiskCache(path, genMapDesc(), conf.DB_SCHEMA, is_concurrency=False),
+    ])
+    def test_put_signature(self, tmp_path, genCache):
+        cache = genCache(str(tmp_path))
+        cache.start()
+        try:
+            cache.put(16, 0, 0, tileData(16, 0, 0), ts=1000, color=(1, 2, 3, 255))
+            cache.put(16, 1, 0, tileData(16, 1, 0), color=(1, 2, 3, 255))
+            with pytest.raises(TypeError):
+                cache.put(16, 2, 0, tileData(16, 2, 0), (1, 2, 3, 255))  #not taken as the timestamp
+            assert cache.get(16, 0, 0) == (tileData(16, 0, 0), 1000)
+            assert cache.get(16, 1, 0)[1] > 1000
+            assert cache.get(16, 2, 0) == (None, None)
+        finally:
+            cache.close()
+
+
+class TestDBDiskCache:
+    def test_put_get(self, tmp_path):
+        desc = genMapDesc()
+        cache = DBDiskCache(str(tmp_path), desc, conf.DB_SCHEMA)
+        cache.start()
+        try:
+            for x in range(5):
+                cache.put(16, x, 1, tileData(16, x, 1))
+            for x in range(5):
+                assert cache.get(16, x, 1)[0] == tileData(16, x, 1)
+            assert cache.get(16, 9, 9) == (None, None)
+        finally:
+            cache.close()
+
+        cache = DBDiskCache(str(tmp_path), desc, conf.DB_SCHEMA, is_concurrency=False)
+        cache.start()
+        try:
+            tiles = cache.getMany(16, range(0, 10), range(0, 10))
+            assert sorted(tiles) == [(x, 1) for x in range(5)]
+            assert all(data == tileData(16, x, y) for (x, y), (data, ts) in tiles.items())
+        finally:
+            cache.close()
+
+    def test_batch_window(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_DB_BATCH_MS', 60000)
+        monkeypatch.setattr(conf, 'TILE_DB_BATCH_SIZE', 100)
+        cache = DBDiskCache(str(tmp_path), genMapDesc(), conf.DB_SCHEMA)
+        cache.start()
+        try:
+            for x in range(3):
+                cache.put(16, x, 0, tileData(16, x, 0))
+            time.sleep(0.2)
+            assert cache.stats['put_tiles'] == 0  #waiting for the batch
+            assert sorted(cache.getMany(16, range(3), range(1))) == [(0, 0), (1, 0), (2, 0)]
+
+            #a full batch is written at once
+            cache.putMany([(16, x, 1, tileData(16, x, 1), None) for x in range(100)])
+            assert waitUntil(lambda: cache.stats['put_tiles'] == 103)
+            assert cache.stats['put_batches'] == 1
+        finally:
+            cache.close()
+        assert cache.stats['put_tiles'] == 103
+
+    def test_dedup_replace(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_DB_DEDUP', True)
+        cache = DBDiskCache(str(tmp_path), genMapDesc(), conf.DB_SCHEMA, is_concurrency=False)
+        cache.start()
+        try:
+            cache.putMany([(16, x, 0, b'shared', None) for x in range(2)] + [(16, 2, 0, b'own', None)])
+            cache.put(16, 0, 0, b'new')  #the shared image is still referenced
+            cache.put(16, 2, 0, b'new')  #the own image is orphaned
+            cache.put(16, 1, 0, b'shared')  #the same image
+            assert [cache.get(16, x, 0)[0] for x in range(3)] == [b'new', b'shared', b'new']
+        finally:
+            cache.close()
+
+        conn = sqlite3.connect(str(tmp_path / "test.mbtiles"))
+        try:
+            assert DBDiskCache.isDedup(conn)
+            ids = sorted(row[0] for row in conn.execute("SELECT tile_id FROM images"))
+            assert ids == sorted(DBDiskCache.genTileHash(data) for data in (b'shared', b'new'))
+        finally:
+            conn.close()
+
+    def test_inflight_visible(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_DB_BATCH_MS', 0)
+        cache = DBDiskCache(str(tmp_path), genMapDesc(), conf.DB_SCHEMA)
+
+        #hold the batch being written
+        entered = Event()
+        release = Event()
+        put_many = cache._DBDiskCache__putMany
+        def slowPutMany(items):
+            entered.set()
+            release.wait(10)
+            put_many(items)
+        cache._DBDiskCache__putMany = slowPutMany
+
+        cache.start()
+        try:
+            cache.put(16, 1, 2, tileData(16, 1, 2), color=(1, 2, 3, 255))
+            assert entered.wait(10)
+            assert cache.get(16, 1, 2)[0] == tileData(16, 1, 2)
+            assert cache.getMany(16, range(3), range(3))[(1, 2)][0] == tileData(16, 1, 2)
+            assert (1, 2) in cache.getTimestamps(16, range(3), range(3))
+            assert cache.getColors(16, range(3), range(3)) == {(1, 2): (1, 2, 3, 255)}
+        finally:
+            release.set()
+            cache.close()
+
+    def test_reader_pool(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_DB_BATCH_MS', 0)
+        monkeypatch.setattr(conf, 'TILE_DB_READERS', 2)
+        cache = DBDiskCache(str(tmp_path), genMapDesc(), conf.DB_SCHEMA)
+
+        opened = []
+        open_reader = cache._DBDiskCache__openReader
+        def countOpenReader():
+            conn = open_reader()
+            opened.append(conn)
+            return conn
+        cache._DBDiskCache__openReader = countOpenReader
+
+        cache.start()
+        errors = []
+        def job(y):
+            try:
+                for i in range(20):
+                    assert cache.get(16, i % 8, y)[0] == tileData(16, i % 8, y)
+                    assert len(cache.getMany(16, range(8), range(y, y+1))) == 8
+            except Exception as ex:
+                errors.append(ex)
+
+        try:
+            cache.putMany([(16, x, y, tileData(16, x, y), None) for x in range(8) for y in range(8)])
+            assert waitUntil(lambda: cache.stats['put_tiles'] == 64)
+
+            workers = [Thread(target=job, args=(y,)) for y in range(8)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            assert not errors
+            assert 1 <= len(opened) <= 2  #the connections are reused, and bounded
+        finally:
+            cache.close()
+        assert cache.stats['get_misses'] == 0
+
+
+def genReq(level, x, y):
+    return (level, x, y, 0, None)
+
+class TestTileReqQueue:
+    def test_lifo(self):
+        queue = TileReqQueue()
+        for id in "abc":
+            queue.push(id, genReq(16, 0, 0))
+        assert [queue.pop()[0] for i in range(3)] == ["c", "b", "a"]
+
+    def test_distance_priority(self):
+        queue = TileReqQueue()
+        queue.setFocus(16, (10, 10, 11, 11))  #center (11, 11)
+        queue.push("far", genReq(16, 20, 11))
+        queue.push("near", genReq(16, 12, 10))
+        queue.push("center", genReq(16, 10, 10))
+        queue.push("level", genReq(17, 22, 22))  #at the center but a level away
+        assert [queue.pop()[0] for i in range(4)] == ["center", "near", "level", "far"]
+
+    def test_replace(self):
+        queue = TileReqQueue()
+        queue.setFocus(16, (10, 10, 11, 11))
+        queue.push("a", genReq(16, 10, 10))
+        queue.push("b", genReq(16, 14, 14))
+        queue.push("a", genReq(16, 30, 30), is_prefetch=True)  #re-prioritized
+        assert len(queue) == 2
+        assert queue.isPrefetch("a") and not queue.isPrefetch("b")
+        assert queue.get("a") == genReq(16, 30, 30)
+
+        #the stale entry of 'a' is skipped
+        assert queue.pop() == ("b", genReq(16, 14, 14))
+        assert queue.pop() == ("a", genReq(16, 30, 30))
+        assert len(queue) == 0 and "a" not in queue
+        with pytest.raises(IndexError):
+            queue.pop()
+
+    def test_refocus(self):
+        queue = TileReqQueue()
+        for x in range(5):
+            queue.push(x, genReq(16, x, 0))  #LIFO before the focus
+        assert queue.setFocus(16, (0, 0, 0, 0), margin=10) == []
+        assert [queue.pop()[0] for i in range(5)] == [0, 1, 2, 3, 4]
+
+    def test_focus_priority(self):
+        queue = TileReqQueue()
+        queue.setFocus(16, (10, 10, 13, 13))
+        queue.push("prefetch", genReq(16, 12, 12), is_prefetch=True)
+        queue.push("far", genReq(16, 20, 20))
+        queue.push("upper", genReq(15, 5, 5))
+        queue.push("center", genReq(16, 11, 11))
+        assert [queue.pop()[0] for i in range(4)] == ["center", "upper", "far", "prefetch"]
+
+    def test_focus_drop(self):
+        queue = TileReqQueue()
+        queue.push("in", genReq(16, 11, 11))
+        queue.push("out", genReq(16, 30, 30))
+        queue.push("lower", genReq(17, 22, 22))
+        queue.push("pf_out", genReq(16, 30, 30), is_prefetch=True)
+        queue.push("pf_upper", genReq(15, 5, 5), is_prefetch=True)
+        queue.push("pf_lower", genReq(17, 27, 27), is_prefetch=True)  #in the margin
+        queue.push("pf_lower_out", genReq(17, 60, 60), is_prefetch=True)
+        queue.push("pf_lower2", genReq(18, 44, 44), is_prefetch=True)
+
+        dropped = queue.setFocus(16, (10, 10, 13, 13), margin=2)
+        assert sorted(id for id, req in dropped) == ["lower", "out", "pf_lower2", "pf_lower_out", "pf_out"]
+        assert sorted(queue.pop()[0] for i in range(len(queue))) == ["in", "pf_lower", "pf_upper"]
+
+    def test_scale_bounds(self):
+        assert TileReqQueue.scaleBounds((10, 10, 13, 13), 0) == (10, 10, 13, 13)
+        assert TileReqQueue.scaleBounds((10, 10, 13, 13), 1) == (20, 20, 27, 27)
+        assert TileReqQueue.scaleBounds((10, 11, 13, 13), -1) == (5, 5, 6, 6)
+
+
+class TestTileAgent:
+    #@tiles is the list of (level, x, y[, timestamp]) in disk
+    def startAgent(self, tmp_path, tiles, expire_days=0, color=None):
+        desc = genMapDesc("test_agent", expire_days)
+        db = DBDiskCache(str(tmp_path), desc, conf.DB_SCHEMA, is_concurrency=False)
+        db.start()
+        db.putMany([tile[:3] + (PNG_DATA, tile[3] if len(tile) > 3 else None, color) for tile in tiles])
+        db.close()
+        return TileAgent(desc, str(tmp_path), auto_start=True)
+
+    def test_get_tiles_expired(self, tmp_path):
+        agent = self.startAgent(tmp_path, [(16, 0, 0, 1), (16, 1, 0)], expire_days=1)
+        try:
+            for i in range(2):  #from disk, and from memory
+                expired = set()
+                tiles, missing = agent.getTiles(16, range(3), range(1), None, allow_fake=False, expired=expired)
+                assert sorted(tiles) == [(0, 0), (1, 0)]
+                assert missing == {(2, 0)}
+                assert expired == {(0, 0)}
+        finally:
+            agent.close()
+
+    def test_get_tiles_counted_once(self, tmp_path):
+        agent = self.startAgent(tmp_path, [(16, 0, 0), (16, 1, 0)])
+        try:
+            agent.getTiles(16, range(3), range(1), None, allow_fake=False)
+            stats = agent.getStats()['mem']
+            assert (stats['hits'], stats['misses']) == (2, 1)
+        finally:
+            agent.close()
+
+    def test_prefetch_stats(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(conf, 'TILE_PREFETCH_DELAY_MS', 0)
+        monkeypatch.setattr(conf, 'TILE_PREFETCH_RING', 1)
+        monkeypatch.setattr(conf, 'TILE_PREFETCH_NETWORK', True)
+
+        #the ring around the viewport is in disk, but the adjacent levels are not
+        ring = [(16, x, y) for x in range(9, 13) for y in range(9, 13) if not (10 <= x <= 11 and 10 <= y <= 11)]
+        agent = self.startAgent(tmp_path, ring)
+        try:
+            agent.setViewport(16, 10, 10, 11, 11)
+            assert waitUntil(lambda: agent.getStats()['prefetch']['reqs'] == 5)  #1 of level 15, 4 of level 17
+            stats = agent.getStats()['prefetch']
+            assert stats['tiles'] == len(ring)
+            assert stats['hits'] == 0
+
+            for x in range(9, 12):
+                assert agent.getTile(16, x, 9, "sync", allow_fake=False) is not None
+            agent.getTile(16, 9, 9, "sync", allow_fake=False)  #counted once
+            stats = agent.getStats()['prefetch']
+            assert stats['hits'] == 3
+            assert stats['hit_rate'] == pytest.approx(3 / (len(ring) + 5))
+        finally:
+            agent.close()
+
+    @pytest.mark.parametrize("load", [
+        lambda agent: agent.getTiles(16, range(1), range(1), None, allow_fake=False),
+        lambda agent: agent.getTile(16, 0, 0, None, allow_fake=False),
+    ])
+    def test_fake_invalidated_by_disk(self, tmp_path, load):
+        agent = self.startAgent(tmp_path, [(15, 0, 0)])
+        try:
+            #the fake magnified from level 15, the green
+            assert agent.getTile(17, 0, 0, None).getpixel((0, 0))[:3] == (0, 128, 0)
+
+            #the tile of level 16 is saved into disk by others, and not in memory
+            buf = BytesIO()
+            Image.new("RGB", (256, 256), "red").save(buf, "PNG")
+            db = DBDiskCache(str(tmp_path), genMapDesc("test_agent"), conf.DB_SCHEMA, is_concurrency=False)
+            db.start()
+            db.put(16, 0, 0, buf.getvalue())
+            db.close()
+            agent._TileAgent__mem_cache.remove(agent.genTileId(16, 0, 0))
+
+            assert load(agent) is not None
+            assert agent.getTile(17, 0, 0, None).getpixel((0, 0))[:3] == (255, 0, 0)
+        finally:
+            agent.close()
+
+    def test_fake_invalidated_by_levels(self, tmp_path):
+        agent = self.startAgent(tmp_path, [(16, x, 0) for x in range(3)] + [(15, 0, 0)])
+        fake_cache = agent._TileAgent__fake_cache
+        removed = []
+        remove = fake_cache.remove
+        def countRemove(id):
+            removed.append(id)
+            remove(id)
+        fake_cache.remove = countRemove
+        try:
+            #no fake tiles, nothing to invalidate
+            agent.getTiles(16, range(2), range(1), None, allow_fake=False)
+            assert removed == []
+
+            #only the level of the fake tiles
+            assert agent.getTile(18, 8, 0, None) is not None  #magnified from (16, 2, 0)
+            agent.getTiles(15, range(1), range(1), None, allow_fake=False)
+            assert sorted(removed) == sorted(agent.genTileId(18, x, y) for x in range(8) for y in range(8))
+        finally:
+            agent.close()
+
+    def test_uniform_tile_lru(self, monkeypatch):
+        monkeypatch.setattr(TileAgent, 'uniform_tiles', OrderedDict())
+        monkeypatch.setattr(TileAgent, 'MAX_UNIFORM_TILES', 2)
+        red = TileAgent.getUniformTile((255, 0, 0, 255))
+        green = TileAgent.getUniformTile((0, 255, 0, 255))
+        assert TileAgent.getUniformTile((255, 0, 0, 255)) is red
+        TileAgent.getUniformTile((0, 0, 255, 255))  #evict the least recently used, green
+        assert list(TileAgent.uniform_tiles) == [(255, 0, 0, 255), (0, 0, 255, 255)]
+        assert TileAgent.getUniformTile((255, 0, 0, 255)) is red
+        assert TileAgent.getUniformTile((0, 255, 0, 255)) is not green
+        assert red.fill_color == (255, 0, 0, 255)
+
+    def test_uniform_tile_shared(self, tmp_path):
+        color = (0, 128, 0, 255)
+        agent = self.startAgent(tmp_path, [(16, 0, 0), (16, 1, 0)], color=color)
+        try:
+            tiles, missing = agent.getTiles(16, range(3), range(1), None)
+            assert missing == {(2, 0)}
+            assert tiles[(0, 0)] is tiles[(1, 0)] is TileAgent.getUniformTile(color)
+            assert not hasattr(tiles[(0, 0)], 'is_fake')
+
+            #also by the single tile
+            assert agent.getTile(16, 1, 0, None) is tiles[(1, 0)]
+            agent._TileAgent__mem_cache.remove(agent.genTileId(16, 1, 0))
+            assert agent.getTile(16, 1, 0, None) is tiles[(1, 0)]
+
+            #the shared tiles are not charged as the data of the cache
+            assert MemoryCache.sizeOf(tiles[(0, 0)]) == MemoryCache.ITEM_OVERHEAD
+            assert MemoryCache.sizeOf(Image.new("RGBA", (256, 256))) > 256 * 256
+        finally:
+            agent.close()
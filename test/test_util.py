@@ -0,0 +1,131 @@
+import pytest
+import pytz
+from threading import Thread
+from io import BytesIO
+from datetime import datetime, timedelta
+from PIL import Image
+
+from src.util import TimezoneResolver, getTrkLocaltimes, tuneAlpha, getUniformColorOfData
+from src.gpx import Track, ColumnarTrack, TrackPoint
+
+
+NEW_YORK = (40.71, -74.0)    #DST at 2016-03-13 07:00 UTC
+ADELAIDE = (-34.93, 138.6)   #+10:30 -> +9:30 at 2016-04-02 16:30 UTC
+KATHMANDU = (27.7, 85.3)     #+5:45
+
+#the times of every @step from @start for @n
+def genTimes(start, step, n):
+    return [start + step * i for i in range(n)]
+
+def toFields(t):
+    return (t.replace(tzinfo=None), t.utcoffset(), t.tzname())
+
+
+class TestTimezoneResolver:
+    @pytest.mark.parametrize("loc, start", [
+        (NEW_YORK, datetime(2016, 3, 13, 6, 0, tzinfo=pytz.utc)),
+        (NEW_YORK, datetime(2016, 11, 6, 5, 0, tzinfo=pytz.utc)),
+        (ADELAIDE, datetime(2016, 4, 2, 15, 30, tzinfo=pytz.utc)),
+        (ADELAIDE, datetime(2016, 10, 1, 15, 30, tzinfo=pytz.utc)),
+        (KATHMANDU, datetime(2016, 1, 1, 18, 0, tzinfo=pytz.utc)),
+    ])
+    def test_localtimes_slot(self, loc, start):
+        lat, lon = loc
+        tz = TimezoneResolver.getTimezone(lat, lon)
+        times = genTimes(start, timedelta(seconds=37), 400)  #across the slots, and the change of offset
+        local_times = TimezoneResolver.getLocaltimesOf([lat] * len(times), [lon] * len(times), times)
+        assert [toFields(t) for t in local_times] == [toFields(t.astimezone(tz)) for t in times]
+        assert len(set(t.utcoffset() for t in local_times)) == (1 if loc == KATHMANDU else 2)
+
+    def test_localtimes_mixed(self):
+        #the slot is not reused by another timezone, or the naive time
+        times = genTimes(datetime(2016, 3, 13, 6, 55, tzinfo=pytz.utc), timedelta(minutes=1), 10)
+        times[3] = None
+        times[5] = times[5].replace(tzinfo=None)
+        locs = [NEW_YORK, KATHMANDU] * 5
+        local_times = TimezoneResolver.getLocaltimesOf([loc[0] for loc in locs], [loc[1] for loc in locs], times)
+        for t, local, loc in zip(times, local_times, locs):
+            if t is None:
+                assert local is None
+            else:
+                tz = TimezoneResolver.getTimezone(*loc)
+                assert toFields(local) == toFields(t.astimezone(tz))
+
+    def test_localtimes_threads(self):
+        #the threads converting the times of different timezones, by the shared slot and their own slots
+        times = genTimes(datetime(2016, 3, 13, 6, 0, tzinfo=pytz.utc), timedelta(seconds=37), 300)
+        errors = []
+
+        def job(loc):
+            tz = TimezoneResolver.getTimezone(*loc)
+            expected = [toFields(t.astimezone(tz)) for t in times]
+            for i in range(5):
+                if [toFields(TimezoneResolver.toLocaltime(t, tz)) for t in times] != expected:
+                    errors.append(loc)
+                lats, lons = [loc[0]] * len(times), [loc[1]] * len(times)
+                if [toFields(t) for t in TimezoneResolver.getLocaltimesOf(lats, lons, times)] != expected:
+                    errors.append(loc)
+
+        workers = [Thread(target=job, args=(loc,)) for loc in (NEW_YORK, ADELAIDE, KATHMANDU) * 2]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        assert errors == []
+
+    def test_memo(self, monkeypatch):
+        resolved = []
+        def resolve(lat, lon):
+            resolved.append((lat, lon))
+            return pytz.timezone('Asia/Taipei')
+        monkeypatch.setattr(TimezoneResolver, '_TimezoneResolver__memo', {})
+        monkeypatch.setattr(TimezoneResolver, '_TimezoneResolver__resolve', resolve)
+        monkeypatch.setattr(TimezoneResolver, 'MEMO_MAX', 2)
+
+        lats = [24.001, 24.002, 24.003, 24.015, 24.001]  #cells: a, a, a, b, a
+        lons = [121.001] * len(lats)
+        tzs = TimezoneResolver.getTimezonesOf(lats, lons)
+        assert all(tz is tzs[0] for tz in tzs)
+        assert resolved == [(24.001, 121.001), (24.015, 121.001)]
+
+        TimezoneResolver.getTimezone(25.0, 121.0)  #a new cell over the max, which clears the memo
+        TimezoneResolver.getTimezone(24.002, 121.002)
+        assert len(resolved) == 4
+
+    @pytest.mark.parametrize("trk_cls", [Track, ColumnarTrack])
+    def test_trk_localtimes(self, trk_cls):
+        trk = trk_cls()
+        for i, t in enumerate(genTimes(datetime(2016, 3, 13, 6, 0, tzinfo=pytz.utc), timedelta(minutes=7), 30)):
+            pt = TrackPoint(NEW_YORK[0] + i * 1e-3, NEW_YORK[1])
+            pt.time = None if i == 10 else t
+            trk.add(pt)
+        assert getTrkLocaltimes(trk) == TimezoneResolver.getLocaltimes(trk)
+        assert getTrkLocaltimes(trk)[10] is None
+
+
+class TestTuneAlpha:
+    @pytest.mark.parametrize("alpha, a", [(0.0, 0), (0.5, 128)])
+    def test_not_modified(self, alpha, a):
+        img = Image.new("RGBA", (4, 4), (10, 20, 30, 255))
+        tuned = tuneAlpha(img, alpha)
+        assert tuned is not img
+        assert tuned.getpixel((0, 0)) == (10, 20, 30, a)
+        assert img.getpixel((0, 0)) == (10, 20, 30, 255)
+
+
+class TestUniformColorOfData:
+    def encode(self, img):
+        buf = BytesIO()
+        img.save(buf, "PNG")
+        return buf.getvalue()
+
+    def test_uniform(self):
+        assert getUniformColorOfData(self.encode(Image.new("RGB", (256, 256), "green"))) == (0, 128, 0, 255)
+
+    def test_not_uniform(self):
+        img = Image.new("RGB", (256, 256), "green")
+        img.putpixel((10, 10), (255, 0, 0))
+        assert getUniformColorOfData(self.encode(img)) is None
+
+    def test_broken(self):
+        assert getUniformColorOfData(b'not a png') is None